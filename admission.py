@@ -0,0 +1,118 @@
+"""
+Admission control for the web service.
+
+Before anything is rendered, the page sizes of every upload are read from the
+PDF page tree (no rasterization) and turned into a rough upper estimate of the
+memory the request will need at the configured DPI. A request whose estimate
+exceeds the per-request budget is rejected; otherwise it reserves its estimate
+from a process-wide MemoryBudget, which also caps the number of requests
+formatting at once. When the budget is exhausted a request waits for a
+bounded time and is then turned away, instead of the host running out of
+memory. An upload whose page tree cannot be read is refused outright: it has
+no size to charge, and the pipeline could not format it either.
+"""
+import math
+import threading
+from merge import pdf_reader
+
+POINTS_PER_INCH = 72
+
+class UnreadablePdf(Exception):
+    """Raised when the page sizes of an upload cannot be read, so its cost is unknown."""
+    def __init__(self, index, error):
+        super().__init__(f"File {index + 1} is not a readable PDF ({type(error).__name__}: {error})")
+        self.index = index
+
+def page_sizes(source, first_page_only=False):
+    """
+    (width, height) in points of the pages of a PDF (bytes or path), with /Rotate applied.
+    """
+    pages = pdf_reader(source).pages
+    sizes = []
+    for page in pages[:1] if first_page_only else pages:
+        width, height = float(page.mediabox.width), float(page.mediabox.height)
+        if page.rotation % 180:
+            width, height = height, width
+        sizes.append((width, height))
+    return sizes
+
+def page_cost(width_pt, height_pt, dpi, grayscale=False, band_rows=None, aspect_w=8.5, aspect_h=11):
+    """
+    Peak bytes held while one page is rendered, cropped and segmented at dpi.
+    The whole render is counted twice, for the render and its cropped copy (the
+    ink mask is built a few rows at a time), plus one segment. A band of
+    band_rows rows also counts its grayscale copy and ink mask.
+    """
+    channels = 1 if grayscale else 3
+    width = math.ceil(width_pt * dpi / POINTS_PER_INCH)
+    height = math.ceil(height_pt * dpi / POINTS_PER_INCH)
+    segment_rows = min(height, int(width * aspect_h / aspect_w))
+    if band_rows and height > band_rows:
+        render = width * band_rows * (2 * channels + 2)
+    else:
+        render = width * height * 2 * channels
+    return render + width * segment_rows * channels
+
+def estimate_request_bytes(sources, dpi, grayscale=False, band_rows=None, page_workers=1, output_dpi=None,
+                           first_page_only=False, page_w_in=8.5, page_h_in=11, compose_workers=1):
+    """
+    Upper estimate of the memory needed to format sources one after another,
+    with up to page_workers pages of an input in flight. Each page in flight
+    also has compose_workers PageComposers, each holding a page buffer at
+    output_dpi and the fitted segment pasted onto it. Raises UnreadablePdf for
+    a source whose page tree cannot be read, rather than counting it as free.
+    """
+    out_dpi = output_dpi or dpi
+    compose = 2 * int(page_w_in * out_dpi) * int(page_h_in * out_dpi) * (1 if grayscale else 3) * compose_workers
+    largest = 0
+    for index, source in enumerate(sources):
+        try:
+            sizes = page_sizes(source, first_page_only)
+        except Exception as exc:
+            raise UnreadablePdf(index, exc) from exc
+        if not sizes:
+            continue
+        worst = max(page_cost(width, height, dpi, grayscale, band_rows) for width, height in sizes)
+        largest = max(largest, (worst + compose) * min(page_workers, len(sizes)))
+    return largest
+
+class MemoryBudget:
+    """
+    Counting semaphore over bytes and request slots. acquire() waits until the
+    estimate fits in what is left of max_bytes and a slot is free.
+    """
+    def __init__(self, max_bytes, max_concurrent):
+        self.max_bytes = max_bytes
+        self.max_concurrent = max_concurrent
+        self._reserved = 0
+        self._active = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes, timeout=None):
+        """
+        Reserve nbytes and one slot. Returns False if that was not possible within timeout seconds.
+        """
+        nbytes = min(nbytes, self.max_bytes)
+        with self._cond:
+            admitted = self._cond.wait_for(
+                lambda: self._active < self.max_concurrent and self._reserved + nbytes <= self.max_bytes, timeout
+            )
+            if not admitted:
+                return False
+            self._reserved += nbytes
+            self._active += 1
+        return True
+
+    def release(self, nbytes):
+        nbytes = min(nbytes, self.max_bytes)
+        with self._cond:
+            self._reserved -= nbytes
+            self._active -= 1
+            self._cond.notify_all()
+
+    def usage(self):
+        """
+        (reserved bytes, active requests).
+        """
+        with self._cond:
+            return self._reserved, self._active
@@ -0,0 +1,198 @@
+"""
+Banded rendering for very tall pages.
+
+Instead of rasterizing a whole page into one bitmap, the page is rendered in
+horizontal strips with poppler's region options (-x/-y/-W/-H). The strips are
+scanned once to find the content bounding box and the row-ink profile, then
+thrown away. The rows of each output segment are rendered only when that
+segment is requested, so peak memory depends on the band and segment size,
+not on the page height.
+
+The two-resolution mode (load_preview_page) finds the bounding box and the
+profile on a low-DPI preview instead and scales them to the output DPI. Each
+edge of the box is then pinned down exactly from a narrow full-resolution strip
+around it, and otherwise only the segments are rendered at full resolution.
+"""
+import math
+import numpy as np
+from merge import (DEFAULT_DPI, WHITE_THRESHOLD, find_content_bbox, pdf_reader, render_pdf_page, row_ink_profile,
+                   run_poppler)
+from metrics import stage
+
+POINTS_PER_INCH = 72
+# Rows per analysis strip when a caller does not choose
+DEFAULT_BAND_ROWS = 2048
+# Resolution of the layout preview in two-resolution mode
+DEFAULT_PREVIEW_DPI = 75
+
+def page_size_pixels(pdf_path, page=1, dpi=DEFAULT_DPI):
+    """
+    Size (width, height) in pixels of a page rendered at dpi, without rendering it.
+    Matches poppler: the media box, with /Rotate applied, rounded up.
+    """
+    src = pdf_reader(pdf_path).pages[page - 1]
+    width = float(src.mediabox.width)
+    height = float(src.mediabox.height)
+    if src.rotation % 180:
+        width, height = height, width
+    return math.ceil(width * dpi / POINTS_PER_INCH), math.ceil(height * dpi / POINTS_PER_INCH)
+
+def render_region(pdf_path, page, dpi, x, y, width, height, grayscale=False, backend="pdftoppm",
+                  poppler_path=None):
+    """
+    Render the pixel rectangle (x, y, width, height) of a page at dpi.
+    Poppler clips the rectangle to the page, so the image may be smaller than asked.
+    """
+    with stage("render_region", backend=backend, dpi=dpi) as info:
+        img = run_poppler(pdf_path, page, dpi, grayscale, backend, poppler_path, (x, y, width, height))
+        info["pixels"] = img.width * img.height
+    return img
+
+def scan_page_bands(pdf_path, page=1, dpi=DEFAULT_DPI, band_rows=DEFAULT_BAND_ROWS, threshold=WHITE_THRESHOLD,
+                    grayscale=False, backend="pdftoppm", poppler_path=None):
+    """
+    Render a page strip by strip and return (bbox, counts): the content bounding
+    box (None for a blank page) and the row-ink profile of the full page width.
+    Columns outside the bounding box hold no ink, so counts[y0:y1] is also the
+    profile of the cropped page.
+    """
+    width, height = page_size_pixels(pdf_path, page, dpi)
+    profiles = []
+    x0, x1 = width, 0
+    y = 0
+    while y < height:
+        rows = min(band_rows, height - y)
+        band = render_region(pdf_path, page, dpi, 0, y, width, rows, grayscale, backend, poppler_path)
+        mask = np.asarray(band if band.mode == "L" else band.convert("L")) < threshold
+        profiles.append(np.count_nonzero(mask, axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if cols.size:
+            x0 = min(x0, int(cols[0]))
+            x1 = max(x1, int(cols[-1]) + 1)
+        y += band.height
+        if band.height < rows:
+            break
+    counts = np.concatenate(profiles) if profiles else np.zeros(0, dtype=np.intp)
+    ink_rows = np.flatnonzero(counts)
+    if ink_rows.size == 0:
+        return None, counts
+    return (x0, int(ink_rows[0]), x1, int(ink_rows[-1]) + 1), counts
+
+class BandedPage:
+    """
+    The cropped content of a page, rendered on demand.
+    Offers the size, mode and crop() of a PIL image, so segment_image_by_aspect_ratio
+    can cut it like a rendered page while only the requested rows are rasterized.
+    """
+    def __init__(self, pdf_path, page, dpi, bbox, grayscale=False, backend="pdftoppm", poppler_path=None):
+        self.pdf_path = pdf_path
+        self.page = page
+        self.dpi = dpi
+        self.bbox = bbox
+        self.grayscale = grayscale
+        self.backend = backend
+        self.poppler_path = poppler_path
+        self.width = bbox[2] - bbox[0]
+        self.height = bbox[3] - bbox[1]
+        self.size = (self.width, self.height)
+        self.mode = "L" if grayscale else "RGB"
+
+    def crop(self, box):
+        left, top, right, bottom = box
+        img = render_region(self.pdf_path, self.page, self.dpi, self.bbox[0] + left, self.bbox[1] + top,
+                            right - left, bottom - top, self.grayscale, self.backend, self.poppler_path)
+        return img if img.mode == self.mode else img.convert(self.mode)
+
+def load_banded_page(pdf_path, page=1, dpi=DEFAULT_DPI, band_rows=DEFAULT_BAND_ROWS, grayscale=False,
+                     backend="pdftoppm", poppler_path=None):
+    """
+    Banded counterpart of crop_pdf_first_page: returns (BandedPage, counts), the
+    cropped page and its row-ink profile. A blank page keeps its full size.
+    """
+    with stage("scan_bands") as info:
+        bbox, counts = scan_page_bands(pdf_path, page, dpi, band_rows, grayscale=grayscale, backend=backend,
+                                       poppler_path=poppler_path)
+        if bbox is None:
+            bbox = (0, 0, page_size_pixels(pdf_path, page, dpi)[0], len(counts))
+        info["pixels"] = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+    return BandedPage(pdf_path, page, dpi, bbox, grayscale, backend, poppler_path), counts[bbox[1]:bbox[3]]
+
+def scale_box(bbox, scale, width, height):
+    """
+    Map a box found at preview resolution onto a page of width x height pixels,
+    scale times larger, widened to whole output pixels.
+    """
+    x0, y0, x1, y1 = bbox
+    return (
+        math.floor(x0 * scale),
+        math.floor(y0 * scale),
+        min(math.ceil(x1 * scale), width),
+        min(math.ceil(y1 * scale), height),
+    )
+
+def scale_profile(counts, first_row, scale, start, end):
+    """
+    Row-ink profile of output rows [start, end) from a preview profile whose
+    first entry is preview row first_row. Each output row takes the count of the
+    preview row it falls in, scaled to output pixels.
+    """
+    index = (np.arange(start, end) / scale).astype(np.intp) - first_row
+    return np.rint(counts[np.clip(index, 0, len(counts) - 1)] * scale).astype(np.intp)
+
+def _ink_extent(img, axis, threshold=WHITE_THRESHOLD):
+    # First and last column (axis=0) or row (axis=1) with ink, or None
+    mask = np.asarray(img if img.mode == "L" else img.convert("L")) < threshold
+    found = np.flatnonzero(mask.any(axis=axis))
+    if found.size == 0:
+        return None
+    return int(found[0]), int(found[-1]) + 1
+
+def refine_bbox(pdf_path, page, dpi, bbox, margin, width, height, backend="pdftoppm", poppler_path=None):
+    """
+    Snap each edge of an approximate content box to the exact full-resolution
+    edge by rendering only a strip margin pixels either side of it.
+    """
+    x0, y0, x1, y1 = bbox
+    top, bottom = max(y0 - margin, 0), min(y1 + margin, height)
+
+    def strip(x, y, w, h, axis):
+        x, y = max(x, 0), max(y, 0)
+        img = render_region(pdf_path, page, dpi, x, y, w, h, True, backend, poppler_path)
+        extent = _ink_extent(img, axis)
+        if extent is None:
+            return None
+        offset = x if axis == 0 else y
+        return extent[0] + offset, extent[1] + offset
+
+    with stage("refine_bbox", dpi=dpi):
+        left = strip(x0 - margin, top, 2 * margin, bottom - top, 0)
+        right = strip(x1 - margin, top, min(2 * margin, width - x1 + margin), bottom - top, 0)
+        x0 = left[0] if left else x0
+        x1 = right[1] if right else x1
+        upper = strip(x0, y0 - margin, x1 - x0, 2 * margin, 1)
+        lower = strip(x0, y1 - margin, x1 - x0, min(2 * margin, height - y1 + margin), 1)
+        y0 = upper[0] if upper else y0
+        y1 = lower[1] if lower else y1
+    return x0, y0, x1, y1
+
+def load_preview_page(pdf_path, page=1, dpi=DEFAULT_DPI, preview_dpi=DEFAULT_PREVIEW_DPI, grayscale=False,
+                      backend="pdftoppm", poppler_path=None):
+    """
+    Two-resolution counterpart of crop_pdf_first_page: returns (BandedPage, counts)
+    at dpi, with the content box and profile taken from a preview at preview_dpi.
+    """
+    width, height = page_size_pixels(pdf_path, page, dpi)
+    with stage("preview", dpi=preview_dpi) as info:
+        preview = render_pdf_page(pdf_path, page=page, dpi=preview_dpi, grayscale=True, backend=backend,
+                                  poppler_path=poppler_path)
+        info["pixels"] = preview.width * preview.height
+        preview_bbox = find_content_bbox(preview)
+        if preview_bbox is None:
+            return BandedPage(pdf_path, page, dpi, (0, 0, width, height), grayscale, backend,
+                              poppler_path), np.zeros(height, dtype=np.intp)
+        preview_counts = row_ink_profile(preview.crop(preview_bbox))
+    scale = dpi / preview_dpi
+    bbox = refine_bbox(pdf_path, page, dpi, scale_box(preview_bbox, scale, width, height), 2 * math.ceil(scale),
+                       width, height, backend, poppler_path)
+    counts = scale_profile(preview_counts, preview_bbox[1], scale, bbox[1], bbox[3])
+    return BandedPage(pdf_path, page, dpi, bbox, grayscale, backend, poppler_path), counts
@@ -0,0 +1,453 @@
+"""
+Benchmark harness for the formatting pipeline.
+
+Synthetic PDFs are generated locally (no network, no extra dependencies) and
+each pipeline stage is timed separately: render and crop, bottom-row analysis,
+segmentation, page composition (resize) and encoding. Results, including peak
+memory, are written as JSON so runs from different commits can be compared:
+
+    python bench.py -o before.json
+    python bench.py -o after.json --compare before.json
+
+--check-startup measures the web app instead: the cost of importing it and
+serving the upload form (which must not load the pipeline), then, under
+gunicorn (gunicorn.conf.py, wsgi:app) with and without the warm-up, the time
+until the server answers and the latency of the first and later uploads.
+Exit status 1 if the form loads numpy or a request fails.
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+import uuid
+import numpy as np
+import PIL
+from PIL import Image
+from merge import (
+    DEFAULT_DPI,
+    BREAK_STRATEGIES,
+    load_page_array,
+    resolve_grayscale,
+    page_numbers,
+    plan_segments,
+    plan_breaks,
+    analyze_bottom_rows,
+    segment_image_by_aspect_ratio,
+    PageComposer,
+    RESAMPLE_FILTERS,
+    iter_pdf_pages,
+)
+from pdf_writer import PdfStreamWriter, encode_page, share_strips
+
+LETTER = (612, 792)
+WORDS = "the quick brown fox jumps over lazy dog segment page render poppler numpy layout".split()
+
+def _text_lines(width, height, rng, line_gap=14, font_size=10, density=1.0):
+    ops = []
+    y = height - 36
+    while y > 36:
+        if rng.random() < density:
+            words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 14)))
+            ops.append(f"BT /F1 {font_size} Tf 36 {y} Td ({words}) Tj ET")
+        y -= line_gap
+    return ops
+
+def _figures(width, height, rng, count):
+    ops = []
+    for _ in range(count):
+        w = rng.randint(60, int(width) - 80)
+        h = rng.randint(30, 200)
+        x = rng.randint(36, max(37, int(width) - w - 36))
+        y = rng.randint(36, max(37, int(height) - h - 36))
+        gray = rng.random() * 0.8
+        ops.append(f"{gray:.2f} {gray:.2f} {1 - gray:.2f} rg {x} {y} {w} {h} re f 0 g")
+    return ops
+
+def _letterhead(width, height):
+    # The same header bar, title and footer on every page, as on handouts from one template
+    return [f"0.2 g 36 {height - 60} {width - 72} 24 re f 0 g",
+            f"BT /F1 14 Tf 36 {height - 84} Td (CMPS 357 Handout - School of Computing and Informatics) Tj ET",
+            "BT /F1 8 Tf 36 40 Td (Copyright School of Computing and Informatics. Do not distribute.) Tj ET"]
+
+def write_pdf_document(path, pages):
+    """
+    Write a minimal PDF. pages is a list of (width_pt, height_pt, [content operators]).
+    """
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for width, height, ops in pages:
+        content = "\n".join(ops).encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (width, height, content_id)
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % kid for kid in kids), len(kids))
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+def generate_cases(directory, tall_inches=60, seed=357):
+    """
+    Create the benchmark PDFs in directory and return {case name: path}.
+    """
+    rng = random.Random(seed)
+    width, height = LETTER
+    tall = int(tall_inches * 72)
+    cases = {
+        "short": [(width, height, _text_lines(width, height, rng))],
+        "tall": [(width, tall, _text_lines(width, tall, rng) + _figures(width, tall, rng, tall_inches // 4))],
+        "sparse": [(width, tall, _text_lines(width, tall, rng, density=0.03))],
+        "dense": [(width, height * 2, _text_lines(width, height * 2, rng, line_gap=9, font_size=8)
+                   + _figures(width, height * 2, rng, 12))],
+        "multipage": [(width, height, _text_lines(width, height, rng)) for _ in range(10)],
+        "repeated": [(width, height, _letterhead(width, height)
+                      + ["q 1 0 0 1 0 64 cm"] + _text_lines(width, height - 160, rng, density=0.6) + ["Q"])
+                     for _ in range(10)],
+    }
+    paths = {}
+    for name, pages in cases.items():
+        path = os.path.join(directory, f"{name}.pdf")
+        write_pdf_document(path, pages)
+        paths[name] = path
+    return paths
+
+def _maxrss_bytes(who):
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+class StageTimer:
+    """
+    Accumulates wall time and the traced peak allocation of a pipeline stage.
+    """
+    def __init__(self):
+        self.seconds = 0.0
+        self.peak_bytes = 0
+
+    @contextlib.contextmanager
+    def measure(self):
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.peak_bytes = max(self.peak_bytes, tracemalloc.get_traced_memory()[1])
+
+def run_case(pdf_path, dpi=DEFAULT_DPI, strategy="greedy", output_dpi=None, resample="lanczos", compose_workers=1,
+             grayscale=False, dedup=False):
+    """
+    Run every stage once on each page of pdf_path and return per-stage timings and counters.
+    Break quality is counted too: cuts whose row holds ink, and the ink in those rows.
+    page_bytes is the memory held by the cropped pages (uint8 arrays, one or three
+    channels depending on grayscale, which may be "auto"). With dedup, pages are
+    split into strips of content and encoded, with repeated strips shared, at the end.
+    With compose_workers > 1, compose and encode overlap across threads, so "compose"
+    times both and "encode" only the writing.
+    """
+    stages = {name: StageTimer() for name in ("render_crop", "analyze", "segment", "compose", "encode")}
+    output = io.BytesIO()
+    writer = PdfStreamWriter(output)
+    # With dedup, pages wait for the whole document (see pdf_writer.share_strips)
+    pending = []
+    add_page = pending.append if dedup else writer.add_page
+    composer = PageComposer(dpi=output_dpi or dpi, resample=resample)
+    pixels = page_bytes = segment_count = inked_cuts = cut_ink = 0
+    for page_num in page_numbers(pdf_path):
+        with stages["render_crop"].measure():
+            cropped, counts = load_page_array(pdf_path, page_num, dpi,
+                                              resolve_grayscale(grayscale, pdf_path, page_num))
+        height, width = cropped.shape[:2]
+        pixels += width * height
+        page_bytes += cropped.nbytes
+        segment_height = int(width / (8.5 / 11))
+        plan = plan_segments(counts, segment_height, dpi)
+        cuts = [counts[end_row - 1] for _, end_row, padded in plan_breaks(counts, segment_height, dpi, strategy)
+                if not padded]
+        inked_cuts += sum(1 for ink in cuts if ink)
+        cut_ink += int(sum(cuts))
+        for seg_num, (start_row, _, _) in enumerate(plan, 1):
+            tentative = Image.fromarray(cropped[start_row:start_row + segment_height])
+            with stages["analyze"].measure():
+                analyze_bottom_rows(tentative, seg_num, dpi=dpi)
+        with stages["segment"].measure():
+            segments = list(segment_image_by_aspect_ratio(cropped, dpi=dpi, counts=counts, strategy=strategy))
+        segment_count += len(segments)
+        if compose_workers > 1:
+            with stages["compose"].measure():
+                pages = list(iter_pdf_pages(segments, dpi=dpi, output_dpi=output_dpi, resample=resample,
+                                            compose_workers=compose_workers, dedup=dedup))
+            with stages["encode"].measure():
+                for page in pages:
+                    add_page(page)
+            continue
+        for segment in segments:
+            with stages["compose"].measure():
+                page = composer.compose(segment)
+            with stages["encode"].measure():
+                add_page(encode_page(page, composer.dpi, dedup=dedup))
+    with stages["encode"].measure():
+        for page in share_strips(pending):
+            writer.add_page(page)
+        writer.close()
+    return {
+        "pixels": pixels,
+        "page_bytes": page_bytes,
+        "segments": segment_count,
+        "inked_cuts": inked_cuts,
+        "cut_ink": cut_ink,
+        "output_bytes": output.tell(),
+        "bytes_saved": writer.bytes_saved,
+        "stages": {name: {"seconds": t.seconds, "peak_traced_bytes": t.peak_bytes} for name, t in stages.items()},
+    }
+
+def _summarize(runs):
+    first = runs[0]
+    stages = {}
+    for name in first["stages"]:
+        seconds = [run["stages"][name]["seconds"] for run in runs]
+        stages[name] = {
+            "min_seconds": min(seconds),
+            "median_seconds": statistics.median(seconds),
+            "peak_traced_bytes": max(run["stages"][name]["peak_traced_bytes"] for run in runs),
+        }
+    return {
+        "pixels": first["pixels"],
+        "page_bytes": first["page_bytes"],
+        "segments": first["segments"],
+        "inked_cuts": first["inked_cuts"],
+        "cut_ink": first["cut_ink"],
+        "output_bytes": first["output_bytes"],
+        "bytes_saved": first["bytes_saved"],
+        "total_median_seconds": sum(stage["median_seconds"] for stage in stages.values()),
+        "stages": stages,
+    }
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    """
+    Print the median time ratio (current / baseline) for every case and stage.
+    """
+    for case, current in results["cases"].items():
+        old = baseline.get("cases", {}).get(case)
+        if old is None:
+            continue
+        print(f"{case}:")
+        for name, stage in current["stages"].items():
+            old_stage = old["stages"].get(name)
+            if not old_stage or not old_stage["median_seconds"]:
+                continue
+            ratio = stage["median_seconds"] / old_stage["median_seconds"]
+            print(f"  {name:12s} {old_stage['median_seconds']:8.3f}s -> {stage['median_seconds']:8.3f}s  x{ratio:.2f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the PDF formatting pipeline on synthetic PDFs.")
+    parser.add_argument("-o", "--output", default="bench_results.json", help="JSON results file")
+    parser.add_argument("--dpi", type=int, default=DEFAULT_DPI)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case (median and min are reported)")
+    parser.add_argument("--cases", nargs="*", help="only run these cases")
+    parser.add_argument("--tall-inches", type=int, default=60, help="height of the tall test pages")
+    parser.add_argument("--compare", help="baseline results JSON to compare against")
+    parser.add_argument("--breaks", choices=BREAK_STRATEGIES, default="greedy", help="page break planner")
+    parser.add_argument("--output-dpi", type=int, default=0, help="output page resolution (default: --dpi)")
+    parser.add_argument("--resample", choices=tuple(RESAMPLE_FILTERS), default="lanczos")
+    parser.add_argument("--compose-workers", type=int, default=1,
+                        help="compose and encode with this many threads; 'compose' then includes encoding")
+    parser.add_argument("--grayscale", choices=("off", "on", "auto"), default="off",
+                        help="render in RGB, in grayscale, or in grayscale unless a page has colour")
+    parser.add_argument("--dedup", action="store_true",
+                        help="encode pages as strips of content and store repeated strips once")
+    parser.add_argument("--check-startup", action="store_true",
+                        help="measure web app startup and first-request latency, with and without the warm-up")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="gunicorn workers for --check-startup (default: 1, as in gunicorn.conf.py)")
+    args = parser.parse_args(argv)
+    if args.check_startup:
+        return run_startup_check(args)
+
+    results = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pillow": PIL.__version__,
+        "dpi": args.dpi,
+        "breaks": args.breaks,
+        "output_dpi": args.output_dpi or args.dpi,
+        "resample": args.resample,
+        "compose_workers": args.compose_workers,
+        "grayscale": args.grayscale,
+        "dedup": args.dedup,
+        "repeat": args.repeat,
+        "cases": {},
+    }
+    tracemalloc.start()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = generate_cases(tmpdir, tall_inches=args.tall_inches)
+        for name, path in paths.items():
+            if args.cases and name not in args.cases:
+                continue
+            runs = [run_case(path, dpi=args.dpi, strategy=args.breaks, output_dpi=args.output_dpi or None,
+                             resample=args.resample, compose_workers=args.compose_workers,
+                             grayscale={"off": False, "on": True, "auto": "auto"}[args.grayscale],
+                             dedup=args.dedup)
+                    for _ in range(args.repeat)]
+            results["cases"][name] = _summarize(runs)
+            summary = results["cases"][name]
+            print(f"{name:10s} {summary['total_median_seconds']:8.3f}s  {summary['segments']:3d} segment(s)  "
+                  f"{summary['page_bytes'] / 1e6:7.1f} MB held  "
+                  f"{summary['output_bytes'] / 1e6:6.2f} MB out  "
+                  f"{summary['inked_cuts']:3d} inked cut(s)  "
+                  + "  ".join(f"{stage}={s['median_seconds']:.3f}s" for stage, s in summary["stages"].items()))
+    tracemalloc.stop()
+    results["maxrss_bytes"] = _maxrss_bytes(resource.RUSAGE_SELF)
+    results["children_maxrss_bytes"] = _maxrss_bytes(resource.RUSAGE_CHILDREN)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return 0
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Run in a fresh interpreter, so nothing this harness imported is already loaded
+FORM_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import flask_app
+imported = time.perf_counter()
+status = flask_app.app.test_client().get('/').status_code
+print(json.dumps({"import_seconds": imported - start, "form_seconds": time.perf_counter() - imported,
+                  "form_status": status, "numpy_loaded": "numpy" in sys.modules}))
+"""
+
+def measure_form():
+    """
+    Import time of the web app and time to serve the upload form, in a new process.
+    """
+    result = subprocess.run([sys.executable, "-c", FORM_PROBE], cwd=APP_DIR, capture_output=True, text=True,
+                            check=True, env=dict(os.environ, PDF_FORMATTER_LOG_LEVEL="WARNING"))
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _upload(url, pdf_bytes):
+    # POST one PDF as the upload form does; returns (status, seconds until the whole response was read)
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"output\"\r\n\r\nraster\r\n"
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"pdf_file\"; filename=\"bench.pdf\"\r\n"
+            f"Content-Type: application/pdf\r\n\r\n").encode() + pdf_bytes + f"\r\n--{boundary}--\r\n".encode()
+    request = urllib.request.Request(url, data=body,
+                                     headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=300) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as exc:
+        status = exc.code
+    return status, time.perf_counter() - start
+
+def measure_server(pdf_bytes, warm_up=True, workers=1, requests=3, start_timeout=60):
+    """
+    Start gunicorn on a free port and time how long it takes to answer, then
+    the first and later uploads of pdf_bytes. The result cache is off, so every
+    upload is formatted.
+    """
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}/"
+    env = dict(os.environ, PDF_FORMATTER_BIND=f"127.0.0.1:{port}", PDF_FORMATTER_WORKERS=str(workers),
+               PDF_FORMATTER_WARM_UP="1" if warm_up else "0", PDF_FORMATTER_CACHE="0",
+               PDF_FORMATTER_LOG_LEVEL="WARNING")
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"],
+                              cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with status {server.returncode}")
+            if time.perf_counter() - start > start_timeout:
+                raise RuntimeError(f"gunicorn did not answer within {start_timeout} s")
+            try:
+                with urllib.request.urlopen(url, timeout=5) as response:
+                    response.read()
+                break
+            except OSError:
+                time.sleep(0.05)
+        ready = time.perf_counter() - start
+        uploads = [_upload(url, pdf_bytes) for _ in range(requests)]
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        "warm_up": warm_up,
+        "workers": workers,
+        "ready_seconds": ready,
+        "first_request_seconds": uploads[0][1],
+        "later_request_seconds": statistics.median(seconds for _, seconds in uploads[1:]) if requests > 1 else None,
+        "statuses": [status for status, _ in uploads],
+    }
+
+def run_startup_check(args):
+    form = measure_form()
+    results = {"workers": args.workers, "form": form, "servers": []}
+    print(f"import {form['import_seconds']:.3f}s  upload form {form['form_seconds'] * 1000:.1f} ms  "
+          f"numpy {'loaded' if form['numpy_loaded'] else 'not loaded'}")
+    ok = form["form_status"] == 200 and not form["numpy_loaded"]
+    if importlib.util.find_spec("gunicorn") is None:
+        print("gunicorn is not installed; skipping the server measurements")
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(generate_cases(tmpdir, tall_inches=args.tall_inches)["short"], "rb") as f:
+                pdf_bytes = f.read()
+        for warm_up in (False, True):
+            server = measure_server(pdf_bytes, warm_up, args.workers, requests=max(args.repeat, 2))
+            results["servers"].append(server)
+            ok = ok and all(status == 200 for status in server["statuses"])
+            print(f"warm-up {'on ' if warm_up else 'off'}  ready {server['ready_seconds']:.3f}s  "
+                  f"first request {server['first_request_seconds']:.3f}s  "
+                  f"later {server['later_request_seconds']:.3f}s  statuses {server['statuses']}")
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
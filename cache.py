@@ -0,0 +1,413 @@
+"""
+Content-addressed cache for formatting results.
+
+Entries are keyed on a hash of the input PDF bytes plus every parameter that
+affects the output, so renaming or re-uploading a file still hits. Two kinds of
+entries are stored on local disk:
+
+- "segments": the per-input result (encoded pages, or a vector plan)
+- "documents": the final merged PDF for an ordered list of inputs
+
+Entries are a JSON header line followed by raw bytes (encoded images, the
+PDF), never pickles, so reading an entry cannot run code. The cache directory
+must belong to the current user and not be writable by anyone else; it is
+created with mode 0700, and the cache turns itself off (with a warning) if an
+existing directory fails the check.
+
+The cache is bounded in size and evicts least-recently-used entries first;
+a running total (CacheSize) keeps inserts from walking the whole directory.
+
+RasterCache keeps cropped page renders as raw .npy arrays that are reopened
+with numpy.memmap, so a re-run with different segmentation parameters skips
+rendering and only reads the rows it actually uses.
+"""
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+import numpy as np
+from pdf_writer import EncodedImage, EncodedPage, Strip, StripPage
+
+logger = logging.getLogger("pdf_formatter")
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_RASTER_MAX_BYTES = 4 * 1024 * 1024 * 1024
+KINDS = ("segments", "documents")
+ENTRY_SUFFIX = ".entry"
+ENTRY_MAGIC = b"PDFFMT-CACHE-1 "
+# Once a cache is over max_bytes, eviction frees it down to this fraction, so a
+# full cache is walked once per tenth of max_bytes written, not on every insert
+EVICT_LOW_WATER = 0.9
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """
+    SHA-256 of a file's contents, read in chunks. path may also be the contents as bytes.
+    """
+    if isinstance(path, bytes):
+        return hashlib.sha256(path).hexdigest()
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cache_key(*parts):
+    """
+    Stable key for any JSON-serializable combination of hashes and parameters.
+    """
+    blob = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+def default_cache_dir(name="pdf-formatter-cache"):
+    """
+    A per-user location under the temp directory: name-<uid> where there are uids.
+    """
+    return os.path.join(tempfile.gettempdir(), f"{name}-{os.getuid()}" if hasattr(os, "getuid") else name)
+
+def private_dir(root):
+    """
+    Create root (mode 0700) if it does not exist. Returns True if it is a real
+    directory owned by the current user that no one else can write to.
+    """
+    try:
+        os.makedirs(root, mode=0o700, exist_ok=True)
+        st = os.lstat(root)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(st.st_mode):
+        return False
+    if hasattr(os, "getuid") and (st.st_uid != os.getuid() or st.st_mode & 0o022):
+        return False
+    return True
+
+def _json_default(value):
+    # numpy scalars from the planners
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot store {type(value).__name__} in the cache")
+
+def _pack(value, blobs, images, index):
+    # JSON-safe description of value; bytes go to blobs, images (shared by id) to images
+    if isinstance(value, dict):
+        return {"type": "plan", "plan": value}
+    if isinstance(value, tuple):
+        page_count, pdf_bytes = value
+        blobs.append(pdf_bytes)
+        return {"type": "document", "pages": page_count, "blob": len(blobs) - 1}
+    if value and not isinstance(value[0], (EncodedPage, StripPage)):
+        return {"type": "list", "items": [_pack(item, blobs, images, index) for item in value]}
+    pages = []
+    for page in value:
+        if isinstance(page, StripPage):
+            strips = []
+            for box, digest, data in page.strips:
+                blobs.append(data)
+                strips.append([list(box), digest, len(blobs) - 1])
+            pages.append({"size": [page.width, page.height], "dpi": page.dpi, "kind": page.kind,
+                          "encoding": page.encoding, "strips": strips})
+            continue
+        placements = []
+        for x, y, w, h, image in page.placements:
+            if id(image) not in index:
+                index[id(image)] = len(images)
+                blobs.append(image.data)
+                images.append([len(blobs) - 1] + list(image[1:]))
+            placements.append([x, y, w, h, index[id(image)]])
+        pages.append([page.width, page.height, placements])
+    return {"type": "pages", "pages": pages}
+
+def _unpack(header, blobs, images):
+    kind = header["type"]
+    if kind == "plan":
+        return header["plan"]
+    if kind == "document":
+        return header["pages"], blobs[header["blob"]]
+    if kind == "list":
+        return [_unpack(item, blobs, images) for item in header["items"]]
+    if kind != "pages":
+        raise ValueError(f"Unknown cache entry type: {kind}")
+    pages = []
+    for page in header["pages"]:
+        if isinstance(page, dict):
+            strips = [Strip(tuple(box), digest, blobs[blob]) for box, digest, blob in page["strips"]]
+            pages.append(StripPage(*page["size"], page["dpi"], page["kind"], page["encoding"], strips))
+            continue
+        width, height, placements = page
+        pages.append(EncodedPage(width, height, [(x, y, w, h, images[image]) for x, y, w, h, image in placements]))
+    return pages
+
+def pack_entry(value):
+    """
+    Serialize a cached value to bytes: a (page count, PDF bytes) document, a
+    list of EncodedPages (or StripPages), a vector plan dict, or a list of page
+    results (lists of pages or plans). An image shared by several pages is stored once.
+    """
+    blobs, images = [], []
+    header = {"value": _pack(value, blobs, images, {}), "images": images}
+    header["sizes"] = [len(blob) for blob in blobs]
+    return b"".join([ENTRY_MAGIC, json.dumps(header, default=_json_default).encode("utf-8"), b"\n"] + blobs)
+
+def unpack_entry(data):
+    """
+    Inverse of pack_entry(). Raises ValueError (or KeyError, IndexError,
+    TypeError) for anything that is not a valid entry.
+    """
+    if not data.startswith(ENTRY_MAGIC):
+        raise ValueError("Not a cache entry")
+    end = data.index(b"\n")
+    header = json.loads(data[len(ENTRY_MAGIC):end])
+    blobs, offset = [], end + 1
+    for size in header["sizes"]:
+        blobs.append(data[offset:offset + size])
+        offset += size
+    if offset != len(data):
+        raise ValueError("Truncated cache entry")
+    images = [EncodedImage(blobs[blob], *fields) for blob, *fields in header["images"]]
+    return _unpack(header["value"], blobs, images)
+
+def evict_lru(root, max_bytes, suffix, target=None):
+    """
+    If the files ending in suffix under root take more than max_bytes, delete
+    the least recently used ones until they take at most target (default
+    max_bytes). Returns their total size afterwards.
+    """
+    entries = []
+    total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if not name.endswith(suffix):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    if total <= max_bytes:
+        return total
+    target = max_bytes if target is None else target
+    entries.sort()
+    for _, size, path in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+    return total
+
+class CacheSize:
+    """
+    Running total size of the files ending in suffix under root: one walk, then
+    the size of every file written since. The tree is walked again only when
+    the total passes max_bytes, and evicted down to EVICT_LOW_WATER of it.
+    Entries written by other processes sharing root are counted at that walk.
+    """
+    def __init__(self, root, max_bytes, suffix):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self._total = None
+        self._lock = threading.Lock()
+
+    def added(self, path):
+        """
+        Count the file just written at path, evicting if the cache is now too large.
+        """
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        with self._lock:
+            if self._total is not None and self._total + size <= self.max_bytes:
+                self._total += size
+                return
+            self._total = evict_lru(self.root, self.max_bytes, self.suffix,
+                                    int(self.max_bytes * EVICT_LOW_WATER))
+
+    def evict(self):
+        with self._lock:
+            self._total = evict_lru(self.root, self.max_bytes, self.suffix)
+
+def replace_atomically(path, write):
+    """
+    Replace path with a temporary file in its directory filled by write(tmp_path),
+    so readers see either the old file or the complete new one.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _checked_root(root, enabled):
+    # enabled, turned off with a warning when root is not private to this user
+    if enabled and not private_dir(root):
+        logger.warning("Cache directory %s is not a directory private to this user; caching is off", root)
+        return False
+    return enabled
+
+class ResultCache:
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES, enabled=True):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.enabled = _checked_root(root, enabled)
+        self._size = CacheSize(root, max_bytes, ENTRY_SUFFIX)
+        self._lock = threading.Lock()
+        self._stats = {kind: {"hits": 0, "misses": 0} for kind in KINDS}
+
+    def options(self):
+        """
+        Constructor arguments, so worker processes can open the same cache.
+        """
+        return {"root": self.root, "max_bytes": self.max_bytes, "enabled": self.enabled}
+
+    def _path(self, kind, key):
+        return os.path.join(self.root, kind, key[:2], key + ENTRY_SUFFIX)
+
+    def get(self, kind, key):
+        """
+        Return the cached value or None, and count the hit or miss.
+        """
+        if not self.enabled:
+            return None
+        path = self._path(kind, key)
+        try:
+            with open(path, "rb") as f:
+                value = unpack_entry(f.read())
+            # Mark as recently used for LRU eviction
+            os.utime(path)
+        except (OSError, ValueError, KeyError, IndexError, TypeError):
+            value = None
+        with self._lock:
+            self._stats[kind]["hits" if value is not None else "misses"] += 1
+        return value
+
+    def put(self, kind, key, value):
+        if not self.enabled:
+            return
+        data = pack_entry(value)
+
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+
+        # Readers never see a partial entry
+        path = self._path(kind, key)
+        replace_atomically(path, write)
+        self._size.added(path)
+
+    def evict(self):
+        """
+        Delete least-recently-used entries until the cache fits in max_bytes.
+        """
+        self._size.evict()
+
+    def stats(self):
+        with self._lock:
+            return {kind: dict(counts) for kind, counts in self._stats.items()}
+
+    def merge_stats(self, stats):
+        """
+        Add counters collected by another process or another ResultCache instance.
+        """
+        if not stats:
+            return
+        with self._lock:
+            for kind, counts in stats.items():
+                for name, value in counts.items():
+                    self._stats[kind][name] += value
+
+class RasterCache:
+    """
+    Cropped page renders stored as .npy files and reopened as read-only memmaps.
+    Keyed by file hash, page, DPI and render options. Each entry can also hold
+    the row-ink profile for a threshold, so segmentation need not scan the page.
+    """
+    def __init__(self, root, max_bytes=DEFAULT_RASTER_MAX_BYTES, enabled=True):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.enabled = _checked_root(root, enabled)
+        self._size = CacheSize(root, max_bytes, ".npy")
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def options(self):
+        return {"root": self.root, "max_bytes": self.max_bytes, "enabled": self.enabled}
+
+    def key(self, digest, page, dpi, grayscale=False, backend="pdftoppm"):
+        return cache_key("raster", digest, page, dpi, grayscale, backend)
+
+    def _path(self, key, name):
+        return os.path.join(self.root, key[:2], key, name + ".npy")
+
+    def _open(self, path):
+        try:
+            arr = np.load(path, mmap_mode="r")
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return arr
+
+    def load(self, key):
+        """
+        Return the cached render as a read-only memmap, or None.
+        """
+        if not self.enabled:
+            return None
+        arr = self._open(self._path(key, "page"))
+        with self._lock:
+            self._stats["hits" if arr is not None else "misses"] += 1
+        return arr
+
+    def store(self, key, img):
+        """
+        Save a PIL image or array and return it reopened as a memmap.
+        """
+        arr = np.asarray(img)
+        if not self.enabled:
+            return arr
+        path = self._path(key, "page")
+
+        def write(tmp_path):
+            out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=arr.dtype, shape=arr.shape)
+            out[:] = arr
+            out.flush()
+            del out
+
+        replace_atomically(path, write)
+        self._size.added(path)
+        cached = self._open(path)
+        # An entry larger than the whole cache is evicted straight away
+        return arr if cached is None else cached
+
+    def load_profile(self, key, threshold):
+        if not self.enabled:
+            return None
+        profile = self._open(self._path(key, f"profile-{threshold}"))
+        return None if profile is None else np.asarray(profile)
+
+    def store_profile(self, key, threshold, counts):
+        if not self.enabled:
+            return
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                np.save(f, counts)
+
+        path = self._path(key, f"profile-{threshold}")
+        replace_atomically(path, write)
+        self._size.added(path)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
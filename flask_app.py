@@ -1,10 +1,166 @@
-from flask import Flask, request, render_template_string, send_file
+from flask import (Flask, Request, Response, current_app, jsonify, request, render_template_string, send_file,
+                   stream_with_context, url_for)
+from werkzeug.utils import secure_filename
+import atexit
+import importlib
+import itertools
+import logging
 import tempfile
+import threading
+import time
+import shutil
+import socket
 import os
 import io
-from merge import crop_pdf_first_page, segment_image_by_aspect_ratio, create_pdf_from_images
+# The pipeline (numpy, PIL, pdf2image, pypdf) is imported by init_services(), on the
+# first request that formats something or in warm_up(), so serving the form stays cheap
+from metrics import METRICS, stage
+
+class SpooledRequest(Request):
+    # Uploaded files stay in memory up to UPLOAD_SPOOL_BYTES; only larger ones spill to an anonymous temp file
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=current_app.config['UPLOAD_SPOOL_BYTES'])
 
 app = Flask(__name__)
+app.request_class = SpooledRequest
+app.config.update(
+    JOB_WORKERS=int(os.environ.get('PDF_FORMATTER_JOB_WORKERS', 2)),
+    JOB_EXECUTOR=os.environ.get('PDF_FORMATTER_JOB_EXECUTOR', 'process'),
+    JOB_QUEUE_SIZE=int(os.environ.get('PDF_FORMATTER_JOB_QUEUE_SIZE', 16)),
+    JOB_RESULT_TTL=int(os.environ.get('PDF_FORMATTER_JOB_RESULT_TTL', 600)),
+    CACHE_ENABLED=os.environ.get('PDF_FORMATTER_CACHE', '1') != '0',
+    # Must be private to the server's user (see cache.private_dir); the default is per user
+    CACHE_DIR=os.environ.get('PDF_FORMATTER_CACHE_DIR'),
+    CACHE_SIZE_MB=int(os.environ.get('PDF_FORMATTER_CACHE_SIZE_MB', 512)),
+    RASTER_CACHE_DIR=os.environ.get('PDF_FORMATTER_RASTER_CACHE_DIR'),
+    RASTER_CACHE_SIZE_MB=int(os.environ.get('PDF_FORMATTER_RASTER_CACHE_SIZE_MB', 4096)),
+    LOG_LEVEL=os.environ.get('PDF_FORMATTER_LOG_LEVEL', 'INFO'),
+    # Page encoding preset; unset for pdf_writer.DEFAULT_ENCODING
+    ENCODING=os.environ.get('PDF_FORMATTER_ENCODING'),
+    # Pages taller than this many pixels are rendered in strips; 0 turns banding off
+    BAND_ROWS=int(os.environ.get('PDF_FORMATTER_BAND_ROWS', 0)),
+    # Find the layout on a preview at this DPI and render only the segments at full DPI; 0 turns it off
+    PREVIEW_DPI=int(os.environ.get('PDF_FORMATTER_PREVIEW_DPI', 0)),
+    # Take the crop box and cut rows from the text layer of text-only pages ('text') or always render ('raster')
+    LAYOUT=os.environ.get('PDF_FORMATTER_LAYOUT', 'raster'),
+    # Render pages in grayscale ('1'), in RGB ('0'), or in grayscale unless they have colour ('auto')
+    GRAYSCALE={'0': False, '1': True}.get(os.environ.get('PDF_FORMATTER_GRAYSCALE', 'auto'), 'auto'),
+    # Encode pages as strips of content and store strips repeated across pages and uploads once
+    DEDUP=os.environ.get('PDF_FORMATTER_DEDUP', '0') != '0',
+    # Page break planner, 'greedy' or 'optimal'
+    BREAK_STRATEGY=os.environ.get('PDF_FORMATTER_BREAKS', 'greedy'),
+    # Resolution of the output pages (0: the render DPI), lowered to stay within MAX_PAGE_PIXELS if set
+    OUTPUT_DPI=int(os.environ.get('PDF_FORMATTER_OUTPUT_DPI', 0)),
+    MAX_PAGE_PIXELS=int(os.environ.get('PDF_FORMATTER_MAX_PAGE_PIXELS', 0)),
+    # Filter for scaling segments onto pages: 'lanczos', 'bicubic' or 'bilinear'
+    RESAMPLE=os.environ.get('PDF_FORMATTER_RESAMPLE', 'lanczos'),
+    # Pages of one document rendered and segmented at once (threads per request or job)
+    PAGE_WORKERS=int(os.environ.get('PDF_FORMATTER_PAGE_WORKERS', 2)),
+    # Threads that compose and encode output pages for each page worker
+    COMPOSE_WORKERS=int(os.environ.get('PDF_FORMATTER_COMPOSE_WORKERS', 2)),
+    # Uploads up to this size are rendered straight from memory; larger ones are saved to disk first
+    UPLOAD_SPOOL_BYTES=int(os.environ.get('PDF_FORMATTER_UPLOAD_SPOOL_MB', 16)) * 1024 * 1024,
+    # Larger request bodies are rejected with 413 before they are read; 0 turns the limit off
+    MAX_CONTENT_LENGTH=int(os.environ.get('PDF_FORMATTER_MAX_UPLOAD_MB', 256)) * 1024 * 1024 or None,
+    # Requests estimated to need more memory than this are rejected with 413
+    REQUEST_MEMORY_BYTES=int(os.environ.get('PDF_FORMATTER_REQUEST_MEMORY_MB', 2048)) * 1024 * 1024,
+    # Memory shared by all requests formatting at once, and how many may run together
+    MEMORY_BUDGET_BYTES=int(os.environ.get('PDF_FORMATTER_MEMORY_BUDGET_MB', 4096)) * 1024 * 1024,
+    MAX_CONCURRENT_REQUESTS=int(os.environ.get('PDF_FORMATTER_MAX_CONCURRENT', 4)),
+    # Seconds a request waits for memory or a slot before it is turned away with 503
+    ADMISSION_TIMEOUT=float(os.environ.get('PDF_FORMATTER_ADMISSION_TIMEOUT', 30)),
+)
+# DEBUG adds one JSON record per pipeline stage
+logging.basicConfig(level=app.config['LOG_LEVEL'], format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+logger = logging.getLogger('pdf_formatter')
+
+# Shared by every request of this process; created by init_services()
+result_cache = None
+raster_cache = None
+job_queue = None
+memory_budget = None
+_services_lock = threading.Lock()
+
+def init_services():
+    # Import the pipeline and create the caches, job queue and memory budget, once
+    global result_cache, raster_cache, job_queue, memory_budget
+    with _services_lock:
+        if memory_budget is not None:
+            return
+        from admission import MemoryBudget
+        from cache import ResultCache, RasterCache, default_cache_dir
+        from jobs import JobQueue
+        result_cache = ResultCache(
+            app.config['CACHE_DIR'] or default_cache_dir(),
+            max_bytes=app.config['CACHE_SIZE_MB'] * 1024 * 1024,
+            enabled=app.config['CACHE_ENABLED'],
+        )
+        # Memory-mapped page renders, only kept when a directory is configured
+        if app.config['RASTER_CACHE_DIR']:
+            raster_cache = RasterCache(
+                app.config['RASTER_CACHE_DIR'],
+                max_bytes=app.config['RASTER_CACHE_SIZE_MB'] * 1024 * 1024,
+            )
+        # Shared by requests and jobs; assigned last, since it marks the services as ready
+        budget = MemoryBudget(app.config['MEMORY_BUDGET_BYTES'], app.config['MAX_CONCURRENT_REQUESTS'])
+        job_queue = JobQueue(
+            workers=app.config['JOB_WORKERS'],
+            max_pending=app.config['JOB_QUEUE_SIZE'],
+            result_ttl=app.config['JOB_RESULT_TTL'],
+            executor=app.config['JOB_EXECUTOR'],
+            cache=result_cache,
+            raster_cache=raster_cache,
+            band_rows=app.config['BAND_ROWS'] or None,
+            page_workers=app.config['PAGE_WORKERS'],
+            compose_workers=app.config['COMPOSE_WORKERS'],
+            memory_budget=budget,
+        )
+        atexit.register(job_queue.shutdown)
+        memory_budget = budget
+
+def create_app(**config):
+    """
+    The WSGI application, with config overriding the PDF_FORMATTER_* settings.
+    Serving the upload form imports nothing but Flask; the pipeline is loaded
+    by the first request that needs it, or ahead of time by warm_up().
+    """
+    app.config.update(config)
+    return app
+
+def warm_up():
+    """
+    Import the pipeline and format a two-page PDF (a bilevel and a gray page)
+    once, so numpy, the PIL codecs and the poppler binaries are loaded before a
+    preforking server forks its workers and the first request does not pay for
+    them. The caches, job queue and memory budget are left to init_services()
+    in each worker, so workers never share a job directory or a budget.
+    Returns the seconds taken. A failed render is logged, not raised.
+    """
+    start = time.perf_counter()
+    for module in ('admission', 'cache', 'jobs'):
+        importlib.import_module(module)
+    from PIL import Image
+    from pdf_writer import encode_page, write_pdf
+    from pipeline import Pipeline
+    pages = []
+    for fill in (0, 128):
+        page = Image.new('L', (72, 72), 'white')
+        page.paste(fill, (8, 8, 64, 40))
+        pages.append(encode_page(page, 72))
+    pdf = io.BytesIO()
+    write_pdf(pages, pdf)
+    options = document_options()
+    try:
+        Pipeline(dpi=72, encoding=options['encoding'], grayscale=options['grayscale'],
+                 resample=options['resample']).run(pdf.getvalue())
+    except Exception as exc:
+        logger.warning('Warm-up render failed: %s: %s', type(exc).__name__, exc)
+    # Requests, not the warm-up, are what the metrics should count
+    METRICS.drain()
+    seconds = time.perf_counter() - start
+    logger.info('Warmed up in %.2f s', seconds)
+    return seconds
 
 UPLOAD_FORM = '''
 <!doctype html>
@@ -113,6 +269,11 @@ UPLOAD_FORM = '''
         #real-file-input {
             display: none;
         }
+        .option {
+            display: block;
+            margin-bottom: 1.2rem;
+            font-size: 0.95rem;
+        }
     </style>
     <style id="dark-mode-style">
     /* Dark mode */
@@ -232,9 +393,10 @@ UPLOAD_FORM = '''
                 <input id="real-file-input" type="file" name="pdf_file" accept="application/pdf" multiple>
             </div>
             <ul class="file-list" id="file-list"></ul>
+            <label class="option"><input type="checkbox" id="vector-output"> Keep text sharp (vector output)</label>
             <input type="submit" value="Upload & Format">
         </form>
-        <div class="footer">Your PDF stays private and is never stored.</div>
+        <div class="footer">Your PDF stays private and never leaves this server.</div>
     </div>
         <style>
         .slider-icon {
@@ -432,63 +594,343 @@ UPLOAD_FORM = '''
             }
             const formData = new FormData();
             files.forEach(f => formData.append('pdf_file', f));
-            // Submit via fetch to preserve order
+            formData.append('output', document.getElementById('vector-output').checked ? 'vector' : 'raster');
+            // Submit via fetch to preserve order, then poll the job until it is done
             e.preventDefault();
-            fetch('/', {
+            const submitBtn = document.querySelector('#pdf-form input[type="submit"]');
+            submitBtn.disabled = true;
+            submitBtn.value = 'Processing...';
+            fetch('/jobs', {
                 method: 'POST',
                 body: formData
             }).then(async resp => {
-                if (resp.ok) {
-                    const blob = await resp.blob();
-                    const url = window.URL.createObjectURL(blob);
-                    const a = document.createElement('a');
-                    a.href = url;
-                    a.download = 'formatted.pdf';
-                    document.body.appendChild(a);
-                    a.click();
-                    a.remove();
-                    window.URL.revokeObjectURL(url);
-                } else {
-                    alert('Error processing PDF(s).');
+                if (!resp.ok) {
+                    throw new Error(resp.status === 503 ? 'The server is busy, please try again shortly.' :
+                                    resp.status === 413 ? 'These files are too large to format.' : 'Error processing PDF(s).');
                 }
+                const job = await resp.json();
+                return pollJob(job.status_url);
+            }).then(async resultUrl => {
+                const resp = await fetch(resultUrl);
+                if (!resp.ok) {
+                    throw new Error('Error processing PDF(s).');
+                }
+                const blob = await resp.blob();
+                const url = window.URL.createObjectURL(blob);
+                const a = document.createElement('a');
+                a.href = url;
+                a.download = 'formatted.pdf';
+                document.body.appendChild(a);
+                a.click();
+                a.remove();
+                window.URL.revokeObjectURL(url);
+            }).catch(err => {
+                alert(err.message);
+            }).finally(() => {
+                submitBtn.disabled = false;
+                submitBtn.value = 'Upload & Format';
             });
         });
+
+        async function pollJob(statusUrl) {
+            while (true) {
+                const resp = await fetch(statusUrl);
+                if (!resp.ok) {
+                    throw new Error('Error processing PDF(s).');
+                }
+                const info = await resp.json();
+                if (info.status === 'done') {
+                    return info.result_url;
+                }
+                if (info.status === 'failed') {
+                    throw new Error('Error processing PDF(s).');
+                }
+                await new Promise(resolve => setTimeout(resolve, 1000));
+            }
+        }
     </script>
 </body>
 </html>
 '''
 
+def read_upload_request():
+    # Returns (files, output_mode, None) or (None, None, error response)
+    if 'pdf_file' not in request.files:
+        return None, None, ('No file part', 400)
+    files = request.files.getlist('pdf_file')
+    if not files or all(f.filename == '' for f in files):
+        return None, None, ('No selected file', 400)
+    output_mode = request.form.get('output', 'raster')
+    if output_mode not in ('raster', 'vector'):
+        return None, None, ('Unknown output mode', 400)
+    return files, output_mode, None
+
+def upload_path(dest_dir, index, file):
+    # Prefix with the upload position so equal names cannot overwrite each other
+    name = secure_filename(file.filename) or 'upload.pdf'
+    return os.path.join(dest_dir, f'{index:03d}-{name}')
+
+def save_uploads(files, dest_dir):
+    input_paths = []
+    for index, file in enumerate(files):
+        if file and file.filename:
+            input_path = upload_path(dest_dir, index, file)
+            file.save(input_path)
+            input_paths.append(input_path)
+    return input_paths
+
+def read_uploads(files):
+    # Returns (sources, tmpdir). Uploads up to UPLOAD_SPOOL_BYTES become bytes that are piped
+    # to the renderer; larger ones are saved under tmpdir, which is None when nothing spilled
+    sources, tmpdir = [], None
+    for index, file in enumerate(files):
+        if not (file and file.filename):
+            continue
+        size = file.stream.seek(0, os.SEEK_END)
+        file.stream.seek(0)
+        if size <= app.config['UPLOAD_SPOOL_BYTES']:
+            sources.append(file.stream.read())
+        else:
+            tmpdir = tmpdir or tempfile.mkdtemp()
+            input_path = upload_path(tmpdir, index, file)
+            file.save(input_path)
+            sources.append(input_path)
+        # Drop the spooled copy now; the response may stream long after this
+        file.close()
+    return sources, tmpdir
+
+def remove_tmpdir(tmpdir):
+    if tmpdir is not None:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def document_options(output_mode='raster'):
+    # Everything configured that changes the output, so every path agrees on cache keys
+    from merge import DEFAULT_DPI, output_resolution
+    from pdf_writer import DEFAULT_ENCODING
+    output_dpi = output_resolution(DEFAULT_DPI, app.config['OUTPUT_DPI'], app.config['MAX_PAGE_PIXELS'])
+    return dict(output_mode=output_mode, dpi=DEFAULT_DPI, encoding=app.config['ENCODING'] or DEFAULT_ENCODING,
+                preview_dpi=app.config['PREVIEW_DPI'] or None, break_strategy=app.config['BREAK_STRATEGY'],
+                output_dpi=output_dpi, resample=app.config['RESAMPLE'], layout=app.config['LAYOUT'],
+                grayscale=app.config['GRAYSCALE'], dedup=app.config['DEDUP'])
+
+def estimate_memory(sources, output_mode='raster'):
+    # Rough peak memory of formatting sources, from their page sizes alone.
+    # Raises admission.UnreadablePdf when a source has no readable page tree
+    from admission import estimate_request_bytes
+    options = document_options(output_mode)
+    grayscale = output_mode == 'vector' or options['grayscale'] is True
+    # Vector output composes nothing in the page workers
+    compose_workers = app.config['COMPOSE_WORKERS'] if output_mode == 'raster' else 1
+    return estimate_request_bytes(sources, options['dpi'], grayscale=grayscale,
+                                  band_rows=app.config['BAND_ROWS'] or None,
+                                  page_workers=app.config['PAGE_WORKERS'], output_dpi=options['output_dpi'],
+                                  compose_workers=compose_workers)
+
+def too_large(estimate):
+    limit = min(app.config['REQUEST_MEMORY_BYTES'], app.config['MEMORY_BUDGET_BYTES'])
+    if estimate <= limit:
+        return None
+    mb = 1024 * 1024
+    return f'These files need about {estimate // mb} MB to format, more than the {limit // mb} MB limit', 413
+
+def admit(sources, output_mode='raster'):
+    # Returns (reserved bytes, None) once the request fits in the memory budget,
+    # or (None, error response) when it never will or the server stays busy
+    from admission import UnreadablePdf
+    with stage('admission', inputs=len(sources)) as info:
+        try:
+            estimate = info['bytes'] = estimate_memory(sources, output_mode)
+        except UnreadablePdf as exc:
+            return None, (str(exc), 400)
+        error = too_large(estimate)
+        if error:
+            return None, error
+        if not memory_budget.acquire(estimate, app.config['ADMISSION_TIMEOUT']):
+            return None, ('The server is busy, try again shortly', 503, {'Retry-After': '10'})
+    return estimate, None
+
+def formatted_pages(input_paths):
+    # Encoded pages of every input in order, produced lazily; cached inputs skip rendering
+    from merge import process_input
+    options = document_options()
+    return itertools.chain.from_iterable(
+        process_input(input_path, cache=result_cache, raster_cache=raster_cache,
+                      band_rows=app.config['BAND_ROWS'] or None, page_workers=app.config['PAGE_WORKERS'],
+                      compose_workers=app.config['COMPOSE_WORKERS'], **options)
+        for input_path in input_paths
+    )
+
+def abort_stream():
+    # Once the response has started its status cannot change, so a failure must
+    # drop the connection before the final chunk: the client then sees a
+    # truncated transfer rather than a complete PDF. gunicorn closes the
+    # connection when the body raises; werkzeug's server would append an error
+    # page and finish the chunked body, so its socket is shut down first
+    sock = request.environ.get('werkzeug.socket')
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def stream_formatted_pdf(first_page, pages, input_count):
+    # Pages are composed, encoded and sent one at a time
+    from pdf_writer import stream_pdf
+    try:
+        with stage('stream_response', inputs=input_count) as info:
+            info['bytes'] = 0
+            for chunk in stream_pdf(itertools.chain([first_page], pages)):
+                info['bytes'] += len(chunk)
+                yield chunk
+    except Exception:
+        logger.exception('Formatting failed after %d bytes were sent; aborting the response', info['bytes'])
+        abort_stream()
+        raise
+
+def send_pdf_bytes(output):
+    output.seek(0)
+    return send_file(
+        output,
+        as_attachment=True,
+        download_name='formatted.pdf',
+        mimetype='application/pdf'
+    )
+
+def send_vector_pdf(input_paths, tmpdir, reserved):
+    from merge import format_pdfs
+    try:
+        output = io.BytesIO()
+        if not format_pdfs(input_paths, output, cache=result_cache, raster_cache=raster_cache,
+                           band_rows=app.config['BAND_ROWS'] or None, page_workers=app.config['PAGE_WORKERS'],
+                           **document_options('vector')):
+            return 'No valid PDF files processed', 400
+        return send_pdf_bytes(output)
+    finally:
+        memory_budget.release(reserved)
+        remove_tmpdir(tmpdir)
+
 @app.route('/', methods=['GET', 'POST'])
 def upload_file():
     if request.method == 'POST':
-        if 'pdf_file' not in request.files:
-            return 'No file part', 400
-        files = request.files.getlist('pdf_file')
-        if not files or all(f.filename == '' for f in files):
-            return 'No selected file', 400
-        with tempfile.TemporaryDirectory() as tmpdir:
-            all_segments = []
-            for file in files:
-                if file and file.filename:
-                    input_path = os.path.join(tmpdir, file.filename)
-                    file.save(input_path)
-                    cropped_img = crop_pdf_first_page(input_path)
-                    segments = segment_image_by_aspect_ratio(cropped_img, 8.5, 11)
-                    all_segments.extend(segments)
-            if not all_segments:
-                return 'No valid PDF files processed', 400
-            output_path = os.path.join(tmpdir, 'output.pdf')
-            create_pdf_from_images(all_segments, output_path)
-            # Read the PDF into memory and send as BytesIO
-            with open(output_path, 'rb') as f:
-                pdf_bytes = f.read()
-            return send_file(
-                io.BytesIO(pdf_bytes),
-                as_attachment=True,
-                download_name='formatted.pdf',
-                mimetype='application/pdf'
-            )
+        files, output_mode, error = read_upload_request()
+        if error:
+            return error
+        init_services()
+        from merge import load_cached_document
+        with stage('upload', files=len(files)):
+            input_paths, tmpdir = read_uploads(files)
+        if not input_paths:
+            remove_tmpdir(tmpdir)
+            return 'No valid PDF files processed', 400
+        if output_mode == 'raster':
+            output = io.BytesIO()
+            if load_cached_document(input_paths, output, result_cache, **document_options()) is not None:
+                remove_tmpdir(tmpdir)
+                return send_pdf_bytes(output)
+        reserved, error = admit(input_paths, output_mode)
+        if error:
+            remove_tmpdir(tmpdir)
+            return error
+        if output_mode == 'vector':
+            return send_vector_pdf(input_paths, tmpdir, reserved)
+        # The first page is made before the response starts, so a failure or an
+        # empty result still gets an error status instead of a broken 200
+        pages = formatted_pages(input_paths)
+        try:
+            first_page = next(pages, None)
+        except BaseException:
+            memory_budget.release(reserved)
+            remove_tmpdir(tmpdir)
+            raise
+        if first_page is None:
+            memory_budget.release(reserved)
+            remove_tmpdir(tmpdir)
+            return 'No valid PDF files processed', 400
+        response = Response(
+            stream_with_context(stream_formatted_pdf(first_page, pages, len(input_paths))),
+            mimetype='application/pdf',
+            headers={'Content-Disposition': 'attachment; filename=formatted.pdf'},
+        )
+
+        # Held until the last page is sent, or the client goes away; also runs
+        # when the response is closed before the body was ever iterated
+        def close_response():
+            memory_budget.release(reserved)
+            remove_tmpdir(tmpdir)
+
+        response.call_on_close(close_response)
+        return response
     return render_template_string(UPLOAD_FORM)
 
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    files, output_mode, error = read_upload_request()
+    if error:
+        return error
+    init_services()
+    from admission import UnreadablePdf
+    from jobs import QueueFull
+    try:
+        job_id, job_dir = job_queue.create()
+    except QueueFull:
+        return jsonify(error='Too many jobs in progress, try again shortly'), 503
+    # A job that never starts must give its slot back, whatever goes wrong
+    try:
+        with stage('upload', files=len(files)):
+            input_paths = save_uploads(files, job_dir)
+        if not input_paths:
+            job_queue.discard(job_id)
+            return 'No valid PDF files processed', 400
+        # Refuse jobs that could never fit; the rest wait in the queue for their share of the memory budget
+        try:
+            estimate = estimate_memory(input_paths, output_mode)
+        except UnreadablePdf as exc:
+            job_queue.discard(job_id)
+            return jsonify(error=str(exc)), 400
+        error = too_large(estimate)
+        if error:
+            job_queue.discard(job_id)
+            return jsonify(error=error[0]), 413
+        job_queue.start(job_id, input_paths, reserve_bytes=estimate, **document_options(output_mode))
+    except BaseException:
+        job_queue.discard(job_id)
+        raise
+    return jsonify(
+        id=job_id,
+        status_url=url_for('job_status', job_id=job_id),
+        result_url=url_for('job_result', job_id=job_id),
+    ), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    init_services()
+    info = job_queue.status(job_id)
+    if info is None:
+        return jsonify(error='Unknown or expired job'), 404
+    if info['status'] == 'done':
+        info['result_url'] = url_for('job_result', job_id=job_id)
+    return jsonify(info)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    init_services()
+    info = job_queue.status(job_id)
+    if info is None:
+        return jsonify(error='Unknown or expired job'), 404
+    if info['status'] == 'failed':
+        return jsonify(info), 500
+    if info['status'] != 'done':
+        return jsonify(info), 202
+    return send_file(
+        job_queue.result_path(job_id),
+        as_attachment=True,
+        download_name='formatted.pdf',
+        mimetype='application/pdf'
+    )
+
+@app.route('/metrics')
+def metrics():
+    return Response(METRICS.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,24 @@
+"""
+Gunicorn settings for the web app: a preforking server whose master imports
+and warms up the app once (see wsgi.py) and then forks the workers.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+PDF_FORMATTER_BIND, PDF_FORMATTER_WORKERS, PDF_FORMATTER_THREADS and
+PDF_FORMATTER_TIMEOUT override the defaults below.
+"""
+import os
+
+bind = os.environ.get('PDF_FORMATTER_BIND', '127.0.0.1:8000')
+# One worker by default: each has its own memory budget, caches in memory and
+# job queue, and a job is only known to the worker that created it. Rendering
+# and encoding run in poppler, numpy and Pillow, which release the GIL, so the
+# threads below (and the page and compose workers) use the CPUs
+workers = int(os.environ.get('PDF_FORMATTER_WORKERS', 1))
+# Threads let a worker keep streaming one response while it accepts the next request
+worker_class = 'gthread'
+threads = int(os.environ.get('PDF_FORMATTER_THREADS', 4))
+# Import and warm up in the master, so workers are forked ready to serve
+preload_app = True
+# Large documents stream for a long time; a worker is only killed after this many silent seconds
+timeout = int(os.environ.get('PDF_FORMATTER_TIMEOUT', 300))
@@ -0,0 +1,220 @@
+"""
+Incremental batch builds.
+
+A state directory keeps a manifest of every input (size, mtime, SHA-256) and
+the results each one produced: its encoded pages, or its vector plans. On the
+next run an input whose size and mtime are unchanged is trusted without being
+read, one whose contents hash the same is reused, and only new or changed inputs
+are rendered. The output is then reassembled from the stored results, and not
+rewritten at all when neither the inputs nor the output changed.
+
+watch() polls the inputs and calls a build function whenever they change.
+"""
+import itertools
+import json
+import os
+import sys
+import time
+from cache import replace_atomically, cache_key, file_hash, pack_entry, unpack_entry
+from merge import cache_params, find_pdfs, page_results, page_worker, write_results
+
+MANIFEST_VERSION = 1
+
+class IncrementalStore:
+    def __init__(self, root):
+        self.root = root
+        self.manifest_path = os.path.join(root, "manifest.json")
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        if manifest.get("version") != MANIFEST_VERSION:
+            manifest = {"version": MANIFEST_VERSION, "inputs": {}, "output": None}
+        self.manifest = manifest
+
+    def _segments_path(self, digest, params_key):
+        return os.path.join(self.root, "segments", f"{digest}-{params_key[:16]}.entry")
+
+    def digest(self, pdf_path):
+        """
+        SHA-256 of pdf_path, taken from the manifest while its size and mtime are unchanged.
+        """
+        st = os.stat(pdf_path)
+        entry = self.manifest["inputs"].get(os.path.abspath(pdf_path))
+        if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            return entry["sha256"]
+        digest = file_hash(pdf_path)
+        self.manifest["inputs"][os.path.abspath(pdf_path)] = {
+            "size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest,
+        }
+        return digest
+
+    def has_segments(self, digest, params_key):
+        return os.path.exists(self._segments_path(digest, params_key))
+
+    def load_segments(self, pdf_path, digest, params_key):
+        """
+        The stored per-page results of an input. Vector plans are pointed at pdf_path.
+        """
+        with open(self._segments_path(digest, params_key), "rb") as f:
+            results = unpack_entry(f.read())
+        return [dict(result, pdf_path=pdf_path) if isinstance(result, dict) else result for result in results]
+
+    def store_segments(self, digest, params_key, results):
+        results = [dict(result, pdf_path=None) if isinstance(result, dict) else result for result in results]
+
+        data = pack_entry(results)
+
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+
+        replace_atomically(self._segments_path(digest, params_key), write)
+
+    def output_current(self, output_pdf, document_key):
+        """
+        True when output_pdf is the file last built for document_key and has not been touched since.
+        """
+        record = self.manifest.get("output")
+        if not record or record["key"] != document_key or record["path"] != os.path.abspath(output_pdf):
+            return False
+        try:
+            st = os.stat(output_pdf)
+        except OSError:
+            return False
+        return st.st_size == record["size"] and st.st_mtime_ns == record["mtime_ns"]
+
+    def record_output(self, output_pdf, document_key):
+        st = os.stat(output_pdf)
+        self.manifest["output"] = {
+            "path": os.path.abspath(output_pdf), "key": document_key,
+            "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+        }
+
+    def prune(self, pdf_paths, params_key):
+        """
+        Forget inputs that are gone and delete results no current input refers to.
+        """
+        current = {os.path.abspath(pdf_path) for pdf_path in pdf_paths}
+        inputs = self.manifest["inputs"]
+        for path in list(inputs):
+            if path not in current:
+                del inputs[path]
+        keep = {os.path.basename(self._segments_path(entry["sha256"], params_key)) for entry in inputs.values()}
+        segments_dir = os.path.join(self.root, "segments")
+        if not os.path.isdir(segments_dir):
+            return
+        for name in os.listdir(segments_dir):
+            if name not in keep:
+                try:
+                    os.remove(os.path.join(segments_dir, name))
+                except OSError:
+                    pass
+
+    def save(self):
+        def write(tmp_path):
+            with open(tmp_path, "w") as f:
+                json.dump(self.manifest, f, indent=1, sort_keys=True)
+
+        replace_atomically(self.manifest_path, write)
+
+def build_incremental(pdf_paths, output_pdf, state_dir, jobs=1, cache=None, raster_cache=None, band_rows=None,
+                      compose_workers=1, **document_options):
+    """
+    Format pdf_paths into output_pdf, rendering only inputs that are new or
+    changed since the last build recorded in state_dir.
+    Returns the exit status: 0, or 1 if any input failed.
+    """
+    store = IncrementalStore(state_dir)
+    params_key = cache_key(cache_params(**document_options))
+    failures = []
+    digests = {}
+    for pdf_path in pdf_paths:
+        try:
+            digests[pdf_path] = store.digest(pdf_path)
+        except OSError as exc:
+            print(f"Failed to process {pdf_path}: {type(exc).__name__}: {exc}", file=sys.stderr)
+            failures.append(pdf_path)
+    readable = [pdf_path for pdf_path in pdf_paths if pdf_path in digests]
+    changed = []
+    pending = set()
+    for pdf_path in readable:
+        # Inputs with the same contents are processed once
+        if digests[pdf_path] not in pending and not store.has_segments(digests[pdf_path], params_key):
+            changed.append(pdf_path)
+            pending.add(digests[pdf_path])
+    print(f"Incremental: {len(readable) - len(changed)} reused, {len(changed)} new or changed input(s)")
+
+    document_key = cache_key("documents", [digests.get(pdf_path) for pdf_path in pdf_paths], params_key)
+    if not changed and not failures and store.output_current(output_pdf, document_key):
+        print(f"{output_pdf} is up to date")
+        return 0
+
+    if changed:
+        worker = page_worker(cache, raster_cache, band_rows, compose_workers, **document_options)
+        first_page_only = document_options.get("first_page_only", False)
+        produced = {pdf_path: [] for pdf_path in changed}
+        results = page_results(changed, worker, jobs, first_page_only, failures, cache)
+        for pdf_path, page_group in itertools.groupby(results, key=lambda item: item[0]):
+            produced[pdf_path].extend(result for _, _, result in page_group)
+        for pdf_path in changed:
+            # A partly failed input is not stored, so the next run retries it
+            if pdf_path not in failures:
+                store.store_segments(digests[pdf_path], params_key, produced[pdf_path])
+
+    output_mode = document_options.get("output_mode", "raster")
+    stored = [pdf_path for pdf_path in readable if store.has_segments(digests[pdf_path], params_key)]
+    results = itertools.chain.from_iterable(
+        store.load_segments(pdf_path, digests[pdf_path], params_key) for pdf_path in stored
+    )
+    page_count = write_results(results, output_pdf, output_mode, document_options.get("margin_in", 0.5))
+    if page_count and output_mode != "vector":
+        print(f"Saved all pages to {output_pdf}")
+    if not failures:
+        store.record_output(output_pdf, document_key)
+    store.prune(pdf_paths, params_key)
+    store.save()
+    if failures:
+        print(f"{len(failures)} of {len(pdf_paths)} file(s) failed", file=sys.stderr)
+        return 1
+    return 0
+
+def snapshot(inputs, ignore=()):
+    """
+    (path, size, mtime_ns) of every PDF that find_pdfs() would return, except those in ignore.
+    """
+    ignore = {os.path.abspath(path) for path in ignore}
+    entries = []
+    for pdf_path in find_pdfs(inputs):
+        if os.path.abspath(pdf_path) in ignore:
+            continue
+        try:
+            st = os.stat(pdf_path)
+        except OSError:
+            continue
+        entries.append((pdf_path, st.st_size, st.st_mtime_ns))
+    return entries
+
+def watch(inputs, build, interval=2.0, ignore=()):
+    """
+    Poll inputs every interval seconds and call build() after they change,
+    once the listing has been stable for one interval (so a file still being
+    copied is not built half-written). Runs until interrupted.
+    """
+    print(f"Watching {', '.join(inputs)} (Ctrl+C to stop)")
+    built = snapshot(inputs, ignore)
+    try:
+        while True:
+            time.sleep(interval)
+            current = snapshot(inputs, ignore)
+            if current == built:
+                continue
+            time.sleep(interval)
+            settled = snapshot(inputs, ignore)
+            if settled != current:
+                continue
+            built = settled
+            build()
+    except KeyboardInterrupt:
+        pass
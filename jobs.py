@@ -0,0 +1,233 @@
+"""
+Background job queue for the web front end.
+
+Uploads are saved into a per-job directory under a private temp area and
+formatted by a bounded local worker pool (threads or processes, no external
+broker). Finished results are kept for a fixed time-to-live and then removed.
+Given the web app's MemoryBudget, a job holds its memory estimate from the
+budget while it is formatted, so jobs and synchronous requests share one limit;
+a job waits in the queue until its estimate fits.
+
+Worker processes are started with JOB_START_METHOD, never by forking the web
+worker: it runs request threads, and a child forked while one of them holds a
+lock (logging, the allocator, a cache) can deadlock on it.
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from cache import ResultCache, RasterCache
+from merge import format_pdfs, load_cached_document
+from metrics import METRICS, stage
+
+logger = logging.getLogger("pdf_formatter")
+
+# A fork server starts each process from a clean single-threaded parent; spawn where there is none
+JOB_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+def run_job(input_paths, output_path, cache_options=None, raster_cache_options=None, report_metrics=False,
+            **options):
+    """
+    Worker entry point: format one job and report the page count and cache counters.
+    With report_metrics (worker processes) the stage metrics recorded are returned too.
+    """
+    cache = ResultCache(**cache_options) if cache_options else None
+    raster_cache = RasterCache(**raster_cache_options) if raster_cache_options else None
+    # The merged document was already looked up when the job was queued
+    with stage("job", inputs=len(input_paths)) as info:
+        info["pages"] = format_pdfs(input_paths, output_path, cache=cache, lookup_document=False,
+                                    raster_cache=raster_cache, **options)
+    return info["pages"], cache.stats() if cache else None, METRICS.drain() if report_metrics else None
+
+class QueueFull(Exception):
+    """Raised when the queue already holds its maximum number of unfinished jobs."""
+
+class JobQueue:
+    def __init__(self, workers=2, max_pending=16, result_ttl=600, executor="process", root=None, cache=None,
+                 raster_cache=None, band_rows=None, page_workers=1, compose_workers=1, memory_budget=None):
+        if executor not in ("process", "thread"):
+            raise ValueError(f"Unknown executor: {executor}")
+        self.workers = workers
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.executor_kind = executor
+        self.cache = cache
+        self.raster_cache = raster_cache
+        self.band_rows = band_rows
+        self.page_workers = page_workers
+        self.compose_workers = compose_workers
+        self.memory_budget = memory_budget
+        self.root = root or tempfile.mkdtemp(prefix="pdf-formatter-jobs-")
+        self._executor = None
+        self._dispatcher = None
+        self._closed = False
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Created on first use so importing the app never starts workers
+        with self._lock:
+            if self._executor is None:
+                if self.executor_kind == "process":
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                         mp_context=multiprocessing.get_context(JOB_START_METHOD))
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _get_dispatcher(self):
+        # Threads that wait for each job's memory and hold it while a worker process formats the job
+        with self._lock:
+            if self._dispatcher is None:
+                self._dispatcher = ThreadPoolExecutor(max_workers=self.workers)
+            return self._dispatcher
+
+    def _submit(self, *args, **kwargs):
+        executor = self._get_executor()
+        try:
+            return executor.submit(*args, **kwargs)
+        except BrokenProcessPool:
+            # A worker process died (killed for memory, say). The jobs the pool
+            # held have already failed with BrokenProcessPool; replace the pool
+            logger.warning("Job worker pool is broken; starting a new one")
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False)
+            return self._get_executor().submit(*args, **kwargs)
+
+    def _reserve(self, nbytes):
+        # Wait as long as it takes for nbytes of the memory budget, but not past shutdown
+        if self.memory_budget is None:
+            return False
+        while not self.memory_budget.acquire(nbytes, timeout=1):
+            if self._closed:
+                raise RuntimeError("The job queue was shut down")
+        return True
+
+    def _run_reserved(self, nbytes, *args, **kwargs):
+        # Runs on a thread: format a job while holding its memory estimate
+        reserved = self._reserve(nbytes)
+        try:
+            if self.executor_kind == "process":
+                return self._submit(run_job, *args, **kwargs).result()
+            return run_job(*args, **kwargs)
+        finally:
+            if reserved:
+                self.memory_budget.release(nbytes)
+
+    def create(self):
+        """
+        Reserve a job slot and its working directory. Returns (job_id, job_dir).
+        Raises QueueFull when max_pending jobs are still queued or running.
+        """
+        self.sweep()
+        with self._lock:
+            active = sum(1 for job in self._jobs.values() if job["future"] is None or not job["future"].done())
+            if active >= self.max_pending:
+                raise QueueFull()
+            job_id = uuid.uuid4().hex
+            job_dir = os.path.join(self.root, job_id)
+            os.makedirs(job_dir)
+            self._jobs[job_id] = {"dir": job_dir, "future": None, "created": time.time(), "finished": None}
+        return job_id, job_dir
+
+    def start(self, job_id, input_paths, reserve_bytes=0, **options):
+        """
+        Queue the formatting work for a job created with create().
+        A merged document that is already cached completes the job immediately.
+        reserve_bytes is the job's memory estimate, held from memory_budget while it runs.
+        """
+        job = self._jobs[job_id]
+        job["output"] = os.path.join(job["dir"], "formatted.pdf")
+        page_count = load_cached_document(input_paths, job["output"], self.cache, **options)
+        if page_count is not None:
+            future = Future()
+            future.set_result((page_count, None, None))
+        else:
+            cache_options = self.cache.options() if self.cache is not None else None
+            raster_cache_options = self.raster_cache.options() if self.raster_cache is not None else None
+            pool = self._get_dispatcher() if self.executor_kind == "process" else self._get_executor()
+            future = pool.submit(self._run_reserved, reserve_bytes, input_paths, job["output"], cache_options,
+                                 raster_cache_options, self.executor_kind == "process", band_rows=self.band_rows,
+                                 page_workers=self.page_workers, compose_workers=self.compose_workers, **options)
+        future.add_done_callback(lambda done: self._finish(job, done))
+        job["future"] = future
+
+    def _finish(self, job, future):
+        job["finished"] = time.time()
+        if future.exception() is not None:
+            return
+        _, cache_stats, metrics = future.result()
+        if self.cache is not None:
+            self.cache.merge_stats(cache_stats)
+        METRICS.merge(metrics)
+
+    def discard(self, job_id):
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        if job is not None:
+            shutil.rmtree(job["dir"], ignore_errors=True)
+
+    def status(self, job_id):
+        """
+        Describe a job as a dict, or return None for unknown or expired jobs.
+        """
+        self.sweep()
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        future = job["future"]
+        info = {"id": job_id, "status": "queued", "error": None}
+        if future is None:
+            return info
+        if future.done():
+            error = future.exception()
+            if isinstance(error, BrokenProcessPool):
+                info.update(status="failed", error="The worker process formatting this job stopped unexpectedly")
+            elif error is not None:
+                info.update(status="failed", error=f"{type(error).__name__}: {error}")
+            elif not future.result()[0]:
+                info.update(status="failed", error="No valid PDF files processed")
+            else:
+                info["status"] = "done"
+        elif future.running():
+            info["status"] = "running"
+        return info
+
+    def result_path(self, job_id):
+        """
+        Path of a finished job's PDF, or None if it is not available.
+        """
+        info = self.status(job_id)
+        if info is None or info["status"] != "done":
+            return None
+        return self._jobs[job_id]["output"]
+
+    def sweep(self):
+        """
+        Remove finished jobs whose results are older than result_ttl.
+        """
+        now = time.time()
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job["finished"] is not None and now - job["finished"] > self.result_ttl
+            ]
+            jobs = [self._jobs.pop(job_id) for job_id in expired]
+        for job in jobs:
+            shutil.rmtree(job["dir"], ignore_errors=True)
+
+    def shutdown(self):
+        self._closed = True
+        if self._dispatcher is not None:
+            self._dispatcher.shutdown(wait=False, cancel_futures=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -1,133 +1,1110 @@
+import io
 import os
+import sys
+import argparse
+import itertools
+import logging
+import math
+import re
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pdf2image import convert_from_path
 from PIL import Image
+from pypdf import PdfReader
 import numpy as np
+from pdf_writer import DEFAULT_ENCODING, ENCODING_PRESETS, encode_page, write_pdf
+from cache import ResultCache, RasterCache, DEFAULT_MAX_BYTES, DEFAULT_RASTER_MAX_BYTES, cache_key, file_hash
+from metrics import stage
 
-def crop_pdf_first_page(pdf_path):
-    images = convert_from_path(pdf_path)
-    if not images:
-        raise ValueError("No images found in PDF.")
-    # Improved cropping: convert to grayscale, threshold, find bounding box
-    first_img = images[0].convert("L")  # Convert to grayscale
-    img_np = np.array(first_img)
+logger = logging.getLogger("pdf_formatter")
+
+# Resolution used for rendering, segmentation and the output PDF unless a
+# caller asks for something else.
+DEFAULT_DPI = 300
+# Grayscale values at or above this count as white paper
+WHITE_THRESHOLD = 240
+RENDER_BACKENDS = ("pdftoppm", "pdftocairo")
+BREAK_STRATEGIES = ("greedy", "optimal")
+# Where the crop box and cut rows come from: the rendered page, or the PDF text layer when a page is text only
+LAYOUT_SOURCES = ("raster", "text")
+# The optimal break planner may cut anywhere in the last this many inches of a page
+OPTIMAL_SEARCH_IN = 2.0
+# Cost of one more page for the optimal planner, in units of segment_height ink pixels
+PAGE_PENALTY = 2.0
+# Resampling filters for composing pages, sharpest first
+RESAMPLE_FILTERS = {"lanczos": Image.LANCZOS, "bicubic": Image.BICUBIC, "bilinear": Image.BILINEAR}
+# Segments within this many pixels of their fitted size are pasted without resampling
+RESAMPLE_TOLERANCE_PX = 2
+# With grayscale="auto", pages are checked for colour on a render at this DPI
+COLOUR_PREVIEW_DPI = 36
+# Pixels whose channels differ by more than this are coloured rather than gray
+COLOUR_TOLERANCE = 24
+# Rows of a page array thresholded at once, so the ink mask stays a small fraction of the page
+SCAN_ROWS = 512
+PNM_HEADER = re.compile(rb"(P[56])\s+(\d+)\s+(\d+)\s+(\d+)\s")
+
+def open_pdf(source):
+    """
+    PdfReader for a file path or for the PDF itself as bytes.
+    """
+    return PdfReader(io.BytesIO(source) if isinstance(source, bytes) else source)
+
+# The file each thread parsed last (PdfReader is not thread-safe), so the
+# per-page helpers do not parse the whole document again for every page
+_parsed = threading.local()
+
+def pdf_reader(source):
+    """
+    Read-only PdfReader for a path or PDF bytes. The calling thread's last
+    file is reused while its path, mtime and size are unchanged. Bytes are
+    parsed on every call, so no thread keeps an upload alive after its request.
+    Callers must not modify it (open_pdf() gives a private reader).
+    """
+    if isinstance(source, bytes):
+        return open_pdf(source)
+    st = os.stat(source)
+    key = (os.fspath(source), st.st_mtime_ns, st.st_size)
+    last = getattr(_parsed, "last", None)
+    if last is not None and last[0] == key:
+        return last[1]
+    reader = open_pdf(source)
+    _parsed.last = (key, reader)
+    return reader
+
+def poppler_output(source, page=1, dpi=DEFAULT_DPI, grayscale=False, backend="pdftoppm", poppler_path=None,
+                   region=None):
+    """
+    The image file poppler writes for one page: PPM/PGM from pdftoppm, PNG from pdftocairo.
+    """
+    if backend not in RENDER_BACKENDS:
+        raise ValueError(f"Unknown render backend: {backend}")
+    command = [os.path.join(poppler_path, backend) if poppler_path else backend]
+    if backend == "pdftocairo":
+        command += ["-png", "-singlefile"]
+    if grayscale:
+        command.append("-gray")
+    command += ["-f", str(page), "-l", str(page), "-r", str(dpi)]
+    if region is not None:
+        x, y, width, height = region
+        command += ["-x", str(x), "-y", str(y), "-W", str(width), "-H", str(height)]
+    command.append("-" if isinstance(source, bytes) else source)
+    if backend == "pdftocairo":
+        # pdftoppm writes to stdout when no output root is given; pdftocairo needs "-"
+        command.append("-")
+    result = subprocess.run(command, input=source if isinstance(source, bytes) else None,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0 or not result.stdout:
+        raise RuntimeError(f"{backend} failed: {result.stderr.decode(errors='replace').strip()}")
+    return result.stdout
+
+def run_poppler(source, page=1, dpi=DEFAULT_DPI, grayscale=False, backend="pdftoppm", poppler_path=None,
+                region=None):
+    """
+    Render one page with poppler in a subprocess and return it as a PIL image.
+    source is a file path or the PDF itself as bytes, which is piped to stdin so
+    it never touches the disk. region (x, y, width, height) renders only that
+    rectangle of the page, in pixels at dpi; poppler clips it to the page.
+    """
+    img = Image.open(io.BytesIO(poppler_output(source, page, dpi, grayscale, backend, poppler_path, region)))
+    img.load()
+    return img
+
+def render_pdf_page(pdf_path, page=1, dpi=DEFAULT_DPI, grayscale=False,
+                    backend="pdftoppm", fmt="ppm", poppler_path=None):
+    """
+    Render a single page (1-based) of a PDF to a PIL image.
+    Only the requested page is rasterized, at the requested DPI.
+    pdf_path may also be the PDF as bytes; it is then piped to poppler (fmt is ignored).
+    """
+    if backend not in RENDER_BACKENDS:
+        raise ValueError(f"Unknown render backend: {backend}")
+    with stage("render", backend=backend, dpi=dpi) as info:
+        if isinstance(pdf_path, bytes):
+            img = run_poppler(pdf_path, page, dpi, grayscale, backend, poppler_path)
+            info["pixels"] = img.width * img.height
+            return img
+        images = convert_from_path(
+            pdf_path,
+            dpi=dpi,
+            first_page=page,
+            last_page=page,
+            grayscale=grayscale,
+            use_pdftocairo=backend == "pdftocairo",
+            fmt=fmt,
+            poppler_path=poppler_path,
+        )
+        if not images:
+            raise ValueError("No images found in PDF.")
+        info["pixels"] = images[0].width * images[0].height
+    return images[0]
+
+def find_content_bbox(img, threshold=WHITE_THRESHOLD):
+    """
+    Find the bounding box (x0, y0, x1, y1) of the non-white content of an image.
+    Returns None for a blank image.
+    """
+    # Convert to grayscale, threshold, find bounding box
+    gray = img if img.mode == "L" else img.convert("L")
+    img_np = np.array(gray)
     # Threshold: consider pixels >240 as white
-    mask = img_np < 240
-    coords = np.argwhere(mask)
-    if coords.size > 0:
-        y0, x0 = coords.min(axis=0)
-        y1, x1 = coords.max(axis=0) + 1  # slices are exclusive at the top
-        cropped_img = images[0].crop((x0, y0, x1, y1))
+    mask = img_np < threshold
+    # Project the mask onto each axis instead of listing every ink pixel
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    # slices are exclusive at the top
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+def crop_pdf_first_page(pdf_path, page=1, dpi=DEFAULT_DPI, grayscale=False,
+                        backend="pdftoppm", fmt="ppm", poppler_path=None):
+    """
+    Render one page (1-based, the first by default) at dpi and crop it to its content.
+    A blank page is returned uncropped.
+    """
+    page_img = render_pdf_page(pdf_path, page=page, dpi=dpi, grayscale=grayscale,
+                               backend=backend, fmt=fmt, poppler_path=poppler_path)
+    with stage("crop", pixels=page_img.width * page_img.height):
+        bbox = find_content_bbox(page_img)
+        if bbox is None:
+            return page_img
+        return page_img.crop(bbox)
+
+def pnm_array(data):
+    """
+    uint8 array (rows, columns[, 3]) over the pixels of a binary PGM or PPM, without copying them.
+    """
+    match = PNM_HEADER.match(data)
+    if match is None or int(match.group(4)) != 255:
+        raise ValueError("Not an 8-bit PGM/PPM image")
+    width, height = int(match.group(2)), int(match.group(3))
+    shape = (height, width) if match.group(1) == b"P5" else (height, width, 3)
+    return np.frombuffer(data, dtype=np.uint8, count=math.prod(shape), offset=match.end()).reshape(shape)
+
+def render_page_array(pdf_path, page=1, dpi=DEFAULT_DPI, grayscale=False, backend="pdftoppm", poppler_path=None):
+    """
+    Render a single page to a read-only uint8 array: 2-D for grayscale, (rows, columns, 3) for RGB.
+    pdftoppm's output is used in place, so the page is held once rather than as
+    the subprocess output, a decoded PIL image and an array copy of it.
+    """
+    with stage("render", backend=backend, dpi=dpi) as info:
+        data = poppler_output(pdf_path, page, dpi, grayscale, backend, poppler_path)
+        if backend == "pdftoppm":
+            arr = pnm_array(data)
+        else:
+            img = Image.open(io.BytesIO(data))
+            arr = np.asarray(img if img.mode in ("L", "RGB") else img.convert("RGB"))
+        info["pixels"] = arr.shape[0] * arr.shape[1]
+    return arr
+
+def luminance(rgb):
+    """
+    Gray values of an RGB uint8 array, with the same weights and rounding as PIL's convert("L").
+    """
+    r, g, b = (rgb[..., channel].astype(np.uint32) for channel in range(3))
+    return ((r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16).astype(np.uint8)
+
+def page_ink(arr, threshold=WHITE_THRESHOLD):
+    """
+    Row-ink profile of a whole page array and a mask of the columns holding any
+    ink, thresholded SCAN_ROWS rows at a time.
+    """
+    counts = np.empty(arr.shape[0], dtype=np.intp)
+    columns = np.zeros(arr.shape[1], dtype=bool)
+    for start in range(0, arr.shape[0], SCAN_ROWS):
+        rows = arr[start:start + SCAN_ROWS]
+        mask = (rows if rows.ndim == 2 else luminance(rows)) < threshold
+        counts[start:start + len(mask)] = np.count_nonzero(mask, axis=1)
+        columns |= mask.any(axis=0)
+    return counts, columns
+
+def crop_page_array(arr, threshold=WHITE_THRESHOLD):
+    """
+    Array counterpart of find_content_bbox and crop: (content of arr, its row-ink profile).
+    The content is C-contiguous, so every row slice of it is a view that
+    Image.fromarray wraps without a copy. It is arr itself when only whole rows
+    are cropped, and otherwise one copy of the content box.
+    """
+    with stage("crop", pixels=arr.shape[0] * arr.shape[1]):
+        counts, columns = page_ink(arr, threshold)
+        rows = np.flatnonzero(counts)
+        if rows.size == 0:
+            return arr, counts
+        cols = np.flatnonzero(columns)
+        y0, y1 = int(rows[0]), int(rows[-1]) + 1
+        return np.ascontiguousarray(arr[y0:y1, int(cols[0]):int(cols[-1]) + 1]), counts[y0:y1]
+
+def load_page_array(pdf_path, page=1, dpi=DEFAULT_DPI, grayscale=False, backend="pdftoppm", poppler_path=None):
+    """
+    Cropped render of a page as a uint8 array and its row-ink profile, the
+    single-channel (or, for colour pages, three-channel) representation the
+    raster pipeline carries from render to compose.
+    """
+    return crop_page_array(render_page_array(pdf_path, page, dpi, grayscale, backend, poppler_path))
+
+def page_has_colour(pdf_path, page=1, backend="pdftoppm", poppler_path=None):
+    """
+    True if a COLOUR_PREVIEW_DPI render of the page has any pixel whose channels
+    differ by more than COLOUR_TOLERANCE.
+    """
+    with stage("colour_check", dpi=COLOUR_PREVIEW_DPI) as info:
+        arr = render_page_array(pdf_path, page, COLOUR_PREVIEW_DPI, False, backend, poppler_path)
+        spread = arr.max(axis=2).astype(np.int16) - arr.min(axis=2)
+        info["colour"] = bool((spread > COLOUR_TOLERANCE).any())
+    return info["colour"]
+
+def resolve_grayscale(grayscale, pdf_path, page=1, backend="pdftoppm", poppler_path=None):
+    """
+    grayscale for one page: True or False as given, and for "auto" True unless the page has colour.
+    """
+    if grayscale == "auto":
+        return not page_has_colour(pdf_path, page, backend, poppler_path)
+    return grayscale
+
+def _image_size(img):
+    # Segmentation accepts PIL images and (memory-mapped) uint8 arrays
+    if isinstance(img, np.ndarray):
+        return img.shape[1], img.shape[0]
+    return img.size
+
+def _image_mode(img):
+    if isinstance(img, np.ndarray):
+        return "L" if img.ndim == 2 else "RGB"
+    return img.mode
+
+def _crop_rows(img, start_row, end_row):
+    # Only rows [start_row, end_row) of an array are read; for a C-contiguous
+    # array the segment is a view of them, which Image.fromarray wraps without a copy
+    if isinstance(img, np.ndarray):
+        return Image.fromarray(np.ascontiguousarray(img[start_row:end_row]))
+    return img.crop((0, start_row, img.width, end_row))
+
+def row_ink_profile(img, threshold=WHITE_THRESHOLD):
+    """
+    Count the non-white pixels in every row of the image in a single pass.
+    The returned array is what all cut points are chosen from.
+    """
+    if isinstance(img, np.ndarray) and img.ndim == 2:
+        arr = img
     else:
-        cropped_img = images[0]
-    return cropped_img
+        if isinstance(img, np.ndarray):
+            img = Image.fromarray(img)
+        arr = np.asarray(img if img.mode == "L" else img.convert("L"))
+    return np.count_nonzero(arr < threshold, axis=1)
 
-def analyze_bottom_rows(img, segment_num, threshold=240, dpi=300):
+def ink_prefix_sums(counts):
     """
-    Analyze the bottom rows of the image to find the best place to segment (the true bottom of content).
-    Draw a black line at that row and return both the row index and inches from the top.
+    Prefix sums of a row-ink profile: prefix[b] - prefix[a] is the ink in rows [a, b).
+    """
+    prefix = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=prefix[1:])
+    return prefix
+
+def find_cut_row(counts, start, end, dpi=DEFAULT_DPI):
+    """
+    Find the row with the fewest non-white pixels in the last half inch of rows [start, end).
+    Ties go to the bottom-most row. Returns the row index relative to start.
     """
-    gray = img.convert("L")
-    arr = np.array(gray)
-    h, w = arr.shape
-    # Calculate number of rows for half an inch
     num_rows = int(0.5 * dpi)
-    min_nonwhite = w  # max possible non-white per row
-    min_row = h - 1
-    for i in range(h-1, max(h-1-num_rows, -1), -1):
-        nonwhite = np.sum(arr[i] < threshold)
-        if nonwhite < min_nonwhite:
-            min_nonwhite = nonwhite
-            min_row = i
-    # Draw a black line at the detected bottom row
-    rgb_img = img.convert("RGB")
-    pixels = rgb_img.load()
-    for x in range(rgb_img.width):
-        pixels[x, min_row] = (0, 0, 0)
-    img.paste(rgb_img)
+    lo = max(end - num_rows, start)
+    # Reverse the window so argmin's first match is the bottom-most row
+    window = counts[lo:end][::-1]
+    return end - 1 - int(np.argmin(window)) - start
+
+def analyze_bottom_rows(img, segment_num, threshold=WHITE_THRESHOLD, dpi=DEFAULT_DPI, draw_line=False):
+    """
+    Analyze the bottom rows of the image to find the best place to segment (the true bottom of content).
+    Returns both the row index and inches from the top. With draw_line, a black line
+    is also drawn at that row, in place.
+    """
+    with stage("analyze", pixels=img.width * img.height):
+        counts = row_ink_profile(img, threshold)
+        min_row = find_cut_row(counts, 0, len(counts), dpi)
+        if draw_line:
+            img.paste("black", (0, min_row, img.width, min_row + 1))
     min_row_inches = min_row / dpi
     return min_row, min_row_inches
 
-def segment_image_by_aspect_ratio(img, aspect_w=8.5, aspect_h=11):
-    w, h = img.size
-    aspect_ratio = aspect_w / aspect_h
-    segment_height = int(w / aspect_ratio)
-    if segment_height <= 0:
-        return []
-    segments = []
+def plan_segments(counts, segment_height, dpi=DEFAULT_DPI):
+    """
+    Choose segment boundaries from a row-ink profile.
+    Returns a list of (start_row, end_row, padded) tuples; only the last
+    segment can be padded, and it is padded to segment_height.
+    """
+    h = len(counts)
+    plan = []
     start_row = 0
-    seg_num = 1
     while start_row < h:
         # Tentative bottom row for this segment
         tentative_bottom = min(start_row + segment_height, h)
-        segment = img.crop((0, start_row, w, tentative_bottom))
-        # Analyze the bottom rows of this segment to find the true bottom
-        min_row, min_row_inches = analyze_bottom_rows(segment, seg_num, dpi=300)
-        print(f"Segment {seg_num}: min row at {min_row_inches:.2f} inches from top (relative to segment)")
-        # The true bottom in the original image is:
-        true_bottom = start_row + min_row + 1  # +1 to include the black line
-        # Crop the segment from start_row to true_bottom
-        segment_final = img.crop((0, start_row, w, true_bottom))
-        segments.append(segment_final)
-        # Prepare for next segment
+        # The true bottom includes the best cut row near the tentative bottom
+        true_bottom = start_row + find_cut_row(counts, start_row, tentative_bottom, dpi) + 1
+        plan.append((start_row, true_bottom, False))
         start_row = true_bottom
-        seg_num += 1
         # If the next segment would be too small, break
         if h - start_row < int(0.2 * segment_height):
             break
     # Handle the last segment (if any rows remain)
     if start_row < h:
-        remainder = img.crop((0, start_row, w, h))
-        # Always pad to segment_height for consistency
-        padded = Image.new("RGB", (w, segment_height), (255, 255, 255))
-        padded.paste(remainder, (0, 0))
-        # Only analyze up to the actual content height (not the padded area)
-        actual_content_height = min(remainder.height, segment_height)
-        # Draw black line at the bottom of actual content in the remainder
-        # Temporarily crop to actual content for analysis
-        content_crop = padded.crop((0, 0, w, actual_content_height))
-        min_row, min_row_inches = analyze_bottom_rows(content_crop, seg_num, dpi=300)
-        print(f"Segment {seg_num}: min row at {min_row_inches:.2f} inches from top (last segment)")
-        # Draw the black line on the padded image at min_row (if within content)
-        rgb_img = padded.convert("RGB")
-        pixels = rgb_img.load()
-        if min_row < actual_content_height:
-            for x in range(rgb_img.width):
-                pixels[x, min_row] = (0, 0, 0)
-            padded.paste(rgb_img)
-        segments.append(padded)
-    return segments
-
-def create_pdf_from_images(images, output_pdf, margin_in=0.5, page_w_in=8.5, page_h_in=11, dpi=300):
-    page_w_px = int(page_w_in * dpi)
-    page_h_px = int(page_h_in * dpi)
-    margin_px = int(margin_in * dpi)
-    content_w = page_w_px - 2 * margin_px
-    content_h = page_h_px - 2 * margin_px
-    pdf_pages = []
-    for img in images:
-        img = img.convert("RGB")
+        plan.append((start_row, h, True))
+    return plan
+
+def blank_row_runs(counts):
+    """
+    Index of the runs of rows without ink, as (starts, ends) arrays: run i is rows [starts[i], ends[i]).
+    """
+    blank = np.concatenate(([False], np.asarray(counts) == 0, [False]))
+    edges = np.flatnonzero(blank[1:] != blank[:-1])
+    return edges[0::2], edges[1::2]
+
+def break_candidates(counts, block_rows, runs=None):
+    """
+    Rows worth cutting after, sorted: both ends of every blank run plus the
+    least-inked row (bottom-most on ties) of each block of block_rows rows,
+    so dense text still offers a candidate every block_rows rows.
+    """
+    h = len(counts)
+    starts, ends = runs if runs is not None else blank_row_runs(counts)
+    blocks = -(-h // block_rows)
+    grid = np.full(blocks * block_rows, np.iinfo(np.int64).max, dtype=np.int64)
+    grid[:h] = counts
+    # Reverse each block so argmin's first match is the bottom-most row
+    block_min = block_rows - 1 - np.argmin(grid.reshape(blocks, block_rows)[:, ::-1], axis=1)
+    rows = np.arange(blocks) * block_rows + block_min
+    return np.unique(np.concatenate((starts, ends - 1, rows)))
+
+def ink_cut(prefix, runs, bounds):
+    """
+    Ink cut by ending pages at each boundary in bounds (after row b - 1): zero on
+    a blank row, otherwise the ink of the smaller of the two pieces the cut
+    splits its block of inked rows (a text line, a figure) into.
+    """
+    starts, ends = runs
+    h = len(prefix) - 1
+    # The inked block around row b - 1 runs from the end of the blank run above to the start of the one below;
+    # the top and bottom of the image stand in for missing runs, so a page without blank rows is one block
+    block_start = np.concatenate(([0], ends))[np.searchsorted(ends, bounds - 1, side="right")]
+    block_end = np.concatenate((starts, [h]))[np.searchsorted(starts, bounds - 1, side="right")]
+    cost = np.minimum(prefix[bounds] - prefix[block_start], prefix[block_end] - prefix[bounds])
+    return np.where(prefix[bounds] == prefix[bounds - 1], 0, cost)
+
+def plan_optimal_segments(counts, segment_height, dpi=DEFAULT_DPI, search_in=OPTIMAL_SEARCH_IN,
+                          page_penalty=PAGE_PENALTY):
+    """
+    Choose all segment boundaries of a profile at once. Same plan format as plan_segments.
+    Each cut falls in the last search_in inches of its page and costs ink_cut();
+    every page costs page_penalty times segment_height ink pixels, about one
+    solid row. A dynamic program over break_candidates() with a sliding-window
+    minimum minimizes the total, in time linear in the number of candidates.
+    The last segment is padded.
+    """
+    h = len(counts)
+    if h <= segment_height:
+        return [(0, h, True)] if h else []
+    min_rows = max(segment_height - int(search_in * dpi), 1)
+    block_rows = max(1, min(int(0.1 * dpi), (segment_height - min_rows) // 2))
+    prefix = ink_prefix_sums(counts)
+    runs = blank_row_runs(counts)
+    # A boundary b ends a page after row b - 1
+    bounds = break_candidates(counts, block_rows, runs) + 1
+    bounds = bounds[(bounds >= min_rows) & (bounds < h)]
+    cut_cost = ink_cut(prefix, runs, bounds)
+    penalty = int(page_penalty * segment_height)
+    positions = [0] + bounds.tolist()
+    best = [0] + [None] * len(bounds)
+    parent = [None] * len(positions)
+    # Reachable boundaries that may start the page ending at positions[j], best cost first
+    window = deque()
+    entering = 0
+    for j in range(1, len(positions)):
+        b = positions[j]
+        while entering < j and positions[entering] <= b - min_rows:
+            if best[entering] is not None:
+                while window and best[window[-1]] >= best[entering]:
+                    window.pop()
+                window.append(entering)
+            entering += 1
+        while window and positions[window[0]] < b - segment_height:
+            window.popleft()
+        if window:
+            best[j] = best[window[0]] + int(cut_cost[j - 1]) + penalty
+            parent[j] = window[0]
+    last = None
+    for j in range(len(positions)):
+        if best[j] is not None and positions[j] >= h - segment_height and (last is None or best[j] <= best[last]):
+            last = j
+    if last is None:
+        return plan_segments(counts, segment_height, dpi)
+    plan = [(positions[last], h, True)]
+    j = last
+    while j:
+        plan.append((positions[parent[j]], positions[j], False))
+        j = parent[j]
+    plan.reverse()
+    return plan
+
+def plan_breaks(counts, segment_height, dpi=DEFAULT_DPI, strategy="greedy"):
+    """
+    Segment plan for a row-ink profile with one of BREAK_STRATEGIES: "greedy"
+    (plan_segments) or "optimal" (plan_optimal_segments).
+    """
+    if strategy == "greedy":
+        return plan_segments(counts, segment_height, dpi)
+    if strategy == "optimal":
+        return plan_optimal_segments(counts, segment_height, dpi)
+    raise ValueError(f"Unknown break strategy: {strategy}")
+
+def segment_image_by_aspect_ratio(img, aspect_w=8.5, aspect_h=11, dpi=DEFAULT_DPI, counts=None, strategy="greedy",
+                                  debug_lines=False):
+    """
+    Generate the segments of an image, cropping each one only when it is requested.
+    img may be a PIL image or a uint8 array; counts is its row-ink profile if already known.
+    strategy picks the break planner (see plan_breaks). debug_lines overlays a black
+    line at the bottom of the content of the padded last segment.
+    """
+    w, h = _image_size(img)
+    aspect_ratio = aspect_w / aspect_h
+    segment_height = int(w / aspect_ratio)
+    if segment_height <= 0:
+        return
+    with stage("plan", pixels=w * h) as info:
+        if counts is None:
+            counts = row_ink_profile(img)
+        plan = plan_breaks(counts, segment_height, dpi, strategy)
+        info["segments"] = len(plan)
+    for seg_num, (start_row, end_row, padded) in enumerate(plan, 1):
+        with stage("segment", pixels=w * (segment_height if padded else end_row - start_row)):
+            segment = _crop_rows(img, start_row, end_row)
+            if not padded:
+                min_row_inches = (end_row - 1 - start_row) / dpi
+                logger.info("Segment %d: min row at %.2f inches from top (relative to segment)",
+                            seg_num, min_row_inches)
+            else:
+                # Always pad the last segment to segment_height for consistency
+                padded_img = Image.new(_image_mode(img), (w, segment_height), "white")
+                padded_img.paste(segment, (0, 0))
+                min_row = find_cut_row(counts, start_row, end_row, dpi)
+                logger.info("Segment %d: min row at %.2f inches from top (last segment)", seg_num, min_row / dpi)
+                if debug_lines:
+                    padded_img.paste("black", (0, min_row, w, min_row + 1))
+                segment = padded_img
+        yield segment
+
+def page_numbers(pdf_path, first_page_only=False):
+    """
+    Page numbers (1-based) of a PDF to process, in order: every page, or only the first.
+    """
+    if first_page_only:
+        return range(1, 2)
+    return range(1, len(pdf_reader(pdf_path).pages) + 1)
+
+def iter_cropped_pages(pdf_path, dpi=DEFAULT_DPI, first_page_only=False, **render_options):
+    """
+    Lazily render and crop each page of a PDF in order; one rendered page is held at a time.
+    """
+    for page in page_numbers(pdf_path, first_page_only):
+        yield crop_pdf_first_page(pdf_path, page=page, dpi=dpi, **render_options)
+
+def segment_pdfs(pdf_paths, aspect_w=8.5, aspect_h=11, dpi=DEFAULT_DPI, first_page_only=False):
+    """
+    Lazily crop and segment every page of each PDF in order; only one rendered page is held at a time.
+    """
+    return itertools.chain.from_iterable(
+        segment_image_by_aspect_ratio(cropped, aspect_w, aspect_h, dpi=dpi)
+        for pdf_path in pdf_paths
+        for cropped in iter_cropped_pages(pdf_path, dpi=dpi, first_page_only=first_page_only)
+    )
+
+def output_resolution(dpi=DEFAULT_DPI, output_dpi=None, max_page_pixels=None, page_w_in=8.5, page_h_in=11):
+    """
+    DPI of the composed pages: output_dpi if given, otherwise the render dpi,
+    lowered if needed so that a page holds at most max_page_pixels pixels.
+    """
+    resolution = output_dpi or dpi
+    if max_page_pixels:
+        resolution = min(resolution, int(math.sqrt(max_page_pixels / (page_w_in * page_h_in))))
+    return max(resolution, 1)
+
+def _covers(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+class PageComposer:
+    """
+    Scales segments to fit inside the margins and centers them on white pages at dpi.
+    Grayscale segments stay grayscale; anything else is composed in RGB.
+    One page buffer per mode is reused and only the previous segment's box is
+    cleared between pages, so a composed page is valid until the next compose().
+    """
+    def __init__(self, margin_in=0.5, page_w_in=8.5, page_h_in=11, dpi=DEFAULT_DPI, resample="lanczos"):
+        if resample not in RESAMPLE_FILTERS:
+            raise ValueError(f"Unknown resample filter: {resample}")
+        self.dpi = dpi
+        self.page_w_px = int(page_w_in * dpi)
+        self.page_h_px = int(page_h_in * dpi)
+        margin_px = int(margin_in * dpi)
+        self.content_w = self.page_w_px - 2 * margin_px
+        self.content_h = self.page_h_px - 2 * margin_px
+        self.resample = RESAMPLE_FILTERS[resample]
+        # mode -> (page buffer, box of the segment last pasted on it)
+        self._pages = {}
+
+    def fit(self, img):
+        """
+        Scale img to fit the content box. Sizes within RESAMPLE_TOLERANCE_PX of
+        the fitted size are not resampled at all, and downscales by 2x or more
+        start with Image.reduce by the integer part of the factor.
+        """
         img_w, img_h = img.size
-        scale = min(content_w / img_w, content_h / img_h)
+        scale = min(self.content_w / img_w, self.content_h / img_h)
         new_w = int(img_w * scale)
         new_h = int(img_h * scale)
-        resized = img.resize((new_w, new_h), Image.LANCZOS)
-        page = Image.new("RGB", (page_w_px, page_h_px), (255, 255, 255))
-        x = (page_w_px - new_w) // 2
-        y = (page_h_px - new_h) // 2
-        page.paste(resized, (x, y))
-        pdf_pages.append(page)
-    if pdf_pages:
-        pdf_pages[0].save(output_pdf, save_all=True, append_images=pdf_pages[1:])
+        factor = int(1 / scale)
+        if factor >= 2:
+            img = img.reduce(factor)
+        if abs(img.width - new_w) <= RESAMPLE_TOLERANCE_PX and abs(img.height - new_h) <= RESAMPLE_TOLERANCE_PX:
+            return img
+        return img.resize((new_w, new_h), self.resample)
+
+    def compose(self, img):
+        with stage("compose", pixels=self.page_w_px * self.page_h_px):
+            if img.mode not in ("L", "RGB"):
+                img = img.convert("RGB")
+            fitted = self.fit(img)
+            x = (self.page_w_px - fitted.width) // 2
+            y = (self.page_h_px - fitted.height) // 2
+            box = (max(x, 0), max(y, 0), min(x + fitted.width, self.page_w_px), min(y + fitted.height, self.page_h_px))
+            if img.mode in self._pages:
+                page, last_box = self._pages[img.mode]
+                if not _covers(box, last_box):
+                    page.paste("white", last_box)
+            else:
+                page = Image.new(img.mode, (self.page_w_px, self.page_h_px), "white")
+            page.paste(fitted, (x, y))
+            self._pages[img.mode] = (page, box)
+        return page
+
+def compose_page(img, margin_in=0.5, page_w_in=8.5, page_h_in=11, dpi=DEFAULT_DPI, resample="lanczos"):
+    """
+    Scale a segment to fit inside the margins and center it on a new white page.
+    """
+    return PageComposer(margin_in, page_w_in, page_h_in, dpi, resample).compose(img)
+
+def _compose_and_encode(composers, settings, encoding, dedup, img):
+    # Runs in a compose worker thread, each with its own PageComposer and page buffer
+    composer = getattr(composers, "composer", None)
+    if composer is None:
+        composer = composers.composer = PageComposer(*settings)
+    page_img = composer.compose(img)
+    with stage("encode", pixels=page_img.width * page_img.height):
+        return encode_page(page_img, composer.dpi, encoding, dedup)
+
+def iter_pdf_pages(images, margin_in=0.5, page_w_in=8.5, page_h_in=11, dpi=DEFAULT_DPI,
+                   encoding=DEFAULT_ENCODING, output_dpi=None, resample="lanczos", compose_workers=1, dedup=False):
+    """
+    Compose and encode each segment as it arrives, yielding pages for pdf_writer.
+    Pages are composed at output_dpi (default: dpi) on a reused buffer. With
+    dedup, pages are split into strips of content (pdf_writer.StripPage) that
+    write_pdf() encodes once the whole document is known.
+    With compose_workers > 1, that many threads compose and encode (Pillow
+    releases the GIL for resizing, pasting and encoding) with at most
+    2 * compose_workers pages in flight; pages are still yielded in order.
+    """
+    settings = (margin_in, page_w_in, page_h_in, output_dpi or dpi, resample)
+    if compose_workers > 1:
+        work = partial(_compose_and_encode, threading.local(), settings, encoding, dedup)
+        yield from ordered_map(work, images, compose_workers, ThreadPoolExecutor)
+        return
+    composer = PageComposer(*settings)
+    for img in images:
+        page_img = composer.compose(img)
+        with stage("encode", pixels=page_img.width * page_img.height):
+            page = encode_page(page_img, composer.dpi, encoding, dedup)
+        yield page
+
+def create_pdf_from_images(images, output_pdf, margin_in=0.5, page_w_in=8.5, page_h_in=11, dpi=DEFAULT_DPI,
+                           encoding=DEFAULT_ENCODING, output_dpi=None, resample="lanczos", compose_workers=1,
+                           dedup=False):
+    """
+    Write segments to output_pdf (a path or binary file object), one page at a time.
+    images may be any iterable, including a generator of segments.
+    """
+    pages = iter_pdf_pages(images, margin_in=margin_in, page_w_in=page_w_in, page_h_in=page_h_in, dpi=dpi,
+                           encoding=encoding, output_dpi=output_dpi, resample=resample,
+                           compose_workers=compose_workers, dedup=dedup)
+    with stage("create_pdf") as info:
+        info["pages"] = write_pdf(pages, output_pdf)
+    if info["pages"]:
+        logger.info("Saved all pages to %s", output_pdf)
+
+def load_page_raster(pdf_path, page=1, dpi=DEFAULT_DPI, grayscale=False, backend="pdftoppm",
+                     raster_cache=None, digest=None, band_rows=None, preview_dpi=None, layout="raster"):
+    """
+    Cropped render of a page and its row-ink profile, reused from raster_cache when possible.
+    Without a cache this is load_page_array; with one the render is a read-only
+    memmap, so later steps only touch the rows they use. grayscale may be "auto"
+    (see resolve_grayscale) to keep colour only for pages that have some; it is
+    resolved only when the page is rendered, so a raster cache hit needs no
+    colour check.
+    With band_rows, a page taller than band_rows pixels is scanned in strips of that
+    height and returned as a banded.BandedPage that renders segments on demand.
+    With a preview_dpi below dpi, the crop box and profile come from a preview at
+    that resolution instead and only the segments are rendered at dpi.
+    With layout="text", a page that only paints text takes both from its text
+    layer (see textlayer) and nothing but the segments is rendered; other pages
+    fall back to the raster analysis.
+    """
+    if layout not in LAYOUT_SOURCES:
+        raise ValueError(f"Unknown layout source: {layout}")
+    if layout == "text":
+        from textlayer import load_text_page
+        loaded = load_text_page(pdf_path, page, dpi, grayscale, backend)
+        if loaded is not None:
+            return loaded
+    if preview_dpi and preview_dpi < dpi:
+        from banded import load_preview_page
+        return load_preview_page(pdf_path, page, dpi, preview_dpi,
+                                 resolve_grayscale(grayscale, pdf_path, page, backend), backend)
+    if band_rows:
+        from banded import load_banded_page, page_size_pixels
+        if page_size_pixels(pdf_path, page, dpi)[1] > band_rows:
+            return load_banded_page(pdf_path, page, dpi, band_rows,
+                                    resolve_grayscale(grayscale, pdf_path, page, backend), backend)
+    if raster_cache is None or not raster_cache.enabled:
+        return load_page_array(pdf_path, page, dpi, resolve_grayscale(grayscale, pdf_path, page, backend), backend)
+    # Keyed on the mode as requested, so "auto" is only resolved on a miss
+    key = raster_cache.key(digest or file_hash(pdf_path), page, dpi, grayscale, backend)
+    img = raster_cache.load(key)
+    counts = None
+    if img is None:
+        cropped, counts = load_page_array(pdf_path, page, dpi, resolve_grayscale(grayscale, pdf_path, page, backend),
+                                          backend)
+        img = raster_cache.store(key, cropped)
+        raster_cache.store_profile(key, WHITE_THRESHOLD, counts)
+    if counts is None:
+        counts = raster_cache.load_profile(key, WHITE_THRESHOLD)
+    if counts is None:
+        counts = row_ink_profile(img)
+        raster_cache.store_profile(key, WHITE_THRESHOLD, counts)
+    return img, counts
+
+def _raster_pages(pdf_path, page=1, aspect_w=8.5, aspect_h=11, dpi=DEFAULT_DPI, margin_in=0.5, grayscale=False,
+                  backend="pdftoppm", encoding=DEFAULT_ENCODING, raster_cache=None, digest=None, band_rows=None,
+                  preview_dpi=None, break_strategy="greedy", output_dpi=None, resample="lanczos", debug_lines=False,
+                  layout="raster", dedup=False, compose_workers=1):
+    # Crop, segment, compose and encode one page of a PDF; its encoded pages are generated lazily
+    cropped_img, counts = load_page_raster(pdf_path, page, dpi=dpi, grayscale=grayscale, backend=backend,
+                                           raster_cache=raster_cache, digest=digest, band_rows=band_rows,
+                                           preview_dpi=preview_dpi, layout=layout)
+    segments = segment_image_by_aspect_ratio(cropped_img, aspect_w, aspect_h, dpi=dpi, counts=counts,
+                                             strategy=break_strategy, debug_lines=debug_lines)
+    return iter_pdf_pages(segments, margin_in=margin_in, dpi=dpi, encoding=encoding, output_dpi=output_dpi,
+                          resample=resample, compose_workers=compose_workers, dedup=dedup)
+
+def cache_params(output_mode="raster", aspect_w=8.5, aspect_h=11, dpi=DEFAULT_DPI, margin_in=0.5,
+                 grayscale=False, backend="pdftoppm", encoding=DEFAULT_ENCODING, preview_dpi=None,
+                 first_page_only=False, break_strategy="greedy", output_dpi=None, resample="lanczos",
+                 debug_lines=False, layout="raster", dedup=False):
+    """
+    Every parameter that changes the output, for use in cache keys.
+    """
+    return {
+        "output_mode": output_mode,
+        "aspect": [aspect_w, aspect_h],
+        "dpi": dpi,
+        "margin_in": margin_in,
+        "threshold": WHITE_THRESHOLD,
+        "grayscale": grayscale,
+        "backend": backend,
+        "encoding": encoding,
+        "preview_dpi": preview_dpi,
+        "first_page_only": first_page_only,
+        "break_strategy": break_strategy,
+        "output_dpi": output_dpi or dpi,
+        "resample": resample,
+        "debug_lines": debug_lines,
+        "layout": layout,
+        "dedup": dedup,
+    }
+
+def process_page(pdf_path, page=1, output_mode="raster", aspect_w=8.5, aspect_h=11, dpi=DEFAULT_DPI,
+                 margin_in=0.5, grayscale=False, backend="pdftoppm", encoding=DEFAULT_ENCODING, preview_dpi=None,
+                 cache=None, digest=None, raster_cache=None, band_rows=None, break_strategy="greedy",
+                 output_dpi=None, resample="lanczos", debug_lines=False, layout="raster", dedup=False,
+                 compose_workers=1):
+    """
+    Produce the result for one page: its encoded pages (raster) or its segment plan (vector).
+    With an enabled cache the result is looked up by content hash, page and parameters
+    first, and stored after it is computed. Without one, raster pages are generated lazily.
+    """
+    key = None
+    if cache is not None and cache.enabled:
+        digest = digest or file_hash(pdf_path)
+        params = cache_params(output_mode, aspect_w=aspect_w, aspect_h=aspect_h, dpi=dpi, margin_in=margin_in,
+                              grayscale=grayscale, backend=backend, encoding=encoding, preview_dpi=preview_dpi,
+                              break_strategy=break_strategy, output_dpi=output_dpi, resample=resample,
+                              debug_lines=debug_lines, layout=layout, dedup=dedup)
+        key = cache_key("segments", digest, page, params)
+        result = cache.get("segments", key)
+        if result is not None:
+            if output_mode == "vector":
+                # The cached plan may come from an upload stored under another name
+                result = dict(result, pdf_path=pdf_path)
+            return result
+    if output_mode == "vector":
+        from vector_pdf import plan_pdf_page
+        # A vector plan is only layout, so it can come straight from the preview
+        result = plan_pdf_page(pdf_path, page, aspect_w=aspect_w, aspect_h=aspect_h,
+                               dpi=min(preview_dpi or dpi, dpi), band_rows=band_rows, strategy=break_strategy,
+                               layout=layout, backend=backend)
+    else:
+        pages = _raster_pages(pdf_path, page, aspect_w=aspect_w, aspect_h=aspect_h, dpi=dpi, margin_in=margin_in,
+                              grayscale=grayscale, backend=backend, encoding=encoding, raster_cache=raster_cache,
+                              digest=digest, band_rows=band_rows, preview_dpi=preview_dpi,
+                              break_strategy=break_strategy, output_dpi=output_dpi, resample=resample,
+                              debug_lines=debug_lines, layout=layout, dedup=dedup, compose_workers=compose_workers)
+        if key is None:
+            return pages
+        result = list(pages)
+    if key is not None:
+        # A plan refers to its input, which may be the upload's bytes; cache only the layout
+        cache.put("segments", key, dict(result, pdf_path=None) if output_mode == "vector" else result)
+    return result
+
+def _page_result(work, page):
+    # Runs in a page worker thread: finish the page there rather than lazily in the consumer
+    result = work(page)
+    return result if isinstance(result, (list, dict)) else list(result)
+
+def process_input(pdf_path, output_mode="raster", aspect_w=8.5, aspect_h=11, dpi=DEFAULT_DPI,
+                  margin_in=0.5, grayscale=False, backend="pdftoppm", encoding=DEFAULT_ENCODING, preview_dpi=None,
+                  cache=None, digest=None, raster_cache=None, band_rows=None, first_page_only=False,
+                  page_workers=1, break_strategy="greedy", output_dpi=None, resample="lanczos", debug_lines=False,
+                  layout="raster", dedup=False, compose_workers=1):
+    """
+    Produce the results for every page of one input in page order: its encoded pages
+    (raster) or a list with one segment plan per page (vector).
+    With page_workers > 1 that many pages are rendered and segmented at once by a
+    thread pool; otherwise pages are processed one after another and, without a
+    cache, raster pages are generated lazily.
+    """
+    if cache is not None and cache.enabled:
+        digest = digest or file_hash(pdf_path)
+    work = partial(process_page, pdf_path, output_mode=output_mode, aspect_w=aspect_w, aspect_h=aspect_h,
+                   dpi=dpi, margin_in=margin_in, grayscale=grayscale, backend=backend, encoding=encoding,
+                   preview_dpi=preview_dpi, cache=cache, digest=digest, raster_cache=raster_cache,
+                   band_rows=band_rows, break_strategy=break_strategy, output_dpi=output_dpi, resample=resample,
+                   debug_lines=debug_lines, layout=layout, dedup=dedup, compose_workers=compose_workers)
+    pages = page_numbers(pdf_path, first_page_only)
+    if page_workers > 1 and len(pages) > 1:
+        results = ordered_map(partial(_page_result, work), pages, page_workers, ThreadPoolExecutor)
+    else:
+        results = map(work, pages)
+    if output_mode == "vector":
+        return list(results)
+    return itertools.chain.from_iterable(results)
+
+def document_cache_key(pdf_paths, digests=None, **options):
+    """
+    Cache key of the merged PDF for an ordered list of inputs.
+    """
+    digests = digests or [file_hash(pdf_path) for pdf_path in pdf_paths]
+    return cache_key("documents", digests, cache_params(**options))
+
+def load_cached_document(pdf_paths, output_pdf, cache, digests=None, **options):
+    """
+    Write the cached merged PDF to output_pdf (path or file object).
+    Returns its page count, or None when it is not cached.
+    """
+    if cache is None or not cache.enabled:
+        return None
+    cached = cache.get("documents", document_cache_key(pdf_paths, digests, **options))
+    if cached is None:
+        return None
+    page_count, pdf_bytes = cached
+    if hasattr(output_pdf, "write"):
+        output_pdf.write(pdf_bytes)
+    else:
+        with open(output_pdf, "wb") as f:
+            f.write(pdf_bytes)
+    return page_count
+
+def store_cached_document(pdf_paths, output_pdf, page_count, cache, digests=None, **options):
+    if cache is None or not cache.enabled or not page_count:
+        return
+    with open(output_pdf, "rb") as f:
+        cache.put("documents", document_cache_key(pdf_paths, digests, **options), (page_count, f.read()))
+
+def format_pdfs(pdf_paths, output_pdf, output_mode="raster", aspect_w=8.5, aspect_h=11,
+                dpi=DEFAULT_DPI, margin_in=0.5, grayscale=False, backend="pdftoppm",
+                encoding=DEFAULT_ENCODING, preview_dpi=None, cache=None, lookup_document=True, raster_cache=None,
+                band_rows=None, first_page_only=False, page_workers=1, break_strategy="greedy", output_dpi=None,
+                resample="lanczos", debug_lines=False, layout="raster", dedup=False, compose_workers=1):
+    """
+    Run the whole pipeline over pdf_paths in order and write output_pdf.
+    Returns the number of pages written.
+    """
+    options = dict(output_mode=output_mode, aspect_w=aspect_w, aspect_h=aspect_h, dpi=dpi,
+                   margin_in=margin_in, grayscale=grayscale, backend=backend, encoding=encoding,
+                   preview_dpi=preview_dpi, first_page_only=first_page_only, break_strategy=break_strategy,
+                   output_dpi=output_dpi, resample=resample, debug_lines=debug_lines, layout=layout, dedup=dedup)
+    digests = [None] * len(pdf_paths)
+    if cache is not None and cache.enabled:
+        digests = [file_hash(pdf_path) for pdf_path in pdf_paths]
+        if lookup_document:
+            page_count = load_cached_document(pdf_paths, output_pdf, cache, digests, **options)
+            if page_count is not None:
+                return page_count
+    results = (
+        process_input(pdf_path, cache=cache, digest=digest, raster_cache=raster_cache, band_rows=band_rows,
+                      page_workers=page_workers, compose_workers=compose_workers, **options)
+        for pdf_path, digest in zip(pdf_paths, digests)
+    )
+    if output_mode == "vector":
+        from vector_pdf import create_vector_pdf
+        page_count = create_vector_pdf(itertools.chain.from_iterable(results), output_pdf, margin_in=margin_in)
+    else:
+        page_count = write_pdf(itertools.chain.from_iterable(results), output_pdf)
+    if not hasattr(output_pdf, "write"):
+        store_cached_document(pdf_paths, output_pdf, page_count, cache, digests, **options)
+    return page_count
+
+def find_pdfs(inputs):
+    """
+    Expand files and directories into a list of PDF paths.
+    Directory entries are sorted by name so the output order is stable.
+    """
+    pdf_paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            pdf_paths.extend(
+                os.path.join(path, fname)
+                for fname in sorted(os.listdir(path))
+                if fname.lower().endswith(".pdf")
+            )
+        else:
+            pdf_paths.append(path)
+    return pdf_paths
+
+def _process_page(task, cache_options=None, raster_cache_options=None, **options):
+    # Runs in a worker process: never raise, report the failure instead
+    pdf_path, page = task
+    cache = ResultCache(**cache_options) if cache_options else None
+    raster_cache = RasterCache(**raster_cache_options) if raster_cache_options else None
+    try:
+        result = process_page(pdf_path, page, cache=cache, raster_cache=raster_cache, **options)
+        if options.get("output_mode") != "vector":
+            result = list(result)
+        error = None
+    except Exception as exc:
+        result, error = None, f"{type(exc).__name__}: {exc}"
+    return pdf_path, page, result, error, cache.stats() if cache else None
+
+def ordered_map(func, items, jobs=1, executor=ProcessPoolExecutor):
+    """
+    Map func over items with up to jobs worker processes (or threads, with
+    executor=ThreadPoolExecutor), yielding results in input order.
+    At most 2 * jobs results are in flight at once.
+    """
+    if jobs <= 1:
+        yield from map(func, items)
+        return
+    with executor(max_workers=jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Crop and segment PDFs into 8.5x11 pages and merge them into a single PDF."
+    )
+    parser.add_argument("inputs", nargs="*", default=["PDFS"],
+                        help="PDF files or directories containing PDFs (default: PDFS)")
+    parser.add_argument("-o", "--output", default="output.pdf", help="output PDF path (default: output.pdf)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of worker processes, 0 for one per CPU (default: 1)")
+    parser.add_argument("--dpi", type=int, default=DEFAULT_DPI, help=f"render resolution (default: {DEFAULT_DPI})")
+    parser.add_argument("--margin", type=float, default=0.5, help="page margin in inches (default: 0.5)")
+    parser.add_argument("--grayscale", action="store_true", help="render pages in grayscale")
+    parser.add_argument("--auto-grayscale", action="store_true",
+                        help="render pages in grayscale unless a low-resolution preview shows colour")
+    parser.add_argument("--backend", choices=RENDER_BACKENDS, default="pdftoppm", help="poppler renderer")
+    parser.add_argument("--encoding", choices=tuple(ENCODING_PRESETS), default=DEFAULT_ENCODING,
+                        help="page encoding preset, from largest/most faithful to smallest (default: %(default)s)")
+    parser.add_argument("--output-mode", choices=("raster", "vector"), default="raster",
+                        help="rasterize segments or keep the original vector content")
+    parser.add_argument("--cache-dir", help="reuse results from this cache directory (disabled by default)")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help="maximum cache size in MB (default: %(default)s)")
+    parser.add_argument("--raster-cache-dir",
+                        help="keep memory-mapped page renders here and reuse them across runs")
+    parser.add_argument("--raster-cache-size", type=int, default=DEFAULT_RASTER_MAX_BYTES // (1024 * 1024),
+                        help="maximum raster cache size in MB (default: %(default)s)")
+    parser.add_argument("--compose-workers", type=int, default=1,
+                        help="threads that compose and encode the output pages of each worker process "
+                             "(default: 1)")
+    parser.add_argument("--preview-dpi", type=int, default=0,
+                        help="find the crop box and cut rows on a preview at this DPI and render only the "
+                             "segments at --dpi (default: 0, off; 75 works well)")
+    parser.add_argument("--band-rows", type=int, default=0,
+                        help="render pages taller than this many pixels in strips of this height, "
+                             "keeping memory bounded (default: 0, off)")
+    parser.add_argument("--breaks", choices=BREAK_STRATEGIES, default="greedy",
+                        help="page break planner: greedy cuts at the emptiest row of each page's last half "
+                             "inch; optimal picks all cuts at once to avoid cutting through text (default: greedy)")
+    parser.add_argument("--layout", choices=LAYOUT_SOURCES, default="raster",
+                        help="take the crop box and cut rows from the rendered page, or from the PDF text layer "
+                             "for pages that only paint text (default: raster)")
+    parser.add_argument("--output-dpi", type=int, default=0,
+                        help="resolution of the output pages (default: 0, same as --dpi)")
+    parser.add_argument("--max-page-pixels", type=int, default=0,
+                        help="lower the output resolution so a page has at most this many pixels (default: 0, off)")
+    parser.add_argument("--resample", choices=tuple(RESAMPLE_FILTERS), default="lanczos",
+                        help="filter used to scale segments onto pages, sharpest and slowest first "
+                             "(default: %(default)s)")
+    parser.add_argument("--dedup", action="store_true",
+                        help="encode pages as strips of content, skipping blank space, and store strips that "
+                             "repeat across pages and inputs once")
+    parser.add_argument("--debug-lines", action="store_true",
+                        help="draw a black line at the bottom of the content of each page's last segment")
+    parser.add_argument("--first-page-only", action="store_true",
+                        help="only process the first page of each input, as older versions did")
+    parser.add_argument("--incremental", metavar="STATE_DIR",
+                        help="keep a manifest and the segments of every input here and only reprocess "
+                             "new or changed inputs on the next run")
+    parser.add_argument("--watch", type=float, nargs="?", const=2.0, default=0, metavar="SECONDS",
+                        help="after building, poll the inputs every SECONDS (default: 2) and rebuild "
+                             "when they change, until interrupted")
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="DEBUG adds one JSON timing record per pipeline stage (default: INFO)")
+    return parser.parse_args(argv)
+
+def page_worker(cache=None, raster_cache=None, band_rows=None, compose_workers=1, **document_options):
+    """
+    The per-page worker for page_results(), with the caches reopened in each worker process.
+    """
+    page_options = {name: value for name, value in document_options.items() if name != "first_page_only"}
+    return partial(
+        _process_page,
+        cache_options=cache.options() if cache else None,
+        raster_cache_options=raster_cache.options() if raster_cache else None,
+        band_rows=band_rows,
+        compose_workers=compose_workers,
+        **page_options,
+    )
+
+def page_results(pdf_paths, worker, jobs=1, first_page_only=False, failures=None, cache=None):
+    """
+    Run worker over every page of pdf_paths on up to jobs processes and yield
+    (pdf_path, page, result) in order. Pages are the unit of work, so the pages
+    of one long document spread across workers. Failures are reported on
+    stderr and their paths appended to failures.
+    """
+    failures = failures if failures is not None else []
+
+    def page_tasks():
+        for pdf_path in pdf_paths:
+            try:
+                pages = page_numbers(pdf_path, first_page_only)
+            except Exception as exc:
+                print(f"Failed to process {pdf_path}: {type(exc).__name__}: {exc}", file=sys.stderr)
+                failures.append(pdf_path)
+                continue
+            for page in pages:
+                yield pdf_path, page
+
+    for pdf_path, page, result, error, cache_stats in ordered_map(worker, page_tasks(), jobs):
+        if cache is not None:
+            cache.merge_stats(cache_stats)
+        if error is not None:
+            print(f"Failed to process {pdf_path} (page {page}): {error}", file=sys.stderr)
+            if pdf_path not in failures:
+                failures.append(pdf_path)
+            continue
+        yield pdf_path, page, result
+
+def write_results(results, output_pdf, output_mode="raster", margin_in=0.5):
+    """
+    Write per-page results in order: encoded pages (raster) or segment plans (vector).
+    Returns the number of pages written.
+    """
+    if output_mode == "vector":
+        from vector_pdf import create_vector_pdf
+        return create_vector_pdf(results, output_pdf, margin_in=margin_in)
+    return write_pdf(itertools.chain.from_iterable(results), output_pdf)
+
+def build_merged_pdf(pdf_paths, output_pdf, jobs=1, cache=None, raster_cache=None, band_rows=None,
+                     compose_workers=1, **document_options):
+    """
+    Format pdf_paths into output_pdf for the command line and report progress.
+    Returns the exit status: 0, or 1 if any input failed.
+    """
+    if load_cached_document(pdf_paths, output_pdf, cache, **document_options) is not None:
+        print(f"Saved all pages to {output_pdf} (cached)")
+        return 0
+    failures = []
+    worker = page_worker(cache, raster_cache, band_rows, compose_workers, **document_options)
+    results = page_results(pdf_paths, worker, jobs, document_options.get("first_page_only", False), failures,
+                           cache)
+    page_count = write_results((result for _, _, result in results), output_pdf,
+                               document_options.get("output_mode", "raster"), document_options.get("margin_in", 0.5))
+    if page_count and document_options.get("output_mode") != "vector":
         print(f"Saved all pages to {output_pdf}")
+    if cache is not None:
+        if not failures:
+            store_cached_document(pdf_paths, output_pdf, page_count, cache, **document_options)
+        stats = cache.stats()
+        print("Cache: " + ", ".join(f"{kind} {c['hits']} hit(s) / {c['misses']} miss(es)" for kind, c in stats.items()))
+    if failures:
+        print(f"{len(failures)} of {len(pdf_paths)} file(s) failed", file=sys.stderr)
+        return 1
+    return 0
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+    for path in args.inputs:
+        if not os.path.exists(path):
+            print(f"Input not found: {path}", file=sys.stderr)
+            return 2
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    cache = None
+    if args.cache_dir:
+        cache = ResultCache(args.cache_dir, max_bytes=args.cache_size * 1024 * 1024)
+    raster_cache = None
+    if args.raster_cache_dir:
+        raster_cache = RasterCache(args.raster_cache_dir, max_bytes=args.raster_cache_size * 1024 * 1024)
+    document_options = dict(output_mode=args.output_mode, dpi=args.dpi, margin_in=args.margin,
+                            grayscale="auto" if args.auto_grayscale else args.grayscale, backend=args.backend,
+                            encoding=args.encoding,
+                            preview_dpi=args.preview_dpi or None, first_page_only=args.first_page_only,
+                            break_strategy=args.breaks,
+                            output_dpi=output_resolution(args.dpi, args.output_dpi, args.max_page_pixels),
+                            resample=args.resample, debug_lines=args.debug_lines, layout=args.layout,
+                            dedup=args.dedup)
+
+    def build():
+        # An output written into an input directory is not an input of the next build
+        pdf_paths = [path for path in find_pdfs(args.inputs)
+                     if os.path.abspath(path) != os.path.abspath(args.output)]
+        if args.incremental:
+            from incremental import build_incremental
+            return build_incremental(pdf_paths, args.output, args.incremental, jobs, cache, raster_cache,
+                                     args.band_rows or None, args.compose_workers, **document_options)
+        return build_merged_pdf(pdf_paths, args.output, jobs, cache, raster_cache, args.band_rows or None,
+                                args.compose_workers, **document_options)
+
+    status = build()
+    if args.watch:
+        from incremental import watch
+        watch(args.inputs, build, args.watch, ignore=(args.output,))
+    return status
 
 if __name__ == "__main__":
-    pdf_dir = "PDFS"
-    all_segments = []
-    for fname in os.listdir(pdf_dir):
-        if fname.lower().endswith(".pdf"):
-            pdf_path = os.path.join(pdf_dir, fname)
-            base = os.path.splitext(fname)[0]
-            cropped_img = crop_pdf_first_page(pdf_path)
-            segments = segment_image_by_aspect_ratio(cropped_img, 8.5, 11)
-            all_segments.extend(segments)
-    create_pdf_from_images(all_segments, "output.pdf")
\ No newline at end of file
+    sys.exit(main())
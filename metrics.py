@@ -0,0 +1,159 @@
+"""
+Per-stage timing and memory instrumentation.
+
+Each pipeline stage (render, crop, segmentation, compose, encode, ...) is
+wrapped in stage(), which records its duration, pixel and segment counts and
+the change in resident memory. Every record is logged as one JSON line on the
+"pdf_formatter.metrics" logger (DEBUG level) and aggregated in a process-wide
+registry that the web app exposes in the Prometheus text format at /metrics.
+
+Recording a stage costs two clock reads and two reads of /proc/self/statm, a
+few microseconds against stages that take milliseconds to seconds. Set
+PDF_FORMATTER_METRICS=0 to turn it off entirely.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger("pdf_formatter.metrics")
+
+# Upper bounds (seconds) of the stage duration histogram buckets
+BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def current_rss():
+    """
+    Resident set size of this process in bytes (peak RSS where /proc is unavailable).
+    """
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        if resource is None:
+            return 0
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if os.uname().sysname == "Darwin" else rss * 1024
+
+def _new_stage():
+    return {"count": 0, "seconds": 0.0, "buckets": [0] * len(BUCKETS), "pixels": 0, "segments": 0,
+            "rss_delta_bytes": 0, "bytes_saved": 0}
+
+class Metrics:
+    """
+    Thread-safe totals per stage. Snapshots can be shipped from worker
+    processes and merged into the parent's registry.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def observe(self, name, seconds, pixels=0, segments=0, rss_delta_bytes=0, bytes_saved=0):
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = _new_stage()
+            stage["count"] += 1
+            stage["seconds"] += seconds
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stage["buckets"][index] += 1
+                    break
+            stage["pixels"] += pixels
+            stage["segments"] += segments
+            stage["rss_delta_bytes"] += rss_delta_bytes
+            stage["bytes_saved"] += bytes_saved
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(stage, buckets=list(stage["buckets"])) for name, stage in self._stages.items()}
+
+    def drain(self):
+        """
+        Return the totals collected so far and reset them.
+        """
+        with self._lock:
+            stages, self._stages = self._stages, {}
+        return stages
+
+    def merge(self, snapshot):
+        """
+        Add totals collected by another process.
+        """
+        if not snapshot:
+            return
+        with self._lock:
+            for name, other in snapshot.items():
+                stage = self._stages.get(name)
+                if stage is None:
+                    stage = self._stages[name] = _new_stage()
+                for field in ("count", "seconds", "pixels", "segments", "rss_delta_bytes", "bytes_saved"):
+                    stage[field] += other.get(field, 0)
+                stage["buckets"] = [a + b for a, b in zip(stage["buckets"], other["buckets"])]
+
+    def render_prometheus(self):
+        """
+        All totals in the Prometheus text exposition format.
+        """
+        stages = self.snapshot()
+        lines = [
+            "# HELP pdf_formatter_stage_seconds Time spent in each pipeline stage.",
+            "# TYPE pdf_formatter_stage_seconds histogram",
+        ]
+        for name, stage in sorted(stages.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, stage["buckets"]):
+                cumulative += count
+                lines.append(f'pdf_formatter_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'pdf_formatter_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {stage["count"]}')
+            lines.append(f'pdf_formatter_stage_seconds_sum{{stage="{name}"}} {stage["seconds"]:.6f}')
+            lines.append(f'pdf_formatter_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+        for field, help_text in (
+            ("pixels", "Pixels processed by each stage."),
+            ("segments", "Segments produced by each stage."),
+            ("rss_delta_bytes", "Sum of resident memory changes across each stage."),
+            ("bytes_saved", "Bytes of images referenced again instead of being written again."),
+        ):
+            metric = f"pdf_formatter_stage_{field}_total"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, stage in sorted(stages.items()):
+                lines.append(f'{metric}{{stage="{name}"}} {stage[field]}')
+        lines.append("# HELP pdf_formatter_resident_memory_bytes Resident memory of the serving process.")
+        lines.append("# TYPE pdf_formatter_resident_memory_bytes gauge")
+        lines.append(f"pdf_formatter_resident_memory_bytes {current_rss()}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics(enabled=os.environ.get("PDF_FORMATTER_METRICS", "1") != "0")
+
+@contextmanager
+def stage(name, **fields):
+    """
+    Time the enclosed block as pipeline stage name.
+    Yields a dict; set "pixels", "segments" or "bytes_saved" (or any other field for the log) in it.
+    """
+    if not METRICS.enabled:
+        yield fields
+        return
+    rss_before = current_rss()
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        seconds = time.perf_counter() - start
+        rss_delta = current_rss() - rss_before
+        METRICS.observe(name, seconds, fields.get("pixels", 0), fields.get("segments", 0), rss_delta,
+                        fields.get("bytes_saved", 0))
+        if logger.isEnabledFor(logging.DEBUG):
+            record = {"event": "stage", "stage": name, "seconds": round(seconds, 6), "rss_delta_bytes": rss_delta}
+            record.update(fields)
+            logger.debug(json.dumps(record, default=str))
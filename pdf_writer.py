@@ -0,0 +1,473 @@
+"""
+Incremental PDF writer for composed pages.
+
+Pages are encoded and written to the output as soon as they are added, so a
+document of any length only ever needs one page image in memory. The page
+tree, catalog and cross-reference table are written when the writer is closed.
+
+Each composed page is classified as bilevel, grayscale or colour from its
+histogram and stored in the cheapest suitable form: 1-bit CCITT G4 (or Flate),
+8-bit gray, or RGB JPEG. An encoding preset trades size against fidelity.
+
+Identical images are written once and shared by every page that shows them.
+With dedup, a page is split into strips of content at white gaps, so blank
+space is not encoded at all. The split pages wait for the rest of the document
+(share_strips), and a header, footer or diagram that occurs more than once in
+it is encoded once (ImageMemo) and stored once, first occurrence included.
+"""
+import hashlib
+import io
+import logging
+import threading
+import zlib
+from collections import Counter, OrderedDict, deque, namedtuple
+import numpy as np
+from PIL import Image, ImageChops, features
+from metrics import stage
+
+logger = logging.getLogger("pdf_formatter")
+
+POINTS_PER_INCH = 72
+
+# An encoded raster ready to be written as a PDF image XObject
+EncodedImage = namedtuple("EncodedImage", "data filter width height colorspace bits decode_parms",
+                          defaults=(None,))
+# A page of width x height points; placements are (x, y, w, h, EncodedImage) in points
+EncodedPage = namedtuple("EncodedPage", "width height placements")
+# A page encoded with dedup, waiting for the rest of its document (see
+# share_strips): the page class and encoding preset, and its strips of content
+Strip = namedtuple("Strip", "box digest data")
+StripPage = namedtuple("StripPage", "width height dpi kind encoding strips")
+
+COLORSPACES = {"1": "DeviceGray", "L": "DeviceGray", "RGB": "DeviceRGB"}
+
+# bilevel_ratio: a page is stored as 1-bit when its mid-tone pixels (64..191)
+# are at most this fraction of its ink; anti-aliased text is about 0.2-0.35.
+# gray_filter: how 8-bit gray pages are compressed.
+ENCODING_PRESETS = {
+    "quality": {"bilevel_ratio": 0.01, "gray_filter": "FlateDecode", "jpeg_quality": 90},
+    "balanced": {"bilevel_ratio": 0.4, "gray_filter": "DCTDecode", "jpeg_quality": 75},
+    "small": {"bilevel_ratio": 0.55, "gray_filter": "DCTDecode", "jpeg_quality": 50},
+}
+DEFAULT_ENCODING = "balanced"
+# A pixel whose channels differ by more than this is coloured
+CHROMA_THRESHOLD = 24
+# Pages with fewer coloured pixels than this fraction are treated as gray
+COLOR_FRACTION = 0.0005
+# Gray values below this become black in 1-bit pages
+BILEVEL_THRESHOLD = 128
+BILEVEL_LUT = [0] * BILEVEL_THRESHOLD + [255] * (256 - BILEVEL_THRESHOLD)
+# Colour is detected on a copy reduced by this factor; a one-pixel coloured
+# line still stands out after averaging
+COLOR_SAMPLE_FACTOR = 4
+# The gray histogram is taken over every n-th row
+HISTOGRAM_ROW_STEP = 4
+HAS_CCITT = features.check("libtiff")
+# With dedup, a page is split into strips at runs of at least this much white
+STRIP_GAP_IN = 0.1
+# Encoded bytes ImageMemo keeps for reuse
+MEMO_MAX_BYTES = 64 * 1024 * 1024
+
+def _fmt(value):
+    return f"{value:.4f}".rstrip("0").rstrip(".")
+
+def classify_page(img, bilevel_ratio=ENCODING_PRESETS[DEFAULT_ENCODING]["bilevel_ratio"]):
+    """
+    Classify a page image as "bilevel", "gray" or "color" from its histograms.
+    Returns the class and the page as a grayscale image (None for colour).
+    """
+    if img.mode not in ("L", "RGB"):
+        img = img.convert("RGB")
+    if img.mode == "RGB":
+        sample = img.reduce(COLOR_SAMPLE_FACTOR) if min(img.size) >= 64 * COLOR_SAMPLE_FACTOR else img
+        r, g, b = sample.split()
+        chroma = ImageChops.lighter(ImageChops.difference(r, g), ImageChops.difference(g, b)).histogram()
+        if sum(chroma[CHROMA_THRESHOLD + 1:]) > COLOR_FRACTION * sample.width * sample.height:
+            return "color", None
+        gray = img.convert("L")
+    else:
+        gray = img
+    hist = np.bincount(np.asarray(gray)[::HISTOGRAM_ROW_STEP].ravel(), minlength=256)
+    ink = hist[:224].sum()
+    if hist[64:192].sum() <= bilevel_ratio * ink:
+        return "bilevel", gray
+    return "gray", gray
+
+def encode_jpeg(img, quality=75):
+    """
+    JPEG (DCTDecode) for grayscale or RGB images.
+    """
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=quality)
+    return EncodedImage(buf.getvalue(), "DCTDecode", img.width, img.height, COLORSPACES[img.mode], 8)
+
+def encode_flate(img):
+    """
+    Lossless Flate of the raw samples (1-bit rows are packed, 1 = white).
+    """
+    bits = 1 if img.mode == "1" else 8
+    return EncodedImage(zlib.compress(img.tobytes(), 6), "FlateDecode", img.width, img.height,
+                        COLORSPACES[img.mode], bits)
+
+def encode_ccitt(img):
+    """
+    CCITT Group 4 for a 1-bit image, taken from a single-strip TIFF written by libtiff.
+    Returns None if the TIFF does not come out as one strip.
+    """
+    buf = io.BytesIO()
+    img.save(buf, "TIFF", compression="group4", tiffinfo={278: img.height})
+    with Image.open(buf) as tiff:
+        offsets = tiff.tag_v2.get(273)
+        counts = tiff.tag_v2.get(279)
+    if offsets is None or len(offsets) != 1:
+        return None
+    data = buf.getvalue()[offsets[0]:offsets[0] + counts[0]]
+    parms = f"<< /K -1 /Columns {img.width} /Rows {img.height} /BlackIs1 true >>"
+    return EncodedImage(data, "CCITTFaxDecode", img.width, img.height, "DeviceGray", 1, parms)
+
+def encode_bilevel(gray):
+    bilevel = gray.point(BILEVEL_LUT, "1")
+    encoded = encode_ccitt(bilevel) if HAS_CCITT else None
+    return encoded or encode_flate(bilevel)
+
+def encode_as(img, kind, encoding=DEFAULT_ENCODING):
+    """
+    Encode img as classified by classify_page: img is the grayscale image for
+    "bilevel" and "gray", and the page itself for "color".
+    """
+    preset = ENCODING_PRESETS[encoding]
+    if kind == "bilevel":
+        return encode_bilevel(img)
+    if kind == "gray":
+        if preset["gray_filter"] == "FlateDecode":
+            return encode_flate(img)
+        return encode_jpeg(img, preset["jpeg_quality"])
+    return encode_jpeg(img if img.mode == "RGB" else img.convert("RGB"), preset["jpeg_quality"])
+
+def encode_image(img, encoding=DEFAULT_ENCODING):
+    """
+    Encode a page image in the smallest form the encoding preset allows.
+    """
+    kind, gray = classify_page(img, ENCODING_PRESETS[encoding]["bilevel_ratio"])
+    return encode_as(img if gray is None else gray, kind, encoding)
+
+def content_strips(arr, min_gap):
+    """
+    Boxes (x0, y0, x1, y1) of the bands of a page array that hold anything but
+    pure white, split at runs of at least min_gap white rows and trimmed to
+    their non-white columns.
+    """
+    rows = arr.reshape(arr.shape[0], -1).min(axis=1) < 255
+    ink = np.flatnonzero(rows)
+    if ink.size == 0:
+        return []
+    # A new strip starts wherever the white run before a row is long enough
+    starts = np.flatnonzero(np.diff(ink) > min_gap) + 1
+    boxes = []
+    for first, last in zip(np.r_[0, starts], np.r_[starts, ink.size]):
+        y0, y1 = int(ink[first]), int(ink[last - 1]) + 1
+        band = arr[y0:y1].min(axis=0)
+        cols = np.flatnonzero((band if band.ndim == 1 else band.min(axis=1)) < 255)
+        boxes.append((int(cols[0]), y0, int(cols[-1]) + 1, y1))
+    return boxes
+
+class ImageMemo:
+    """
+    Encoded images by digest of their pixels, so a raster seen before is not
+    encoded again. Least recently used entries are dropped beyond max_bytes of
+    encoded data. Thread-safe; one per process is shared by every document,
+    which only saves time: the same pixels always encode to the same bytes.
+    """
+    def __init__(self, max_bytes=MEMO_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "bytes_saved": 0}
+
+    @staticmethod
+    def digest(arr):
+        arr = np.ascontiguousarray(arr)
+        digest = hashlib.blake2b(repr(arr.shape).encode("ascii"), digest_size=16)
+        digest.update(arr)
+        return digest.hexdigest()
+
+    def encode(self, arr, kind, encoding=DEFAULT_ENCODING, digest=None):
+        """
+        encode_as() of the uint8 array arr, reused when the same pixels were encoded the same way before.
+        """
+        key = (digest or self.digest(arr), kind, encoding)
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                self._stats["bytes_saved"] += len(encoded.data)
+                return encoded
+            self._stats["misses"] += 1
+        encoded = encode_as(Image.fromarray(np.ascontiguousarray(arr)), kind, encoding)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = encoded
+                self._bytes += len(encoded.data)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, dropped = self._entries.popitem(last=False)
+                self._bytes -= len(dropped.data)
+        return encoded
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+IMAGE_MEMO = ImageMemo()
+
+def encode_page(page_img, dpi, encoding=DEFAULT_ENCODING, dedup=False):
+    """
+    Encode a composed full-page image as a page of page_img.size / dpi inches.
+    With dedup, blank space is left out: the page is split into strips of
+    content and returned as a StripPage, which write_pdf() and stream_pdf()
+    encode once the whole document is known (see share_strips). Every strip is
+    encoded in the class of the whole page, so small strips are not misjudged.
+    """
+    width = page_img.width * POINTS_PER_INCH / dpi
+    height = page_img.height * POINTS_PER_INCH / dpi
+    if not dedup:
+        return EncodedPage(width, height, [(0, 0, width, height, encode_image(page_img, encoding))])
+    kind, gray = classify_page(page_img, ENCODING_PRESETS[encoding]["bilevel_ratio"])
+    if gray is None and page_img.mode != "RGB":
+        page_img = page_img.convert("RGB")
+    arr = np.asarray(page_img if gray is None else gray)
+    strips = []
+    for x0, y0, x1, y1 in content_strips(arr, int(STRIP_GAP_IN * dpi)):
+        strip = np.ascontiguousarray(arr[y0:y1, x0:x1])
+        # Kept compressed (losslessly, and fast) until the document is complete
+        strips.append(Strip((x0, y0, x1, y1), ImageMemo.digest(strip), zlib.compress(strip, 1)))
+    return StripPage(width, height, dpi, kind, encoding, strips)
+
+def _group_strips(strips, repeated):
+    # (box, strips) per image: a repeated strip is an image of its own so it can
+    # be shared, and each run of strips in between is merged into one box
+    groups = []
+    merging = False
+    for strip in strips:
+        if strip.digest in repeated or not merging:
+            groups.append((strip.box, [strip]))
+            merging = strip.digest not in repeated
+            continue
+        (x0, y0, x1, _), members = groups[-1]
+        groups[-1] = ((min(x0, strip.box[0]), y0, max(x1, strip.box[2]), strip.box[3]), members + [strip])
+    return groups
+
+def _strip_pixels(strip, channels):
+    x0, y0, x1, y1 = strip.box
+    shape = (y1 - y0, x1 - x0) + ((channels,) if channels > 1 else ())
+    return np.frombuffer(zlib.decompress(strip.data), dtype=np.uint8).reshape(shape)
+
+def _encode_strips(page, repeated, memo):
+    # The EncodedPage of a StripPage; everything between strips is white
+    scale = POINTS_PER_INCH / page.dpi
+    channels = 3 if page.kind == "color" else 1
+    placements = []
+    for (x0, y0, x1, y1), strips in _group_strips(page.strips, repeated):
+        if len(strips) == 1:
+            arr, digest = _strip_pixels(strips[0], channels), strips[0].digest
+        else:
+            arr = np.full((y1 - y0, x1 - x0) + ((channels,) if channels > 1 else ()), 255, dtype=np.uint8)
+            for strip in strips:
+                sx0, sy0, sx1, sy1 = strip.box
+                arr[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = _strip_pixels(strip, channels)
+            digest = None
+        encoded = memo.encode(arr, page.kind, page.encoding, digest)
+        placements.append((x0 * scale, page.height - y1 * scale, (x1 - x0) * scale, (y1 - y0) * scale, encoded))
+    return EncodedPage(page.width, page.height, placements)
+
+def share_strips(pages, memo=None):
+    """
+    EncodedPages for one document, in order. EncodedPages pass straight
+    through; from the first StripPage on, the rest of the document is read
+    first, so that a strip occurring more than once anywhere in it becomes an
+    image of its own from its first occurrence on and is stored once. Runs of
+    other strips are encoded together, so a page with nothing repeated stays
+    about one image. Encoded bytes are reused through memo (IMAGE_MEMO by
+    default); the output depends on the document alone.
+    """
+    memo = memo or IMAGE_MEMO
+    pages = iter(pages)
+    for page in pages:
+        if isinstance(page, StripPage):
+            break
+        yield page
+    else:
+        return
+    document = deque([page])
+    document.extend(pages)
+    counts = Counter(strip.digest for page in document if isinstance(page, StripPage) for strip in page.strips)
+    repeated = {digest for digest, count in counts.items() if count > 1}
+    while document:
+        page = document.popleft()
+        if isinstance(page, StripPage):
+            pixels = sum((x1 - x0) * (y1 - y0) for (x0, y0, x1, y1), _, _ in page.strips)
+            with stage("encode_strips", pixels=pixels):
+                page = _encode_strips(page, repeated, memo)
+        yield page
+
+class PdfStreamWriter:
+    """
+    Write EncodedPages to a binary file object one at a time.
+    Call close() (or use as a context manager) to finish the document.
+    An image identical to one already written is referenced instead of written
+    again; images_reused and bytes_saved count those.
+    """
+    CATALOG_ID = 1
+    PAGES_ID = 2
+
+    def __init__(self, out):
+        self._out = out
+        self._offset = 0
+        self._offsets = {}
+        self._next_id = self.PAGES_ID + 1
+        self._page_ids = []
+        # digest of an encoded image -> its object id
+        self._images = {}
+        self.images_reused = 0
+        self.bytes_saved = 0
+        self._closed = False
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    @property
+    def page_count(self):
+        return len(self._page_ids)
+
+    def _write(self, data):
+        self._out.write(data)
+        self._offset += len(data)
+
+    def _new_id(self):
+        obj_id = self._next_id
+        self._next_id += 1
+        return obj_id
+
+    def _write_object(self, obj_id, body, stream=None):
+        self._offsets[obj_id] = self._offset
+        self._write(f"{obj_id} 0 obj\n".encode("ascii"))
+        if stream is None:
+            self._write(body.encode("ascii") + b"\nendobj\n")
+            return
+        self._write(body[:-2].encode("ascii") + f" /Length {len(stream)} >>\nstream\n".encode("ascii"))
+        self._write(stream)
+        self._write(b"\nendstream\nendobj\n")
+
+    def _write_image(self, image):
+        body = (
+            f"<< /Type /XObject /Subtype /Image /Width {image.width} /Height {image.height} "
+            f"/ColorSpace /{image.colorspace} /BitsPerComponent {image.bits} /Filter /{image.filter}"
+        )
+        if image.decode_parms:
+            body += f" /DecodeParms {image.decode_parms}"
+        body += " >>"
+        digest = hashlib.blake2b(body.encode("ascii") + image.data, digest_size=16).digest()
+        obj_id = self._images.get(digest)
+        if obj_id is not None:
+            self.images_reused += 1
+            self.bytes_saved += len(image.data)
+            return obj_id, len(image.data)
+        obj_id = self._images[digest] = self._new_id()
+        self._write_object(obj_id, body, image.data)
+        return obj_id, 0
+
+    def add_page(self, page):
+        """
+        Write one EncodedPage (its images, content stream and page object) and flush it.
+        """
+        with stage("write") as info:
+            xobjects = []
+            ops = []
+            saved = 0
+            for index, (x, y, w, h, image) in enumerate(page.placements):
+                name = f"Im{index}"
+                obj_id, reused = self._write_image(image)
+                saved += reused
+                xobjects.append(f"/{name} {obj_id} 0 R")
+                ops.append(f"q {_fmt(w)} 0 0 {_fmt(h)} {_fmt(x)} {_fmt(y)} cm /{name} Do Q")
+            content_id = self._new_id()
+            self._write_object(content_id, "<< >>", "\n".join(ops).encode("ascii"))
+            page_id = self._new_id()
+            self._write_object(
+                page_id,
+                f"<< /Type /Page /Parent {self.PAGES_ID} 0 R "
+                f"/MediaBox [0 0 {_fmt(page.width)} {_fmt(page.height)}] "
+                f"/Resources << /XObject << {' '.join(xobjects)} >> >> /Contents {content_id} 0 R >>",
+            )
+            self._page_ids.append(page_id)
+            info["bytes_saved"] = saved
+        if hasattr(self._out, "flush"):
+            self._out.flush()
+
+    def close(self):
+        """
+        Write the page tree, catalog, cross-reference table and trailer.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        kids = " ".join(f"{page_id} 0 R" for page_id in self._page_ids)
+        self._write_object(self.PAGES_ID, f"<< /Type /Pages /Kids [{kids}] /Count {len(self._page_ids)} >>")
+        self._write_object(self.CATALOG_ID, f"<< /Type /Catalog /Pages {self.PAGES_ID} 0 R >>")
+        xref_offset = self._offset
+        size = self._next_id
+        lines = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+        for obj_id in range(1, size):
+            lines.append(f"{self._offsets[obj_id]:010d} 00000 n \n")
+        lines.append(f"trailer\n<< /Size {size} /Root {self.CATALOG_ID} 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n")
+        self._write("".join(lines).encode("ascii"))
+        if hasattr(self._out, "flush"):
+            self._out.flush()
+        if self.images_reused:
+            logger.info("Shared %d repeated image(s), saving %.1f KB", self.images_reused, self.bytes_saved / 1024)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+def write_pdf(pages, output_pdf):
+    """
+    Write an iterable of EncodedPages (or StripPages) to a path or binary file object.
+    Nothing is created when there are no pages. Returns the page count.
+    """
+    pages = share_strips(pages)
+    first = next(pages, None)
+    if first is None:
+        return 0
+    if hasattr(output_pdf, "write"):
+        return _write_all(PdfStreamWriter(output_pdf), first, pages)
+    with open(output_pdf, "wb") as f:
+        return _write_all(PdfStreamWriter(f), first, pages)
+
+def _write_all(writer, first, pages):
+    with writer:
+        writer.add_page(first)
+        for page in pages:
+            writer.add_page(page)
+    return writer.page_count
+
+def stream_pdf(pages):
+    """
+    Generate the bytes of a PDF, yielding a chunk as soon as each page is written.
+    StripPages are written once the whole document has been produced.
+    """
+    buf = io.BytesIO()
+    writer = PdfStreamWriter(buf)
+    for page in share_strips(pages):
+        writer.add_page(page)
+        yield _drain(buf)
+    writer.close()
+    yield _drain(buf)
+
+def _drain(buf):
+    data = buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    return data
@@ -0,0 +1,135 @@
+"""
+In-process formatting API.
+
+Pipeline runs the raster pipeline on PDFs given as bytes, paths or binary file
+objects and returns the result without touching the disk: composed page
+images, encoded pages, the output PDF as bytes, or a stream of PDF chunks.
+
+    pipeline = Pipeline(dpi=200, page_w_in=8.27, page_h_in=11.69, aspect_w=8.27, aspect_h=11.69)
+    pdf_bytes = pipeline.run(request_body)
+
+Each stage is a method that can be replaced by passing a callable of the same
+signature to the constructor, or by overriding it in a subclass:
+
+- render(source, page) -> PIL image of one page
+- crop(img) -> (cropped image, row-ink profile or None)
+- segment(img, counts) -> iterable of page-sized segments
+- compose(segment) -> PIL image of an output page
+- encode(page_img) -> pdf_writer.EncodedPage (StripPage with dedup)
+
+With layout="text", pages that only paint text take their crop box and cut
+rows from the PDF text layer instead of the render and crop stages.
+
+dedup=True encodes pages as strips of content and stores a strip repeated
+anywhere in the output once (see pdf_writer.share_strips); the output is then
+written when the last page is done. Repeated images are stored once either way.
+
+grayscale="auto" renders a page in colour only when a low-resolution preview
+of it shows colour.
+
+A Pipeline holds a reused page buffer (PageComposer), so use one per thread.
+"""
+import io
+import os
+from pdf_writer import DEFAULT_ENCODING, encode_page, stream_pdf, write_pdf
+from merge import (DEFAULT_DPI, PageComposer, find_content_bbox, page_numbers, render_pdf_page,
+                   resolve_grayscale, segment_image_by_aspect_ratio)
+from metrics import stage
+from textlayer import load_text_page
+
+STAGES = ("render", "crop", "segment", "compose", "encode")
+
+class Pipeline:
+    def __init__(self, aspect_w=8.5, aspect_h=11, dpi=DEFAULT_DPI, margin_in=0.5, page_w_in=8.5, page_h_in=11,
+                 grayscale=False, backend="pdftoppm", encoding=DEFAULT_ENCODING, break_strategy="greedy",
+                 output_dpi=None, resample="lanczos", debug_lines=False, first_page_only=False, layout="raster",
+                 dedup=False, **stages):
+        unknown = set(stages) - set(STAGES)
+        if unknown:
+            raise TypeError(f"Unknown pipeline stage(s): {', '.join(sorted(unknown))}")
+        self.aspect_w = aspect_w
+        self.aspect_h = aspect_h
+        self.dpi = dpi
+        self.grayscale = grayscale
+        self.backend = backend
+        self.encoding = encoding
+        self.break_strategy = break_strategy
+        self.debug_lines = debug_lines
+        self.first_page_only = first_page_only
+        self.layout = layout
+        self.dedup = dedup
+        self.composer = PageComposer(margin_in, page_w_in, page_h_in, output_dpi or dpi, resample)
+        for name, func in stages.items():
+            setattr(self, name, func)
+
+    def render(self, source, page):
+        grayscale = resolve_grayscale(self.grayscale, source, page, self.backend)
+        return render_pdf_page(source, page=page, dpi=self.dpi, grayscale=grayscale, backend=self.backend)
+
+    def crop(self, img):
+        with stage("crop", pixels=img.width * img.height):
+            bbox = find_content_bbox(img)
+            return (img if bbox is None else img.crop(bbox)), None
+
+    def segment(self, img, counts=None):
+        return segment_image_by_aspect_ratio(img, self.aspect_w, self.aspect_h, self.dpi, counts,
+                                             self.break_strategy, self.debug_lines)
+
+    def compose(self, segment):
+        return self.composer.compose(segment)
+
+    def encode(self, page_img):
+        with stage("encode", pixels=page_img.width * page_img.height):
+            return encode_page(page_img, self.composer.dpi, self.encoding, self.dedup)
+
+    def segments(self, sources):
+        """
+        Segments of every page of every source, in order; one rendered page is held at a time.
+        sources is one PDF (bytes, path or binary file object) or a list of them.
+        """
+        if isinstance(sources, (bytes, bytearray, str, os.PathLike)) or hasattr(sources, "read"):
+            sources = [sources]
+        for source in sources:
+            if hasattr(source, "read"):
+                source = source.read()
+            elif isinstance(source, bytearray):
+                source = bytes(source)
+            for page in page_numbers(source, self.first_page_only):
+                loaded = None
+                if self.layout == "text":
+                    # Text-only pages skip render and crop; only their segments are rendered
+                    loaded = load_text_page(source, page, self.dpi, self.grayscale, self.backend)
+                cropped, counts = loaded or self.crop(self.render(source, page))
+                yield from self.segment(cropped, counts)
+
+    def images(self, sources):
+        """
+        Composed output pages as PIL images. Each one is a copy, so they can be kept.
+        """
+        for segment in self.segments(sources):
+            yield self.compose(segment).copy()
+
+    def pages(self, sources):
+        """
+        Encoded output pages (pdf_writer.EncodedPage, or StripPage with dedup), ready
+        for write_pdf() or stream_pdf().
+        """
+        for segment in self.segments(sources):
+            yield self.encode(self.compose(segment))
+
+    def stream(self, sources):
+        """
+        The output PDF as an iterator of byte chunks, produced while pages are processed.
+        """
+        return stream_pdf(self.pages(sources))
+
+    def run(self, sources, output=None):
+        """
+        Format sources into one PDF. Returns its bytes, or with output (a path or
+        binary file object) writes it there and returns the page count.
+        """
+        if output is not None:
+            return write_pdf(self.pages(sources), output)
+        buf = io.BytesIO()
+        write_pdf(self.pages(sources), buf)
+        return buf.getvalue()
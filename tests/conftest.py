@@ -0,0 +1,22 @@
+import os
+import sys
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pdf_writer import encode_page, write_pdf
+
+@pytest.fixture
+def make_pdf(tmp_path):
+    """
+    Write a PDF of the given PIL images (or of that many blank pages), one per
+    page at 72 DPI, and return its path.
+    """
+    def make(images, name="input.pdf"):
+        if isinstance(images, int):
+            images = [Image.new("L", (72, 96), "white") for _ in range(images)]
+        path = tmp_path / name
+        write_pdf([encode_page(img, 72) for img in images], str(path))
+        return str(path)
+    return make
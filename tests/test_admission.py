@@ -0,0 +1,59 @@
+import threading
+import pytest
+from admission import MemoryBudget, UnreadablePdf, estimate_request_bytes, page_cost
+
+LETTER_PAGE = 612 * 792
+
+def test_page_cost_counts_render_crop_and_segment():
+    # The render and its cropped copy, plus one segment as tall as the page
+    assert page_cost(612, 792, 72) == 3 * LETTER_PAGE * 3
+    assert page_cost(612, 792, 72, grayscale=True) == 3 * LETTER_PAGE
+    # A band, its grayscale copy and ink mask stand in for the whole render
+    assert page_cost(612, 792, 72, grayscale=True, band_rows=100) == 612 * 100 * 4 + LETTER_PAGE
+
+def test_estimate_counts_composers_of_every_page_in_flight(make_pdf):
+    pdf_path = make_pdf(3)
+    worst = page_cost(72, 96, 72, grayscale=True)
+    composer = 2 * LETTER_PAGE
+    assert estimate_request_bytes([pdf_path], 72, grayscale=True) == worst + composer
+    assert estimate_request_bytes([pdf_path], 72, grayscale=True, page_workers=2, compose_workers=3) == \
+        2 * (worst + 3 * composer)
+    # No more pages in flight than the input has
+    assert estimate_request_bytes([pdf_path], 72, grayscale=True, page_workers=8) == 3 * (worst + composer)
+    assert estimate_request_bytes([pdf_path], 72, grayscale=True, page_workers=8, first_page_only=True) == \
+        worst + composer
+
+def test_estimate_refuses_unreadable_sources(make_pdf):
+    with pytest.raises(UnreadablePdf) as excinfo:
+        estimate_request_bytes([make_pdf(1), b"not a pdf"], 72)
+    assert excinfo.value.index == 1
+    assert str(excinfo.value).startswith("File 2 is not a readable PDF")
+
+def test_budget_limits_bytes_and_slots():
+    budget = MemoryBudget(100, max_concurrent=2)
+    assert budget.acquire(60, timeout=0)
+    assert not budget.acquire(50, timeout=0)
+    assert budget.acquire(40, timeout=0)
+    assert budget.usage() == (100, 2)
+    budget.release(40)
+    assert budget.acquire(0, timeout=0)
+    # Both slots are taken, however little is asked for
+    assert not budget.acquire(0, timeout=0)
+    budget.release(60)
+    budget.release(0)
+    assert budget.usage() == (0, 0)
+    # An estimate above the whole budget is charged as the whole budget
+    assert budget.acquire(500, timeout=0)
+    assert budget.usage() == (100, 1)
+    budget.release(500)
+    assert budget.usage() == (0, 0)
+
+def test_budget_wakes_waiters_on_release():
+    budget = MemoryBudget(100, max_concurrent=4)
+    assert budget.acquire(100)
+    admitted = []
+    waiter = threading.Thread(target=lambda: admitted.append(budget.acquire(50, timeout=30)))
+    waiter.start()
+    budget.release(100)
+    waiter.join()
+    assert admitted == [True] and budget.usage() == (50, 1)
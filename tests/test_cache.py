@@ -0,0 +1,78 @@
+import os
+import pickle
+import numpy as np
+import pytest
+from cache import ResultCache, pack_entry, private_dir, unpack_entry
+from pdf_writer import EncodedImage, EncodedPage, Strip, StripPage
+
+def _pages():
+    shared = EncodedImage(b"\x00\xff" * 8, "FlateDecode", 4, 4, "DeviceGray", 8)
+    other = EncodedImage(b"jpeg", "DCTDecode", 2, 2, "DeviceRGB", 8, "<< /K -1 >>")
+    return [
+        EncodedPage(612.0, 792.0, [(0, 0, 612.0, 792.0, shared)]),
+        EncodedPage(612.0, 792.0, [(0, 10.5, 100, 20, shared), (0, 40, 50, 50, other)]),
+    ]
+
+@pytest.mark.parametrize("value", [
+    (3, b"%PDF-1.4 body"),
+    {"pdf_path": None, "page": np.int64(2), "dpi": 300, "bbox": [1, 2, 3, 4], "segments": [[0, 10, False]]},
+    [],
+])
+def test_entry_round_trip(value):
+    restored = unpack_entry(pack_entry(value))
+    if isinstance(value, dict):
+        assert restored == dict(value, page=2)
+    else:
+        assert restored == value
+
+def test_pages_round_trip_share_images():
+    pages = _pages()
+    data = pack_entry([pages, {"page": 1}])
+    assert data.count(b"\x00\xff" * 8) == 1
+    restored, plan = unpack_entry(data)
+    assert restored == pages and plan == {"page": 1}
+    assert restored[0].placements[0][4] is restored[1].placements[0][4]
+
+def test_pickles_are_not_loaded(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    cache.put("documents", "ab" * 32, (1, b"%PDF"))
+    path = cache._path("documents", "ab" * 32)
+    with open(path, "wb") as f:
+        pickle.dump((1, b"%PDF"), f)
+    assert cache.get("documents", "ab" * 32) is None
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="POSIX permissions")
+def test_cache_refuses_shared_directory(tmp_path):
+    root = tmp_path / "shared"
+    root.mkdir()
+    os.chmod(root, 0o777)
+    assert not private_dir(str(root))
+    assert not ResultCache(str(root)).enabled
+    fresh = tmp_path / "fresh"
+    assert private_dir(str(fresh))
+    assert os.stat(fresh).st_mode & 0o777 == 0o700
+
+def test_strip_pages_round_trip():
+    strips = [Strip((0, 2, 10, 8), "ab" * 16, b"zlib data"), Strip((1, 20, 5, 30), "cd" * 16, b"more")]
+    pages = [StripPage(612.0, 792.0, 300, "bilevel", "balanced", strips), StripPage(612.0, 792.0, 300, "gray",
+                                                                                     "small", [])]
+    assert unpack_entry(pack_entry([pages])) == [pages]
+
+def test_inserts_walk_the_cache_only_when_it_is_full(tmp_path, monkeypatch):
+    walks = []
+    real_walk = os.walk
+    monkeypatch.setattr(os, "walk", lambda root: walks.append(root) or real_walk(root))
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=10 * 1024)
+    for index in range(20):
+        cache.put("documents", f"{index:064x}", (1, b"x" * 100))
+    assert len(walks) == 1
+    for index in range(20, 200):
+        cache.put("documents", f"{index:064x}", (1, b"x" * 100))
+    sizes = [os.path.getsize(os.path.join(dirpath, name))
+             for dirpath, _, names in real_walk(cache.root) for name in names]
+    assert sum(sizes) <= 10 * 1024
+    # A full cache is walked once per tenth of its size written, not per insert
+    entry_size = os.path.getsize(cache._path("documents", f"{199:064x}"))
+    assert 1 < len(walks) <= 1 + 180 * entry_size // 1024
+    assert cache.get("documents", f"{199:064x}") == (1, b"x" * 100)
+    assert cache.get("documents", f"{0:064x}") is None
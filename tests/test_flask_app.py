@@ -0,0 +1,101 @@
+import io
+import os
+import threading
+import time
+import pytest
+import flask_app
+import jobs
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """
+    A test client with fresh services: no result cache, a thread job pool and
+    uploads spilled to disk, so tests see the temp directories.
+    """
+    for name in ('result_cache', 'raster_cache', 'job_queue', 'memory_budget'):
+        monkeypatch.setattr(flask_app, name, None)
+    for key, value in {'CACHE_ENABLED': False, 'CACHE_DIR': str(tmp_path / 'cache'), 'JOB_EXECUTOR': 'thread',
+                       'UPLOAD_SPOOL_BYTES': 0, 'ADMISSION_TIMEOUT': 0.1}.items():
+        monkeypatch.setitem(flask_app.app.config, key, value)
+    monkeypatch.setattr(flask_app.tempfile, 'tempdir', str(tmp_path))
+    yield flask_app.app.test_client()
+    if flask_app.job_queue is not None:
+        flask_app.job_queue.shutdown()
+
+def _upload(path, output='raster'):
+    return {'pdf_file': [(open(path, 'rb'), 'input.pdf')], 'output': output}
+
+def _spill_dirs(tmp_path):
+    return [entry for entry in os.listdir(tmp_path) if entry.startswith('tmp')]
+
+def test_unread_stream_removes_spilled_uploads(client, make_pdf, tmp_path, monkeypatch):
+    monkeypatch.setattr(flask_app, 'formatted_pages', lambda input_paths: iter(['page']))
+    with flask_app.app.test_request_context('/', method='POST', data=_upload(make_pdf(1))):
+        response = flask_app.upload_file()
+    assert response.status_code == 200
+    assert _spill_dirs(tmp_path)
+    # Closed without the body ever being iterated, as when the client disconnects first
+    response.close()
+    assert not _spill_dirs(tmp_path)
+    assert flask_app.memory_budget.usage() == (0, 0)
+
+def _post(client, url, data):
+    response = client.post(url, data=data, content_type='multipart/form-data')
+    return response.status_code, response
+
+def test_estimate_over_the_request_limit_is_rejected(client, make_pdf, tmp_path, monkeypatch):
+    monkeypatch.setitem(flask_app.app.config, 'REQUEST_MEMORY_BYTES', 1024)
+    status, response = _post(client, '/', _upload(make_pdf(1)))
+    assert status == 413 and b'more than the 0 MB limit' in response.data
+    assert not _spill_dirs(tmp_path)
+    status, response = _post(client, '/jobs', _upload(make_pdf(1)))
+    assert status == 413 and 'limit' in response.get_json()['error']
+    assert not flask_app.job_queue._jobs
+    assert flask_app.memory_budget.usage() == (0, 0)
+
+def test_unreadable_upload_is_rejected(client, tmp_path):
+    data = {'pdf_file': [(io.BytesIO(b'not a pdf'), 'input.pdf')]}
+    status, response = _post(client, '/', data)
+    assert status == 400 and response.data.startswith(b'File 1 is not a readable PDF')
+    assert not _spill_dirs(tmp_path)
+    data = {'pdf_file': [(io.BytesIO(b'not a pdf'), 'input.pdf')]}
+    status, response = _post(client, '/jobs', data)
+    assert status == 400 and response.get_json()['error'].startswith('File 1 is not a readable PDF')
+    assert not flask_app.job_queue._jobs
+
+def test_busy_server_answers_503(client, make_pdf, tmp_path, monkeypatch):
+    monkeypatch.setitem(flask_app.app.config, 'MAX_CONCURRENT_REQUESTS', 1)
+    flask_app.init_services()
+    assert flask_app.memory_budget.acquire(0)
+    status, response = _post(client, '/', _upload(make_pdf(1)))
+    assert status == 503 and response.headers['Retry-After'] == '10'
+    assert not _spill_dirs(tmp_path)
+    flask_app.memory_budget.release(0)
+
+def test_job_holds_its_estimate_while_it_runs(client, make_pdf, monkeypatch):
+    monkeypatch.setitem(flask_app.app.config, 'MAX_CONCURRENT_REQUESTS', 1)
+    flask_app.init_services()
+    started, finish = threading.Event(), threading.Event()
+
+    def run_job(input_paths, output_path, *args, **options):
+        started.set()
+        finish.wait(30)
+        with open(output_path, 'wb') as f:
+            f.write(b'%PDF-1.4')
+        return 1, None, None
+
+    monkeypatch.setattr(jobs, 'run_job', run_job)
+    # The budget is full, so the job waits for it instead of being turned away
+    pdf_path = make_pdf(1)
+    assert flask_app.memory_budget.acquire(0)
+    status, response = _post(client, '/jobs', _upload(pdf_path))
+    assert status == 202
+    assert not started.wait(0.2)
+    flask_app.memory_budget.release(0)
+    assert started.wait(30)
+    assert flask_app.memory_budget.usage() == (flask_app.estimate_memory([pdf_path]), 1)
+    finish.set()
+    job_id = response.get_json()['id']
+    while flask_app.job_queue.status(job_id)['status'] != 'done':
+        time.sleep(0.01)
+    assert flask_app.memory_budget.usage() == (0, 0)
@@ -0,0 +1,93 @@
+import os
+import shutil
+import pytest
+from pypdf import PdfReader
+import incremental
+
+pytestmark = pytest.mark.skipif(shutil.which("pdftoppm") is None, reason="needs poppler")
+
+@pytest.fixture
+def rendered(monkeypatch):
+    """
+    The inputs each build renders, in order.
+    """
+    calls = []
+    real_page_results = incremental.page_results
+
+    def page_results(pdf_paths, *args, **kwargs):
+        calls.append([os.path.basename(pdf_path) for pdf_path in pdf_paths])
+        return real_page_results(pdf_paths, *args, **kwargs)
+
+    monkeypatch.setattr(incremental, "page_results", page_results)
+    return calls
+
+def _build(pdf_paths, tmp_path):
+    output = str(tmp_path / "out.pdf")
+    assert incremental.build_incremental(pdf_paths, output, str(tmp_path / "state"), dpi=72) == 0
+    return output
+
+def _page_count(output):
+    return len(PdfReader(output).pages)
+
+def test_unchanged_inputs_are_up_to_date(make_pdf, tmp_path, rendered, monkeypatch, capsys):
+    pdf_paths = [make_pdf(1, "a.pdf"), make_pdf(2, "b.pdf")]
+    output = _build(pdf_paths, tmp_path)
+    assert rendered == [["a.pdf", "b.pdf"]]
+    before = os.stat(output).st_mtime_ns
+
+    # Inputs whose size and mtime are unchanged are trusted from the manifest without being hashed
+    monkeypatch.setattr(incremental, "file_hash", lambda path: pytest.fail(f"{path} was hashed"))
+    _build(pdf_paths, tmp_path)
+    assert rendered == [["a.pdf", "b.pdf"]]
+    assert "is up to date" in capsys.readouterr().out
+    assert os.stat(output).st_mtime_ns == before
+
+def test_touched_output_is_reassembled_from_stored_results(make_pdf, tmp_path, rendered, capsys):
+    pdf_paths = [make_pdf(1, "a.pdf"), make_pdf(2, "b.pdf")]
+    output = _build(pdf_paths, tmp_path)
+    pages = _page_count(output)
+    os.utime(output, ns=(0, 0))
+    capsys.readouterr()
+    _build(pdf_paths, tmp_path)
+    assert rendered == [["a.pdf", "b.pdf"]]
+    assert "is up to date" not in capsys.readouterr().out
+    assert _page_count(output) == pages
+
+def test_manifest_is_reused_across_stores(make_pdf, tmp_path):
+    pdf_paths = [make_pdf(1, "a.pdf")]
+    _build(pdf_paths, tmp_path)
+    store = incremental.IncrementalStore(str(tmp_path / "state"))
+    entry = store.manifest["inputs"][os.path.abspath(pdf_paths[0])]
+    assert entry["size"] == os.path.getsize(pdf_paths[0])
+    assert store.digest(pdf_paths[0]) == entry["sha256"]
+
+def test_only_changed_inputs_are_rendered(make_pdf, tmp_path, rendered):
+    pdf_paths = [make_pdf(1, "a.pdf"), make_pdf(2, "b.pdf")]
+    output = _build(pdf_paths, tmp_path)
+    pages = _page_count(output)
+    make_pdf(3, "b.pdf")
+    _build(pdf_paths, tmp_path)
+    assert rendered == [["a.pdf", "b.pdf"], ["b.pdf"]]
+    assert _page_count(output) > pages
+
+def test_touched_input_with_the_same_contents_is_reused(make_pdf, tmp_path, rendered):
+    pdf_paths = [make_pdf(1, "a.pdf")]
+    _build(pdf_paths, tmp_path)
+    os.utime(pdf_paths[0], ns=(0, 0))
+    _build(pdf_paths, tmp_path)
+    assert rendered == [["a.pdf"]]
+
+def test_removed_inputs_are_pruned(make_pdf, tmp_path, rendered):
+    pdf_paths = [make_pdf(1, "a.pdf"), make_pdf(2, "b.pdf")]
+    output = _build(pdf_paths, tmp_path)
+    pages = _page_count(output)
+    segments_dir = tmp_path / "state" / "segments"
+    assert len(os.listdir(segments_dir)) == 2
+
+    os.remove(pdf_paths[1])
+    _build(pdf_paths[:1], tmp_path)
+    assert rendered == [["a.pdf", "b.pdf"]]
+    assert _page_count(output) < pages
+    assert len(os.listdir(segments_dir)) == 1
+    store = incremental.IncrementalStore(str(tmp_path / "state"))
+    assert list(store.manifest["inputs"]) == [os.path.abspath(pdf_paths[0])]
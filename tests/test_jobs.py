@@ -0,0 +1,75 @@
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+import pytest
+import jobs
+
+def _fake_run_job(input_paths, output_path, *args, **options):
+    # Stands in for formatting: one page per input
+    with open(output_path, "wb") as f:
+        f.write(b"%PDF-1.4")
+    return len(input_paths), None, None
+
+def _wait(queue, job_id, timeout=30):
+    deadline = time.time() + timeout
+    while queue.status(job_id)["status"] in ("queued", "running"):
+        assert time.time() < deadline
+        time.sleep(0.01)
+    return queue.status(job_id)
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "run_job", _fake_run_job)
+    job_queue = jobs.JobQueue(workers=1, max_pending=2, executor="thread", root=str(tmp_path / "jobs"))
+    yield job_queue
+    job_queue.shutdown()
+
+def test_job_runs_and_its_result_is_served(queue):
+    job_id, job_dir = queue.create()
+    assert os.path.isdir(job_dir)
+    assert queue.status(job_id) == {"id": job_id, "status": "queued", "error": None}
+    assert queue.result_path(job_id) is None
+    queue.start(job_id, ["a.pdf"])
+    assert _wait(queue, job_id)["status"] == "done"
+    assert queue.result_path(job_id) == os.path.join(job_dir, "formatted.pdf")
+    assert queue.status("unknown") is None
+
+def test_job_without_pages_fails(queue):
+    job_id, _ = queue.create()
+    queue.start(job_id, [])
+    assert _wait(queue, job_id) == {"id": job_id, "status": "failed", "error": "No valid PDF files processed"}
+
+def test_queue_full_and_discard(queue):
+    first, first_dir = queue.create()
+    queue.create()
+    with pytest.raises(jobs.QueueFull):
+        queue.create()
+    queue.discard(first)
+    assert not os.path.exists(first_dir) and queue.status(first) is None
+    queue.create()
+
+def test_sweep_removes_expired_results(queue):
+    queue.result_ttl = 0
+    job_id, job_dir = queue.create()
+    queue.start(job_id, ["a.pdf"])
+    while queue._jobs[job_id]["finished"] is None:
+        time.sleep(0.01)
+    time.sleep(0.01)
+    queue.sweep()
+    assert queue.status(job_id) is None and not os.path.exists(job_dir)
+
+def test_broken_process_pool_is_replaced(tmp_path):
+    queue = jobs.JobQueue(workers=1, executor="process", root=str(tmp_path / "jobs"))
+    try:
+        # A worker that dies takes the pool down, as when it is killed for memory
+        broken = queue._get_executor()
+        with pytest.raises(BrokenProcessPool):
+            broken.submit(os._exit, 1).result(timeout=60)
+        job_id, _ = queue.create()
+        queue.start(job_id, [str(tmp_path / "missing.pdf")])
+        status = _wait(queue, job_id, timeout=120)
+        assert queue._executor is not broken
+        # The new pool ran the job: it fails on the missing input, not on the pool
+        assert status["status"] == "failed" and "FileNotFoundError" in status["error"]
+    finally:
+        queue.shutdown()
@@ -0,0 +1,63 @@
+import gc
+import sys
+from unittest import mock
+import numpy as np
+from PIL import Image
+import merge
+
+def test_crop_renders_only_the_requested_page(make_pdf):
+    pdf_path = make_pdf(3)
+    page_img = Image.new("RGB", (40, 60), "white")
+    page_img.paste((0, 0, 0), (10, 20, 30, 40))
+    with mock.patch.object(merge, "convert_from_path", return_value=[page_img]) as convert:
+        cropped = merge.crop_pdf_first_page(pdf_path, dpi=150)
+    convert.assert_called_once()
+    args, kwargs = convert.call_args
+    assert args == (pdf_path,)
+    assert kwargs["first_page"] == kwargs["last_page"] == 1
+    assert kwargs["dpi"] == 150
+    assert cropped.size == (20, 20)
+
+def test_crop_of_bytes_renders_only_the_requested_page(make_pdf):
+    with open(make_pdf(3), "rb") as f:
+        pdf_bytes = f.read()
+    page_img = Image.new("L", (40, 60), "white")
+    with mock.patch.object(merge, "run_poppler", return_value=page_img) as run:
+        merge.crop_pdf_first_page(pdf_bytes, page=2, dpi=100)
+    run.assert_called_once()
+    assert run.call_args.args[1:3] == (2, 100)
+
+def test_poppler_command_limits_the_page_range():
+    result = mock.Mock(returncode=0, stdout=b"P5 1 1 255 \xff", stderr=b"")
+    with mock.patch.object(merge.subprocess, "run", return_value=result) as run:
+        merge.poppler_output("in.pdf", page=3, dpi=200)
+    command = run.call_args.args[0]
+    assert command[command.index("-f") + 1] == command[command.index("-l") + 1] == "3"
+    assert command[command.index("-r") + 1] == "200"
+
+def test_raster_cache_hit_skips_colour_check(make_pdf, tmp_path):
+    page = np.full((60, 40, 3), 255, dtype=np.uint8)
+    page[20:40, 10:30] = (200, 0, 0)
+    raster_cache = merge.RasterCache(str(tmp_path / "rasters"))
+    with mock.patch.object(merge, "render_page_array", return_value=page) as render, \
+            mock.patch.object(merge, "page_has_colour", return_value=True) as colour:
+        first, _ = merge.load_page_raster(make_pdf(1), 1, 100, "auto", raster_cache=raster_cache, digest="d")
+        second, _ = merge.load_page_raster(make_pdf(1), 1, 100, "auto", raster_cache=raster_cache, digest="d")
+    assert render.call_count == colour.call_count == 1
+    assert first.shape == second.shape == (20, 20, 3)
+
+def test_pdf_reader_reuses_unchanged_files_only(make_pdf):
+    pdf_path = make_pdf(1)
+    reader = merge.pdf_reader(pdf_path)
+    assert merge.pdf_reader(pdf_path) is reader
+    make_pdf(2)
+    assert len(merge.pdf_reader(pdf_path).pages) == 2
+
+def test_pdf_reader_does_not_hold_uploaded_bytes(make_pdf):
+    with open(make_pdf(3), "rb") as f:
+        pdf_bytes = f.read()
+    refs = sys.getrefcount(pdf_bytes)
+    assert len(merge.pdf_reader(pdf_bytes).pages) == 3
+    # A reader refers to itself through its pages, so it is freed by the collector
+    gc.collect()
+    assert sys.getrefcount(pdf_bytes) == refs
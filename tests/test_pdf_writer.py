@@ -0,0 +1,42 @@
+import io
+from PIL import Image
+from pdf_writer import EncodedPage, PdfStreamWriter, StripPage, encode_page, share_strips, write_pdf
+
+DPI = 100
+
+def _page(body_row):
+    # A header shared by every page and two body lines, more than a strip gap apart
+    img = Image.new("L", (400, 500), 255)
+    img.paste(0, (50, 20, 350, 40))
+    img.paste(0, (50, body_row, 150 + body_row // 2, body_row + 20))
+    img.paste(0, (60, body_row + 40, 100 + body_row // 4, body_row + 60))
+    return img
+
+def _write(pages):
+    buf = io.BytesIO()
+    write_pdf(pages, buf)
+    return buf.getvalue()
+
+def test_repeated_strip_is_shared_from_its_first_occurrence():
+    pages = list(share_strips(encode_page(_page(row), DPI, dedup=True) for row in (100, 200)))
+    assert all(isinstance(page, EncodedPage) for page in pages)
+    first, second = ([image for *_, image in page.placements] for page in pages)
+    # Header on its own, the two body lines together
+    assert len(first) == len(second) == 2
+    assert first[0] == second[0] and first[1] != second[1]
+    writer = PdfStreamWriter(io.BytesIO())
+    for page in pages:
+        writer.add_page(page)
+    assert writer.images_reused == 1
+
+def test_strip_pages_wait_for_the_document_and_unique_strips_merge():
+    page = encode_page(_page(100), DPI, dedup=True)
+    assert isinstance(page, StripPage) and len(page.strips) == 3
+    (shared,) = share_strips([page])
+    assert len(shared.placements) == 1
+
+def test_output_depends_only_on_the_document():
+    document = [encode_page(_page(row), DPI, dedup=True) for row in (100, 200, 300)]
+    alone = _write(document)
+    _write([encode_page(_page(row), DPI, dedup=True) for row in (150, 250)])
+    assert _write(document) == alone
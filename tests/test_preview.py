@@ -0,0 +1,34 @@
+import math
+import shutil
+import pytest
+import bench
+from banded import load_preview_page
+from merge import find_content_bbox, plan_segments, render_pdf_page, row_ink_profile
+
+pytestmark = pytest.mark.skipif(shutil.which("pdftoppm") is None, reason="needs poppler")
+
+DPI = 300
+
+@pytest.fixture(scope="module")
+def cases(tmp_path_factory):
+    return bench.generate_cases(str(tmp_path_factory.mktemp("cases")), tall_inches=20)
+
+@pytest.mark.parametrize("preview_dpi", [75])
+@pytest.mark.parametrize("name", ["short", "tall", "sparse", "dense", "multipage", "repeated"])
+def test_preview_plan_matches_full_resolution(cases, name, preview_dpi):
+    page_img = render_pdf_page(cases[name], dpi=DPI, grayscale=True)
+    bbox = find_content_bbox(page_img)
+    counts = row_ink_profile(page_img.crop(bbox))
+    preview_page, preview_counts = load_preview_page(cases[name], dpi=DPI, preview_dpi=preview_dpi)
+    assert preview_page.bbox == bbox
+    assert len(preview_counts) == len(counts)
+
+    segment_height = int((bbox[2] - bbox[0]) / (8.5 / 11))
+    full = plan_segments(counts, segment_height, DPI)
+    preview = plan_segments(preview_counts, segment_height, DPI)
+    assert len(preview) == len(full)
+    # Every cut within one preview pixel, scaled to the output DPI
+    tolerance = math.ceil(DPI / preview_dpi)
+    for (_, full_end, full_padded), (_, preview_end, preview_padded) in zip(full, preview):
+        assert abs(full_end - preview_end) <= tolerance
+        assert full_padded == preview_padded
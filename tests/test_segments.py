@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from PIL import Image
+import merge
+
+def _baseline_plan(arr, segment_height, dpi):
+    # The per-row loop segment_image_by_aspect_ratio used before plan_segments
+    def bottom_row(rows):
+        min_nonwhite, min_row = rows.shape[1], rows.shape[0] - 1
+        for i in range(rows.shape[0] - 1, max(rows.shape[0] - 1 - int(0.5 * dpi), -1), -1):
+            nonwhite = np.sum(rows[i] < merge.WHITE_THRESHOLD)
+            if nonwhite < min_nonwhite:
+                min_nonwhite, min_row = nonwhite, i
+        return min_row
+
+    h = arr.shape[0]
+    plan = []
+    start_row = 0
+    while start_row < h:
+        true_bottom = start_row + bottom_row(arr[start_row:min(start_row + segment_height, h)]) + 1
+        plan.append((start_row, true_bottom, False))
+        start_row = true_bottom
+        if h - start_row < int(0.2 * segment_height):
+            break
+    if start_row < h:
+        plan.append((start_row, h, True))
+    return plan
+
+def _text_page(rng, width, height):
+    # Lines of random length and darkness, blank gaps of random height, and some noise
+    arr = np.full((height, width), 255, dtype=np.uint8)
+    row = int(rng.integers(0, 40))
+    while row < height:
+        line = int(rng.integers(5, 60))
+        arr[row:row + line, :int(rng.integers(1, width))] = rng.integers(0, 250, size=(1, 1))
+        row += line + int(rng.integers(0, 80))
+    arr[rng.random(arr.shape) < 0.002] = 0
+    return arr
+
+@pytest.mark.parametrize("seed", range(20))
+def test_plan_segments_matches_the_per_row_loop(seed):
+    rng = np.random.default_rng(seed)
+    dpi = int(rng.choice([100, 150, 300]))
+    arr = _text_page(rng, 300, int(rng.integers(100, 6000)))
+    segment_height = int(300 / (8.5 / 11))
+    counts = merge.row_ink_profile(arr)
+    assert merge.plan_segments(counts, segment_height, dpi) == _baseline_plan(arr, segment_height, dpi)
+    segments = list(merge.segment_image_by_aspect_ratio(Image.fromarray(arr), dpi=dpi))
+    assert len(segments) == len(_baseline_plan(arr, segment_height, dpi))
+
+def _assert_valid_plan(plan, h, segment_height):
+    # Pages cover [0, h) contiguously, none is taller than a segment, and only the last is padded
+    assert plan[0][0] == 0 and plan[-1][1] == h
+    assert all(end == next_start for (_, end, _), (next_start, _, _) in zip(plan, plan[1:]))
+    assert all(0 < end - start <= segment_height for start, end, _ in plan)
+    assert [padded for _, _, padded in plan] == [False] * (len(plan) - 1) + [True]
+
+@pytest.mark.parametrize("seed", range(20))
+def test_optimal_plan_invariants(seed):
+    rng = np.random.default_rng(seed)
+    dpi = int(rng.choice([100, 150, 300]))
+    segment_height = int(rng.integers(200, 1200))
+    arr = _text_page(rng, 300, int(rng.integers(100, 6000)))
+    _assert_valid_plan(merge.plan_optimal_segments(merge.row_ink_profile(arr), segment_height, dpi),
+                       arr.shape[0], segment_height)
+
+@pytest.mark.parametrize("h", [1, 3300, 5000, 20000])
+def test_optimal_plan_without_blank_rows(h):
+    counts = np.full(h, 100)
+    _assert_valid_plan(merge.plan_optimal_segments(counts, 3300, 300), h, 3300)
+    segments = list(merge.segment_image_by_aspect_ratio(Image.new("L", (2550, h), 100), strategy="optimal"))
+    assert len(segments) == len(merge.plan_optimal_segments(counts, 3300, 300))
@@ -0,0 +1,19 @@
+import importlib.util
+import shutil
+import pytest
+import bench
+
+def test_upload_form_does_not_load_the_pipeline():
+    form = bench.measure_form()
+    assert form["form_status"] == 200
+    assert not form["numpy_loaded"]
+
+@pytest.mark.skipif(importlib.util.find_spec("gunicorn") is None, reason="needs gunicorn")
+@pytest.mark.skipif(shutil.which("pdftoppm") is None, reason="needs poppler")
+def test_warmed_up_server_formats_the_first_request_quickly(tmp_path):
+    with open(bench.generate_cases(str(tmp_path), tall_inches=20)["short"], "rb") as f:
+        pdf_bytes = f.read()
+    server = bench.measure_server(pdf_bytes, warm_up=True, requests=3)
+    assert server["statuses"] == [200, 200, 200]
+    # The warm-up already imported the pipeline, so the first upload costs about as much as the next ones
+    assert server["first_request_seconds"] < 2 * server["later_request_seconds"] + 0.5
@@ -0,0 +1,134 @@
+"""
+Layout analysis from the PDF text layer.
+
+For born-digital pages the content box and the cut rows do not need a raster:
+poppler's pdftotext -bbox-layout reports the box of every text line in points.
+The lines are scaled to pixels at the output DPI and turned into a row profile
+in which rows covered by a line count that line's width and rows between lines
+are empty. The break planners then only ever cut between lines, and the page
+is never rendered for analysis: only its segments are, as regions (see
+banded.BandedPage).
+
+The text layer says nothing about images or vector graphics, so a page whose
+content stream paints anything but text (a scanned page, a figure, a rule) is
+left to the raster analysis: text_layout() returns None for it.
+"""
+import math
+import os
+import subprocess
+import xml.etree.ElementTree as ET
+import numpy as np
+from merge import DEFAULT_DPI, pdf_reader, resolve_grayscale
+from banded import BandedPage, page_size_pixels
+from metrics import stage
+
+POINTS_PER_INCH = 72
+XHTML = "{http://www.w3.org/1999/xhtml}"
+# Content stream operators that paint something other than text
+GRAPHICS_OPERATORS = {b"S", b"s", b"f", b"F", b"f*", b"B", b"B*", b"b", b"b*", b"sh", b"Do", b"INLINE IMAGE"}
+# Glyph boxes are widened by this much so the crop never clips an accent or an italic overhang
+LINE_PAD_PT = 1.0
+
+def run_pdftotext(source, page=1, poppler_path=None):
+    """
+    pdftotext -bbox-layout output (XHTML) for one page of a PDF (path or bytes).
+    """
+    command = [os.path.join(poppler_path, "pdftotext") if poppler_path else "pdftotext", "-bbox-layout",
+               "-f", str(page), "-l", str(page), "-" if isinstance(source, bytes) else source, "-"]
+    result = subprocess.run(command, input=source if isinstance(source, bytes) else None,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"pdftotext failed: {result.stderr.decode(errors='replace').strip()}")
+    return result.stdout
+
+def text_lines(source, page=1, poppler_path=None):
+    """
+    Boxes (x0, y0, x1, y1) in points, from the top left of the page, of every text line on a page.
+    """
+    root = ET.fromstring(run_pdftotext(source, page, poppler_path))
+    return [
+        tuple(float(line.get(name)) for name in ("xMin", "yMin", "xMax", "yMax"))
+        for line in root.iter(XHTML + "line")
+    ]
+
+def paints_graphics(source, page=1):
+    """
+    True if the page's content stream paints anything besides text.
+    """
+    src = pdf_reader(source).pages[page - 1]
+    contents = src.get_contents()
+    if contents is None:
+        return False
+    return any(operator in GRAPHICS_OPERATORS for _, operator in contents.operations)
+
+def line_profile(lines, dpi, width, height):
+    """
+    Content box (pixels at dpi, clipped to width x height) of the text lines and
+    the row profile of that box. Returns (None, None) when there are no lines.
+    Line boxes span the font's ascent and descent, so with tight leading they
+    overlap the next line. Lines are grouped into rows (side-by-side columns
+    share a row) and each row starts below the previous row's descent, which
+    leaves an empty profile row between any two rows of text to cut at.
+    """
+    scale = dpi / POINTS_PER_INCH
+    boxes = sorted(
+        (math.floor(x0 * scale), math.floor(y0 * scale), math.ceil(x1 * scale), math.ceil(y1 * scale))
+        for x0, y0, x1, y1 in lines
+    )
+    boxes = [box for box in boxes if box[0] < box[2] and box[1] < box[3]]
+    if not boxes:
+        return None, None
+    pad = math.ceil(LINE_PAD_PT * scale)
+    bbox = (
+        max(min(b[0] for b in boxes) - pad, 0),
+        max(min(b[1] for b in boxes) - pad, 0),
+        min(max(b[2] for b in boxes) + pad, width),
+        min(max(b[3] for b in boxes) + pad, height),
+    )
+    if bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+        return None, None
+    rows = []
+    for x0, y0, x1, y1 in sorted(boxes, key=lambda box: box[1]):
+        # A line whose box is mostly inside the current row is part of it
+        if rows and y0 + (y1 - y0) // 2 < rows[-1][1]:
+            rows[-1][1] = max(rows[-1][1], y1)
+            rows[-1][2] += x1 - x0
+        else:
+            rows.append([y0, y1, x1 - x0])
+    counts = np.zeros(bbox[3] - bbox[1], dtype=np.intp)
+    bottom = None
+    for y0, y1, ink in rows:
+        top = y0 if bottom is None else max(y0, bottom + 1)
+        counts[max(top, bbox[1]) - bbox[1]:min(y1, bbox[3]) - bbox[1]] += ink
+        bottom = y1 if bottom is None else max(bottom, y1)
+    return bbox, counts
+
+def text_layout(source, page=1, dpi=DEFAULT_DPI, poppler_path=None):
+    """
+    (bbox, counts) of a page at dpi from its text layer, or None when the page
+    has no text or paints graphics and needs the raster analysis.
+    """
+    with stage("text_layout", dpi=dpi) as info:
+        if paints_graphics(source, page):
+            info["fallback"] = "graphics"
+            return None
+        width, height = page_size_pixels(source, page, dpi)
+        bbox, counts = line_profile(text_lines(source, page, poppler_path), dpi, width, height)
+        if bbox is None:
+            info["fallback"] = "no text"
+            return None
+        info["pixels"] = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+    return bbox, counts
+
+def load_text_page(pdf_path, page=1, dpi=DEFAULT_DPI, grayscale=False, backend="pdftoppm", poppler_path=None):
+    """
+    Text-layer counterpart of crop_pdf_first_page: returns (BandedPage, counts),
+    or None when the page needs the raster analysis. grayscale may be "auto";
+    it is resolved only for pages the text layer handles.
+    """
+    layout = text_layout(pdf_path, page, dpi, poppler_path)
+    if layout is None:
+        return None
+    bbox, counts = layout
+    grayscale = resolve_grayscale(grayscale, pdf_path, page, backend, poppler_path)
+    return BandedPage(pdf_path, page, dpi, bbox, grayscale, backend, poppler_path), counts
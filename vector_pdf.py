@@ -0,0 +1,168 @@
+"""
+Vector-preserving output mode.
+
+Pages are still rasterized, but only to find the content bounding box and the
+segment boundaries. Each output page then draws the original PDF page as a
+form XObject, clipped to its segment and scaled onto the letter page, so text
+and line art stay vector and the source content is stored once per input page.
+"""
+import logging
+import pypdf
+from pypdf import PdfWriter
+from pypdf.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    FloatObject,
+    NameObject,
+)
+from merge import (
+    DEFAULT_DPI,
+    open_pdf,
+    render_pdf_page,
+    find_content_bbox,
+    row_ink_profile,
+    plan_breaks,
+)
+from metrics import stage
+from banded import page_size_pixels, scan_page_bands
+
+logger = logging.getLogger("pdf_formatter")
+
+def _add_object(writer, obj):
+    """
+    Add obj to writer as an indirect object and return its reference.
+    pypdf 4.x only has the private PdfWriter._add_object for this; a public
+    add_object is used where a release provides one.
+    """
+    add = getattr(writer, "add_object", None) or getattr(writer, "_add_object", None)
+    if add is None:
+        raise RuntimeError(f"pypdf {pypdf.__version__} cannot add objects to a PdfWriter; "
+                           f"vector output is tested with the pypdf version in requirements.txt")
+    return add(obj)
+
+POINTS_PER_INCH = 72
+
+def plan_pdf_page(pdf_path, page=1, aspect_w=8.5, aspect_h=11, dpi=DEFAULT_DPI, band_rows=None, strategy="greedy",
+                  layout="raster", **render_options):
+    """
+    Render a page for analysis only and return where its segments are.
+    The plan holds the content bounding box and the segment rows, in pixels at dpi.
+    With band_rows, a page taller than band_rows pixels is analyzed strip by strip.
+    strategy picks the break planner (see merge.plan_breaks). With layout="text",
+    a page that only paints text is planned from its text layer without rendering.
+    """
+    text = None
+    if layout == "text":
+        from textlayer import text_layout
+        text = text_layout(pdf_path, page, dpi)
+    if text is not None:
+        bbox, counts = text
+    elif band_rows and page_size_pixels(pdf_path, page, dpi)[1] > band_rows:
+        bbox, counts = scan_page_bands(pdf_path, page, dpi, band_rows, grayscale=True, **render_options)
+        bbox = bbox or (0, 0, page_size_pixels(pdf_path, page, dpi)[0], len(counts))
+        counts = counts[bbox[1]:bbox[3]]
+    else:
+        img = render_pdf_page(pdf_path, page=page, dpi=dpi, grayscale=True, **render_options)
+        bbox = find_content_bbox(img) or (0, 0, img.width, img.height)
+        counts = row_ink_profile(img.crop(bbox))
+    with stage("plan", pixels=(bbox[2] - bbox[0]) * len(counts)) as info:
+        segment_height = int((bbox[2] - bbox[0]) / (aspect_w / aspect_h))
+        segments = []
+        if segment_height > 0:
+            segments = plan_breaks(counts, segment_height, dpi, strategy)
+        info["segments"] = len(segments)
+    return {
+        "pdf_path": pdf_path,
+        "page": page,
+        "dpi": dpi,
+        "bbox": bbox,
+        "segment_height": segment_height,
+        "segments": segments,
+    }
+
+def _fmt(value):
+    return f"{value:.4f}".rstrip("0").rstrip(".")
+
+def _page_form_xobject(writer, src_page):
+    """
+    Copy a source page into the writer as a form XObject and return its reference.
+    """
+    # pdftoppm renders pages with /Rotate applied; bake it into the content
+    # so pixel rows map onto the unrotated media box.
+    src_page.transfer_rotation_to_content()
+    media = src_page.mediabox
+    form = DecodedStreamObject()
+    contents = src_page.get_contents()
+    form.set_data(contents.get_data() if contents is not None else b"")
+    form[NameObject("/Type")] = NameObject("/XObject")
+    form[NameObject("/Subtype")] = NameObject("/Form")
+    form[NameObject("/BBox")] = ArrayObject(
+        [FloatObject(media.left), FloatObject(media.bottom), FloatObject(media.right), FloatObject(media.top)]
+    )
+    resources = src_page.get("/Resources")
+    if resources is not None:
+        form[NameObject("/Resources")] = resources.get_object().clone(writer)
+    return _add_object(writer, form.flate_encode())
+
+def _add_segment_page(writer, form_ref, media, plan, start_row, end_row, padded,
+                      margin_in, page_w_in, page_h_in):
+    """
+    Add one output page showing rows [start_row, end_row) of the planned source page.
+    Layout matches create_pdf_from_images: fit inside the margins and center.
+    """
+    px = POINTS_PER_INCH / plan["dpi"]
+    x0, y0, x1, _ = plan["bbox"]
+    page_w = page_w_in * POINTS_PER_INCH
+    page_h = page_h_in * POINTS_PER_INCH
+    margin = margin_in * POINTS_PER_INCH
+    content_w = page_w - 2 * margin
+    content_h = page_h - 2 * margin
+    seg_w = (x1 - x0) * px
+    seg_h = (end_row - start_row) * px
+    # The padded last segment keeps the full segment height, content at the top
+    layout_h = plan["segment_height"] * px if padded else seg_h
+    scale = min(content_w / seg_w, content_h / layout_h)
+    new_w = seg_w * scale
+    new_h = layout_h * scale
+    left = (page_w - new_w) / 2
+    top = page_h - (page_h - new_h) / 2
+    # Source rectangle in PDF user space (pixel rows count down from the top)
+    src_left = float(media.left) + x0 * px
+    src_top = float(media.top) - (y0 + start_row) * px
+    ops = (
+        f"q {_fmt(left)} {_fmt(top - seg_h * scale)} {_fmt(new_w)} {_fmt(seg_h * scale)} re W n "
+        f"{_fmt(scale)} 0 0 {_fmt(scale)} {_fmt(left - src_left * scale)} {_fmt(top - src_top * scale)} cm "
+        f"/Src Do Q"
+    )
+    page = writer.add_blank_page(width=page_w, height=page_h)
+    page[NameObject("/Resources")] = DictionaryObject({
+        NameObject("/XObject"): DictionaryObject({NameObject("/Src"): form_ref}),
+    })
+    content = DecodedStreamObject()
+    content.set_data(ops.encode("ascii"))
+    page.replace_contents(content)
+
+def create_vector_pdf(plans, output_pdf, margin_in=0.5, page_w_in=8.5, page_h_in=11):
+    """
+    Write one page per planned segment, reusing the source page vector content.
+    output_pdf may be a path or a binary file object.
+    """
+    writer = PdfWriter()
+    readers = {}
+    page_count = 0
+    for plan in plans:
+        source = plan["pdf_path"]
+        if source not in readers:
+            readers[source] = open_pdf(source)
+        src_page = readers[source].pages[plan["page"] - 1]
+        form_ref = _page_form_xobject(writer, src_page)
+        for start_row, end_row, padded in plan["segments"]:
+            _add_segment_page(writer, form_ref, src_page.mediabox, plan, start_row, end_row, padded,
+                              margin_in, page_w_in, page_h_in)
+            page_count += 1
+    if page_count:
+        with stage("write_vector_pdf", pages=page_count):
+            writer.write(output_pdf)
+        logger.info("Saved all pages to %s", output_pdf)
+    return page_count
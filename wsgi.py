@@ -0,0 +1,18 @@
+"""
+WSGI entry point for production servers.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Importing this module creates the app and warms it up (flask_app.warm_up).
+With gunicorn's preload_app that happens once, in the master, before the
+workers are forked: every worker starts with the pipeline imported and
+poppler and the image codecs loaded, and only the pages touched after the
+fork are copied. PDF_FORMATTER_WARM_UP=0 skips the warm-up.
+"""
+import os
+from flask_app import create_app, warm_up
+
+app = create_app()
+
+if os.environ.get('PDF_FORMATTER_WARM_UP', '1') != '0':
+    warm_up()